@@ -0,0 +1,122 @@
+"""
+Bytes written to Redis per channel layer message, with and without the
+compression of main.layers.HybridChannelLayer.
+
+    python -m benchmarks.layer_bench
+    python -m benchmarks.layer_bench --threshold 512 --compare before.json
+
+Serializes the events the consumers send through the channel layer, so no
+Redis server is needed, and reports their stored size and the time to
+serialize and deserialize them.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import time
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+import django  # noqa: E402
+
+django.setup()
+
+from benchmarks.ws_bench import compare  # noqa: E402
+from benchmarks.ws_bench import git_commit  # noqa: E402
+from main.layers import HybridChannelLayer  # noqa: E402
+from main.presence import presence_entry  # noqa: E402
+
+ADDRESS = {
+    'sender_country_code': '+44',
+    'sender_phone_number': '7000000001',
+    'receiver_country_code': '+44',
+    'receiver_phone_number': '7000000002',
+}
+
+
+def relay(frame: dict, **extra) -> dict:
+    # as sent by UserAuthorizationConsumer.relay_event and send_receipts
+    return {'type': 'relay', 'text': json.dumps(frame), **extra}
+
+
+def events() -> dict[str, dict]:
+    hashes = [hashlib.sha256(str(n).encode()).hexdigest()
+              for n in range(500)]
+    return {
+        'private_message': relay({
+            'type': 'private_message', **ADDRESS,
+            'message': 'See you at eight?', 'hash': hashes[0],
+            'timestamp': '1700000000.123',
+        }),
+        'image_message': relay({
+            'type': 'image_message', **ADDRESS,
+            'blob': hashes[1], 'hash': hashes[2],
+            'timestamp': '1700000000.123',
+        }),
+        'message_read_batch': relay({
+            'type': 'message_read', **ADDRESS, 'hashes': hashes,
+        }, receipt='message_read:+447000000001'),
+        'presence': relay({
+            'type': 'presence',
+            'users': [presence_entry('+44', f'7{n:09d}', n % 2 == 0, None)
+                      for n in range(200)],
+        }),
+    }
+
+
+def measure(layer: HybridChannelLayer, message: dict, repeat: int) -> dict:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        stored = layer.serialize(message)
+    serialize = (time.perf_counter() - started) / repeat
+    started = time.perf_counter()
+    for _ in range(repeat):
+        layer.deserialize(stored)
+    deserialize = (time.perf_counter() - started) / repeat
+    return {
+        'bytes': len(stored),
+        'serialize_us': serialize * 1e6,
+        'deserialize_us': deserialize * 1e6,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threshold', type=int, default=1024,
+                        help='compression_threshold of the layer')
+    parser.add_argument('--level', type=int, default=1,
+                        help='compression_level of the layer')
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--output', default='layer_bench_output.json')
+    parser.add_argument('--compare', help='results of an earlier run')
+    args = parser.parse_args()
+
+    plain = HybridChannelLayer(compression_threshold=None)
+    compressed = HybridChannelLayer(compression_threshold=args.threshold,
+                                    compression_level=args.level)
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'args': vars(args),
+    }
+    for name, message in events().items():
+        before = measure(plain, message, args.repeat)
+        after = measure(compressed, message, args.repeat)
+        results[name] = {
+            'uncompressed': before,
+            'compressed': after,
+            'ratio': after['bytes'] / before['bytes'],
+        }
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
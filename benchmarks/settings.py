@@ -0,0 +1,70 @@
+# flake8: noqa
+
+"""
+Settings for the benchmarks, see benchmarks/ws_bench.py.
+
+Uses a throw-away SQLite database and the in-memory channel layer unless
+BENCH_REDIS_HOST is set, e.g. `BENCH_REDIS_HOST=127.0.0.1:6379`. With Redis,
+`BENCH_CHANNEL_LAYER=redis` runs the plain Redis layer instead of the hybrid
+one, to compare the two.
+"""
+import os
+import tempfile
+
+from chat.settings import *
+
+DEBUG = False
+
+BENCH_DIR = Path(os.environ.get('BENCH_DIR') or tempfile.mkdtemp(
+    prefix='chat-bench-'))
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BENCH_DIR / 'db.sqlite3',
+    }
+}
+
+# BENCH_SHARDS=N stores the messages in N more SQLite databases
+MESSAGE_SHARDS = [f'messages-{i}'
+                  for i in range(int(os.environ.get('BENCH_SHARDS', 0)))]
+for shard in MESSAGE_SHARDS:
+    DATABASES[shard] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BENCH_DIR / f'{shard}.sqlite3',
+    }
+MESSAGE_SHARDS = MESSAGE_SHARDS or ['default']
+
+# create the main tables straight from the models
+MIGRATION_MODULES = {'main': None}
+
+if os.environ.get('BENCH_REDIS_HOST'):
+    host, port = os.environ['BENCH_REDIS_HOST'].split(':')
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': {
+                'hybrid': 'main.layers.HybridChannelLayer',
+                'redis': 'channels_redis.core.RedisChannelLayer',
+            }[os.environ.get('BENCH_CHANNEL_LAYER', 'hybrid')],
+            'CONFIG': {
+                "hosts": [(host, int(port))],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 10000,
+            },
+        },
+    }
+
+BLOB_ROOT = BENCH_DIR / 'blobs'
+
+# logins in benchmarks must not reach Twilio
+SMS = {**SMS, 'PROVIDER': 'main.sms.FakeProvider'}
+
+# benchmark clients send as fast as they can
+SOCKET_LIMITS = {**SOCKET_LIMITS, 'RATE': (1e6, 1e6), 'EVENT_RATES': {}}
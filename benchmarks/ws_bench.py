@@ -0,0 +1,270 @@
+"""
+WebSocket benchmark of the chat ASGI application, run in-process.
+
+    python -m benchmarks.ws_bench --clients 2000 --messages 20
+    python -m benchmarks.ws_bench --output after.json --compare before.json
+
+Reports connects per second, `private_message` relay latency and
+throughput on `ws/user/`, and fan-out on `ws/chat/<room>/`. Results are
+written as JSON so runs on two commits, or two channel layers, can be
+diffed:
+
+    BENCH_REDIS_HOST=127.0.0.1:6379 BENCH_CHANNEL_LAYER=redis \\
+        python -m benchmarks.ws_bench --output redis.json
+    BENCH_REDIS_HOST=127.0.0.1:6379 \\
+        python -m benchmarks.ws_bench --output hybrid.json --compare redis.json
+
+`BENCH_SHARDS=4` stores the messages in four SQLite shards, see
+main.shards.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.settings'
+
+import django  # noqa: E402
+
+django.setup()
+
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from rest_framework_simplejwt.tokens import RefreshToken  # noqa: E402
+from chat.asgi import application  # noqa: E402
+from main.metrics import CHANNEL_LAYER_MESSAGES  # noqa: E402
+from main.models import User  # noqa: E402
+
+TIMEOUT = 60
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def summary(latencies: list[float]) -> dict:
+    # seconds in, milliseconds out
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'p999_ms': percentile(latencies, 0.999) * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000,
+    }
+
+
+def create_users(count: int) -> list[User]:
+    for database in settings.DATABASES:
+        call_command('migrate', run_syncdb=True, verbosity=0,
+                     database=database)
+    User.objects.bulk_create(
+        User(country_code='+44', phone_number=f'7{i:09d}', is_active=True)
+        for i in range(count)
+    )
+    users = list(User.objects.order_by('id')[:count])
+    for user in users:
+        user.access_token = str(RefreshToken.for_user(user).access_token)
+    User.objects.bulk_update(users, ['access_token'], batch_size=500)
+    return users
+
+
+def user_client(user: User) -> WebsocketCommunicator:
+    return WebsocketCommunicator(application, 'ws/user/', headers=[
+        (b'authorization', f'Bearer {user.access_token}'.encode()),
+    ])
+
+
+async def gather_limited(coroutines, concurrency: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+async def connect(communicator: WebsocketCommunicator) -> None:
+    connected, _ = await communicator.connect(timeout=TIMEOUT)
+    if not connected:
+        raise RuntimeError('connection refused')
+
+
+async def bench_private_messages(users: list[User], messages: int,
+                                 concurrency: int) -> dict:
+    clients = [user_client(user) for user in users]
+    started = time.perf_counter()
+    await gather_limited((connect(client) for client in clients),
+                         concurrency)
+    connect_seconds = time.perf_counter() - started
+
+    latencies: list[float] = []
+
+    async def send(i: int) -> None:
+        sender, receiver = users[i], users[(i + 1) % len(users)]
+        for n in range(messages):
+            await clients[i].send_to(text_data=json.dumps({
+                'type': 'private_message',
+                'sender_country_code': sender.country_code,
+                'sender_phone_number': sender.phone_number,
+                'receiver_country_code': receiver.country_code,
+                'receiver_phone_number': receiver.phone_number,
+                'message': f'message {n}',
+                'hash': f'{i}-{n}',
+                'timestamp': repr(time.perf_counter()),
+            }))
+
+    async def receive(i: int) -> None:
+        # own echoes plus the messages of the previous client
+        for _ in range(2 * messages):
+            frame = json.loads(
+                await clients[i].receive_from(timeout=TIMEOUT)
+            )
+            if frame['receiver_phone_number'] == users[i].phone_number:
+                latencies.append(
+                    time.perf_counter() - float(frame['timestamp'])
+                )
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(len(users))),
+                         *(receive(i) for i in range(len(users))))
+    relay_seconds = time.perf_counter() - started
+
+    await asyncio.gather(*(client.disconnect() for client in clients))
+    return {
+        'clients': len(users),
+        'connects_per_second': len(users) / connect_seconds,
+        'messages': len(latencies),
+        'messages_per_second': len(latencies) / relay_seconds,
+        'latency': summary(latencies),
+    }
+
+
+async def bench_rooms(rooms: int, members: int, messages: int,
+                      concurrency: int) -> dict:
+    clients = [[WebsocketCommunicator(application, f'ws/chat/room{r}/')
+                for _ in range(members)] for r in range(rooms)]
+    everyone = [client for room in clients for client in room]
+    await gather_limited((connect(client) for client in everyone),
+                         concurrency)
+
+    latencies: list[float] = []
+
+    async def send(client: WebsocketCommunicator) -> None:
+        for _ in range(messages):
+            await client.send_to(text_data=json.dumps({
+                'message': repr(time.perf_counter()),
+            }))
+
+    async def receive(client: WebsocketCommunicator) -> None:
+        # every member receives every message sent to the room
+        for _ in range(members * messages):
+            frame = json.loads(await client.receive_from(timeout=TIMEOUT))
+            latencies.append(time.perf_counter() - float(frame['message']))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(client) for client in everyone),
+                         *(receive(client) for client in everyone))
+    seconds = time.perf_counter() - started
+
+    await asyncio.gather(*(client.disconnect() for client in everyone))
+    return {
+        'rooms': rooms,
+        'members': members,
+        'deliveries': len(latencies),
+        'deliveries_per_second': len(latencies) / seconds,
+        'latency': summary(latencies),
+    }
+
+
+def channel_layer_messages() -> dict:
+    # deliveries of the hybrid layer, empty for the other layers
+    with CHANNEL_LAYER_MESSAGES.lock:
+        counts = {'.'.join(key): value
+                  for key, value in CHANNEL_LAYER_MESSAGES.values.items()}
+    local = sum(value for key, value in counts.items()
+                if key.endswith('.local'))
+    remote = sum(value for key, value in counts.items()
+                 if key.endswith('.remote'))
+    if local + remote:
+        counts['local_ratio'] = local / (local + remote)
+    return counts
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(results: dict, baseline: dict, prefix: str = '') -> None:
+    # print every numeric metric next to the baseline value
+    for key, value in results.items():
+        old = baseline.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            compare(value, old, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) \
+                and isinstance(old, (int, float)) and old:
+            print(f'{prefix}{key}: {old:.2f} -> {value:.2f} '
+                  f'({(value - old) / old:+.1%})')
+
+
+async def run(args: argparse.Namespace, users: list[User]) -> dict:
+    return {
+        'private_message': await bench_private_messages(
+            users, args.messages, args.concurrency
+        ),
+        'rooms': await bench_rooms(
+            args.rooms, args.room_members, args.room_messages,
+            args.concurrency
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10,
+                        help='private messages sent by each client')
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--room-members', type=int, default=50)
+    parser.add_argument('--room-messages', type=int, default=5,
+                        help='messages sent by each room member')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='connections opened at the same time')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', help='results of an earlier run')
+    args = parser.parse_args()
+
+    users = create_users(args.clients)
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+        'message_shards': len(settings.MESSAGE_SHARDS),
+        'args': vars(args),
+        **asyncio.run(run(args, users)),
+        'channel_layer_messages': channel_layer_messages(),
+    }
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ import os
 from channels.routing import ProtocolTypeRouter
 from channels.routing import URLRouter
 from channels.auth import AuthMiddlewareStack
-from django.core.asgi import get_asgi_application
+from main.streaming import get_asgi_application
 import main.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat.settings')
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
+import os
 from datetime import timedelta
 from pathlib import Path
 
@@ -63,6 +64,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -104,6 +106,15 @@ DATABASES = {
     }
 }
 
+# Messages are stored in the database of their conversation, see main.shards.
+# Each alias needs an entry in DATABASES, e.g.
+# 'messages-1': {'ENGINE': ..., 'NAME': BASE_DIR / 'messages-1.sqlite3'},
+# then `manage.py migrate --database=messages-1`. After changing the list,
+# `manage.py rebalance_messages` moves the conversations to their new shard.
+MESSAGE_SHARDS = ['default']
+
+DATABASE_ROUTERS = ['main.shards.MessageRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -157,12 +168,14 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [],
 }
 
-# Channels
+# Channels, sockets of the same worker talk without going through Redis
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'main.layers.HybridChannelLayer',
         'CONFIG': {
             "hosts": [('127.0.0.1', 6379)],
+            # messages packed to more bytes are stored compressed in Redis
+            'compression_threshold': 1024,
         },
     },
 }
@@ -196,4 +209,125 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
-}
\ No newline at end of file
+}
+
+# Messages are persisted in batches by main.persistence.MessageWriter
+MESSAGE_WRITER = {
+    'BATCH_SIZE': 500,  # flush once this many messages are buffered
+    'FLUSH_INTERVAL': 0.5,  # or once the oldest one is this many seconds old
+    'MAX_PENDING': 10000,  # senders wait while the buffer is this full
+}
+
+# Undelivered messages are replayed to a connecting user in pages of this
+# size, and it is the largest page the sync endpoint returns
+MESSAGE_SYNC_PAGE_SIZE = 200
+
+# Registered contacts are looked up this many phone numbers per query
+CONTACTS_CHUNK_SIZE = 500
+
+# Uploaded images, stored by sha256 in main.blobs.BlobStore
+BLOB_ROOT = BASE_DIR / 'blobs'
+BLOB_MAX_SIZE = 20 * 1024 * 1024
+BLOB_CHUNK_SIZE = 64 * 1024
+
+# Users authenticated on WebSocket connect, see main.auth.UserCache
+USER_CACHE = {
+    'TTL': 60,  # seconds
+    'MAX_SIZE': 10000,
+}
+
+# Largest page of a conversation's history, see main.views.HistoryView
+MESSAGE_HISTORY_PAGE_SIZE = 100
+
+# Largest page of message search results, see main.views.SearchView
+MESSAGE_SEARCH_PAGE_SIZE = 50
+
+# Messages fetched and sent at a time by main.views.ExportView
+MESSAGE_EXPORT_CHUNK_SIZE = 2000
+
+# retention of the message table, run `manage.py archive_messages`
+# periodically, see main.archive
+MESSAGE_ARCHIVE = {
+    'ROOT': BASE_DIR / 'archive',
+    # delivered messages older than this many days move to the archive
+    'AGE_DAYS': 365,
+    # messages moved, or soft-deleted messages purged, per transaction
+    'BATCH_SIZE': 5000,
+    'PURGE_BATCH_SIZE': 1000,
+    # messages per compressed block, each has one line in the index
+    'BLOCK_SIZE': 500,
+}
+
+# Delivery and read receipts are coalesced per conversation over this many
+# seconds, see main.receipts.ReceiptBatcher
+RECEIPT_WINDOW = 0.2
+
+# OTP SMS are sent in the background by main.sms.SMSQueue
+SMS = {
+    # 'main.sms.FakeProvider' keeps messages in memory instead
+    'PROVIDER': 'main.sms.TwilioProvider',
+    'CONCURRENCY': 4,  # messages in flight at once
+    'MAX_PENDING': 1000,  # /login/ fails while this many are queued
+    'RETRIES': 3,
+    'BACKOFF': 0.5,  # seconds before the first retry, doubled after
+    # repeated logins within this many seconds get the same code and SMS
+    'DEDUPE_WINDOW': 60,
+}
+
+# per socket limits of the user WebSocket, see main.limits and main.outbound
+SOCKET_LIMITS = {
+    # token bucket of every received frame, (frames per second, burst)
+    'RATE': (20, 60),
+    # token buckets of single event types
+    'EVENT_RATES': {
+        'private_message': (10, 30),
+        'delete_private_message': (5, 20),
+        'image_message': (1, 5),
+    },
+    # frames waiting to be sent to the client
+    'OUTBOUND_QUEUE_SIZE': 1000,
+    # close sockets that took no frame for this many seconds while some
+    # were waiting
+    'SLOW_TIMEOUT': 10,
+}
+
+# online state and last seen times, see main.presence
+PRESENCE = {
+    # seconds between two batches of presence frames
+    'WINDOW': 1.0,
+    # going offline is only pushed after this many seconds offline
+    'DEBOUNCE': 5.0,
+    # seconds between two bulk writes of the last seen times
+    'FLUSH_INTERVAL': 30.0,
+    # close sockets that sent heartbeats but none for this many seconds
+    'HEARTBEAT_TIMEOUT': 90.0,
+}
+
+# chat rooms of ChatConsumer
+CHAT_ROOMS = {
+    # 'worker': every worker joins the room's group once and fans out to
+    # its own sockets, see main.rooms. 'member': every socket joins it
+    'FANOUT': 'worker',
+    # recent messages of each room replayed to new members, 0 disables.
+    # Only kept with the 'worker' fan-out
+    'HISTORY_SIZE': 50,
+    # the least recently used rooms are dropped past either limit
+    'HISTORY_MAX_ROOMS': 1000,
+    'HISTORY_MAX_BYTES': 16 * 2 ** 20,
+}
+
+# permessage-deflate of the WebSocket connections, served by
+# chat.workers.UvicornWorker
+WEBSOCKET_DEFLATE = {
+    'ENABLED': True,
+    # 8 to 15, memory per socket grows with both
+    'MAX_WINDOW_BITS': 12,
+    'MEM_LEVEL': 5,
+}
+
+# who can scrape main.metrics at /metrics/: clients from these networks, as
+# seen in REMOTE_ADDR, or sending `Authorization: Bearer <TOKEN>`
+METRICS = {
+    'ALLOWED_NETWORKS': ['127.0.0.1/32', '::1/128'],
+    'TOKEN': os.environ.get('METRICS_TOKEN') or None,
+}
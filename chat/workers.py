@@ -0,0 +1,39 @@
+"""
+Gunicorn worker of the chat ASGI application.
+
+    gunicorn chat.asgi -k chat.workers.UvicornWorker
+
+Like uvicorn's own worker, with the permessage-deflate settings of the
+WebSocket connections taken from WEBSOCKET_DEFLATE in chat/settings.py.
+"""
+from django.conf import settings
+from uvicorn.protocols.websockets.websockets_impl import \
+    WebSocketProtocol as UvicornWebSocketProtocol
+from uvicorn.workers import UvicornWorker as BaseUvicornWorker
+from websockets.extensions.permessage_deflate import \
+    ServerPerMessageDeflateFactory
+
+
+def deflate_extensions() -> list:
+    deflate = settings.WEBSOCKET_DEFLATE
+    if not deflate['ENABLED']:
+        return []
+    return [ServerPerMessageDeflateFactory(
+        server_max_window_bits=deflate['MAX_WINDOW_BITS'],
+        client_max_window_bits=deflate['MAX_WINDOW_BITS'],
+        compress_settings={'memLevel': deflate['MEM_LEVEL']},
+    )]
+
+
+class WebSocketProtocol(UvicornWebSocketProtocol):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # offered to clients that ask for permessage-deflate, uvicorn's
+        # defaults take about 300 KiB per socket
+        self.available_extensions = deflate_extensions()
+
+
+class UvicornWorker(BaseUvicornWorker):
+    CONFIG_KWARGS = {**BaseUvicornWorker.CONFIG_KWARGS,
+                     'ws': WebSocketProtocol}
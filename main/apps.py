@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        # connects the user cache invalidation signals
+        from . import auth  # noqa: F401
+        # creates the message search index after migrate
+        from . import search  # noqa: F401
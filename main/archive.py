@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import fcntl
+import gzip
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from pathlib import Path
+from typing import Iterator
+from django.conf import settings
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_micros(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value)
+
+
+def month_of(micros: int) -> str:
+    return from_micros(micros).strftime('%Y-%m')
+
+
+class MessageArchive:
+    """
+    Cold storage of old messages, one pair of append-only files per month.
+
+    `<month>.ndjson.gz` holds blocks of up to `block_size` messages, each
+    a gzip member of JSON lines sorted by conversation, so the whole file
+    still reads with zcat. `<month>.index` has one JSON line per block with
+    its offset and size, its highest id, its newest message and the newest
+    message of each conversation in it; a block only counts once its index
+    line is written.
+    Finding a conversation reads the small index and decompresses only the
+    blocks that hold it, a conversation that was never archived costs a
+    dictionary lookup per month.
+    """
+
+    def __init__(self, root: Path | str, block_size: int = 500):
+        self.root = Path(root)
+        self.block_size = block_size
+        # month -> (size of the index file, its entries, conversation ->
+        # the entries of the blocks holding it)
+        self.indexes: dict[str, tuple[int, list[dict],
+                                      dict[str, list[dict]]]] = {}
+        self.lock = threading.Lock()
+
+    def path(self, month: str, suffix: str) -> Path:
+        return self.root / f'{month}{suffix}'
+
+    def months(self) -> list[str]:
+        """
+        Archived months, newest first
+        """
+        if not self.root.is_dir():
+            return []
+        return sorted((path.name[:-len('.index')]
+                       for path in self.root.glob('*.index')), reverse=True)
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        # one writer at a time, across processes
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, records: list[dict]) -> None:
+        """
+        Adds messages, as dicts with `conversation` and `creation_date` in
+        microseconds, to the files of their months. Call within writing().
+        """
+        by_month: dict[str, list[dict]] = {}
+        for record in records:
+            by_month.setdefault(month_of(record['creation_date']),
+                                []).append(record)
+        for month, month_records in by_month.items():
+            month_records.sort(key=lambda record: (
+                record['conversation'], record['creation_date'], record['id']
+            ))
+            entries = []
+            with open(self.path(month, '.ndjson.gz'), 'ab') as blocks:
+                offset = blocks.tell()
+                for start in range(0, len(month_records), self.block_size):
+                    block = month_records[start:start + self.block_size]
+                    data = gzip.compress(''.join(
+                        json.dumps(record) + '\n' for record in block
+                    ).encode())
+                    blocks.write(data)
+                    conversations: dict[str, int] = {}
+                    for record in block:
+                        conversations[record['conversation']] = max(
+                            conversations.get(record['conversation'], 0),
+                            record['creation_date']
+                        )
+                    entries.append({
+                        'offset': offset,
+                        'size': len(data),
+                        'last_id': max(record['id'] for record in block),
+                        'newest': max(conversations.values()),
+                        'conversations': conversations,
+                    })
+                    offset += len(data)
+                blocks.flush()
+                os.fsync(blocks.fileno())
+            with open(self.path(month, '.index'), 'a') as index:
+                index.write(''.join(json.dumps(entry) + '\n'
+                                    for entry in entries))
+                index.flush()
+                os.fsync(index.fileno())
+        return None
+
+    def index(self, month: str) -> list[dict]:
+        return self.load_index(month)[0]
+
+    def blocks(self, month: str, conversation: str) -> list[dict]:
+        # index entries of the blocks of `month` holding the conversation
+        return self.load_index(month)[1].get(conversation, [])
+
+    def load_index(self, month: str
+                   ) -> tuple[list[dict], dict[str, list[dict]]]:
+        path = self.path(month, '.index')
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return [], {}
+        with self.lock:
+            cached = self.indexes.get(month)
+            if cached is not None and cached[0] == size:
+                return cached[1], cached[2]
+        with open(path) as index:
+            # a line cut short by a crash is not a block yet
+            entries = [json.loads(line) for line in index.read(size)
+                       .splitlines() if line.endswith('}')]
+        by_conversation: dict[str, list[dict]] = {}
+        for entry in entries:
+            for conversation in entry['conversations']:
+                by_conversation.setdefault(conversation, []).append(entry)
+        with self.lock:
+            self.indexes[month] = (size, entries, by_conversation)
+        return entries, by_conversation
+
+    def newest(self, conversation: str | None = None) -> int | None:
+        """
+        Creation date, in microseconds, of the newest archived message, of
+        `conversation` if given
+        """
+        for month in self.months():
+            if conversation is None:
+                entries = self.index(month)
+                if entries:
+                    return max(entry['newest'] for entry in entries)
+                continue
+            entries = self.blocks(month, conversation)
+            if entries:
+                return max(entry['conversations'][conversation]
+                           for entry in entries)
+        return None
+
+    def read_block(self, month: str, entry: dict) -> list[dict]:
+        with open(self.path(month, '.ndjson.gz'), 'rb') as blocks:
+            blocks.seek(entry['offset'])
+            data = gzip.decompress(blocks.read(entry['size']))
+        return [json.loads(line) for line in data.splitlines()]
+
+    def conversation(self, month: str, conversation: str) -> list[dict]:
+        return [record
+                for entry in self.blocks(month, conversation)
+                for record in self.read_block(month, entry)
+                if record['conversation'] == conversation]
+
+    def history(self, conversation: str, before: tuple[int, int] | None,
+                limit: int) -> list[dict]:
+        """
+        Page of an archived conversation, newest first, strictly older than
+        the (creation_date in microseconds, id) of `before`
+        """
+        records: dict[int, dict] = {}
+        for month in self.months():
+            if before is not None and month > month_of(before[0]):
+                continue
+            for record in self.conversation(month, conversation):
+                if before is None \
+                        or (record['creation_date'], record['id']) < before:
+                    # an interrupted run can archive a message twice
+                    records[record['id']] = record
+            # months do not overlap, older ones only hold older messages
+            if len(records) >= limit:
+                break
+        return sorted(records.values(),
+                      key=lambda record: (record['creation_date'],
+                                          record['id']),
+                      reverse=True)[:limit]
+
+    def export(self, user_id: int, after: int, limit: int) -> list[dict]:
+        """
+        The first `limit` archived messages the user sent or received, by
+        id, after the id `after`
+        """
+        records: dict[int, dict] = {}
+        for month in self.months():
+            conversations = {
+                conversation: entries for conversation, entries
+                in self.load_index(month)[1].items()
+                if str(user_id) in conversation.split(':')
+            }
+            # offset -> entry, a block can hold several of the conversations
+            blocks = {entry['offset']: entry
+                      for entries in conversations.values()
+                      for entry in entries
+                      # written before the index kept the highest id
+                      if entry.get('last_id', after + 1) > after}
+            for entry in blocks.values():
+                for record in self.read_block(month, entry):
+                    if record['conversation'] in conversations \
+                            and record['id'] > after:
+                        # an interrupted run can archive a message twice
+                        records[record['id']] = record
+            # months are not in id order, keep only the first ones so far
+            records = {pk: records[pk] for pk in sorted(records)[:limit]}
+        return [records[pk] for pk in sorted(records)]
+
+
+message_archive = MessageArchive(settings.MESSAGE_ARCHIVE['ROOT'],
+                                 settings.MESSAGE_ARCHIVE['BLOCK_SIZE'])
+
+
+def archived_until() -> str | None:
+    """
+    Creation date of the newest archived message, the endpoints reading
+    the message table only, like search, leave out the archived messages up
+    to it
+    """
+    newest = message_archive.newest()
+    return from_micros(newest).isoformat() if newest is not None else None
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import time
+import jwt
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from rest_framework.authentication import BaseAuthentication
+from .models import User
+from .metrics import sync_to_async
+from chat.settings import SECRET_KEY
+
+# offered next to a codec subprotocol by clients that cannot set headers
+TOKEN_SUBPROTOCOL_PREFIX = 'access_token.'
+
+
+class UserCache:
+    """
+    Small in-process cache of users by primary key.
+
+    Entries expire after `ttl` seconds and are dropped whenever the user is
+    saved or deleted in this process.
+    """
+
+    def __init__(self, ttl: float = 60, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.users: dict[int, tuple[float, User]] = {}
+
+    def get(self, pk: int) -> User | None:
+        entry = self.users.get(pk)
+        if entry is None:
+            return None
+        expires, user = entry
+        if expires < time.monotonic():
+            self.users.pop(pk, None)
+            return None
+        return user
+
+    def set(self, user: User) -> None:
+        if len(self.users) >= self.max_size:
+            # drop the oldest entry
+            self.users.pop(next(iter(self.users), None), None)
+        self.users[user.pk] = (time.monotonic() + self.ttl, user)
+        return None
+
+    def invalidate(self, pk: int) -> None:
+        self.users.pop(pk, None)
+        return None
+
+
+user_cache = UserCache(settings.USER_CACHE['TTL'],
+                       settings.USER_CACHE['MAX_SIZE'])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance: User, **kwargs) -> None:
+    user_cache.invalidate(instance.pk)
+
+
+@sync_to_async
+def load_user(pk: int) -> User | None:
+    user = User.exists(pk=pk)
+    if user:
+        user_cache.set(user)
+    return user
+
+
+def access_token_from_scope(scope: dict) -> str | None:
+    """
+    Access token of a WebSocket handshake, from the `Authorization: Bearer`
+    header or an `access_token.<token>` subprotocol
+    """
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            auth_type, _, token = value.decode('latin1').partition(' ')
+            if auth_type in settings.SIMPLE_JWT['AUTH_HEADER_TYPES']:
+                return token.strip() or None
+    for subprotocol in scope.get('subprotocols', []):
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):] or None
+    return None
+
+
+def decode_access_token(access_token: str) -> int | None:
+    """
+    User id of a validly signed access token, None otherwise
+    """
+    try:
+        decoded: dict = jwt.decode(str(access_token), SECRET_KEY,
+                                   algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None
+    if decoded.get('token_type') != 'access' or 'user_id' not in decoded:
+        return None
+    return decoded['user_id']
+
+
+def token_user(access_token: str) -> User | None:
+    """
+    User of a valid access token, active or not, straight from the DB for
+    the sync views
+    """
+    user_id = decode_access_token(access_token)
+    user = User.exists(pk=user_id) if user_id is not None else None
+    # only the latest token issued to the user is accepted
+    if user and user.access_token == access_token:
+        return user
+    return None
+
+
+class AccessTokenAuthentication(BaseAuthentication):
+    """
+    DRF authentication by `Authorization: Bearer` access token, held to the
+    rules of token_user, unlike simplejwt's JWTAuthentication which accepts
+    any unexpired token ever issued
+    """
+
+    def authenticate(self, request) -> tuple[User, str] | None:
+        auth_type, _, access_token = request.META.get(
+            'HTTP_AUTHORIZATION', ''
+        ).partition(' ')
+        if auth_type not in settings.SIMPLE_JWT['AUTH_HEADER_TYPES'] \
+                or not access_token.strip():
+            return None
+        user = token_user(access_token.strip())
+        if user and user.is_active:
+            return user, access_token.strip()
+        return None
+
+
+async def load_token_user(access_token: str) -> User | None:
+    """
+    User of a valid access token, active or not.
+
+    The signature is verified locally and the user comes from the cache,
+    only a cache miss or a token newer than the cached one hits the DB.
+    """
+    user_id = decode_access_token(access_token)
+    if user_id is None:
+        return None
+    user = user_cache.get(user_id)
+    if user is None or user.access_token != access_token:
+        user = await load_user(user_id)
+    if user and user.access_token == access_token:
+        return user
+    return None
+
+
+async def authenticate(access_token: str) -> User | None:
+    """
+    Active user of a valid access token, see load_token_user
+    """
+    user = await load_token_user(access_token)
+    if user and user.is_active:
+        return user
+    return None
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import os
+import re
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from typing import BinaryIO
+from typing import Iterator
+from django.conf import settings
+
+BLOB_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobStore:
+    """
+    Content-addressed files on the local disk, named by their sha256.
+
+    Uploading the same content twice keeps a single copy.
+    """
+
+    def __init__(self, root: Path, chunk_size: int = 64 * 1024):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def exists(self, digest: str) -> bool:
+        return bool(BLOB_DIGEST.match(digest)) and self.path(digest).is_file()
+
+    def size(self, digest: str) -> int:
+        return self.path(digest).stat().st_size
+
+    def write(self, stream: BinaryIO, max_size: int) -> tuple[str, bool]:
+        """
+        Copy `stream` into the store chunk by chunk, returns the digest
+        and whether the blob is new.
+        """
+        tmp_dir = self.root / 'tmp'
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        digest = sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while chunk := stream.read(self.chunk_size):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise BlobTooLarge(f'blob is over {max_size} bytes')
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            path = self.path(digest.hexdigest())
+            if path.exists():
+                return digest.hexdigest(), False
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+            return digest.hexdigest(), True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def read(self, digest: str, start: int = 0,
+             end: int | None = None) -> Iterator[bytes]:
+        """
+        Bytes `start` to `end` (inclusive) of a blob, chunk by chunk
+        """
+        with open(self.path(digest), 'rb') as blob:
+            blob.seek(start)
+            remaining = (end if end is not None else self.size(digest) - 1) \
+                - start + 1
+            while remaining > 0:
+                chunk = blob.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+blob_store = BlobStore(settings.BLOB_ROOT, settings.BLOB_CHUNK_SIZE)
@@ -4,43 +4,103 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat.settings')
 django.setup()
 import json
-from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .models import User
+from .models import Message
+from .routing_table import routing_table
+from .routing_table import user_group_name
+from .persistence import message_writer
+from .frames import select_codec
+from .events import validate_event
+from .auth import access_token_from_scope
+from .auth import authenticate
+from .receipts import ReceiptBatcher
+from .limits import RateLimiter
+from .outbound import OutboundQueue
+from .presence import presence
+from .presence import HEARTBEAT
+from .rooms import room_hub
+from .metrics import sync_to_async
+from .metrics import timed
+from .metrics import CHANNEL_LAYER_SECONDS
+from .metrics import OPEN_SOCKETS
+from .metrics import SOCKET_EVENTS
+from .metrics import SOCKET_EVENT_SECONDS
+from .metrics import SOCKET_RATE_LIMITED
+from .metrics import SLOW_CONSUMERS_EVICTED
+
+# "Try Again Later", sent to the sockets that cannot keep up
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# sent to the sockets whose heartbeats stopped, see main.presence
+HEARTBEAT_CLOSE_CODE = 4000
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = 'chat_%s' % self.room_name
+        self.fanout = settings.CHAT_ROOMS['FANOUT']
+        self.outbound = OutboundQueue(
+            self.forward, self.evict,
+            settings.SOCKET_LIMITS['OUTBOUND_QUEUE_SIZE'],
+            settings.SOCKET_LIMITS['SLOW_TIMEOUT']
+        )
 
         # join room group
+        if self.fanout == 'worker':
+            await self.accept()
+            OPEN_SOCKETS.inc(consumer='chat')
+            # once per worker, also replays the room's recent messages,
+            # see main.rooms
+            await room_hub.join(self.room_group_name, self)
+            return None
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
         await self.accept()
+        OPEN_SOCKETS.inc(consumer='chat')
 
     async def disconnect(self, code):
+        OPEN_SOCKETS.dec(consumer='chat')
+        self.outbound.close()
         # leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        if self.fanout == 'worker':
+            await room_hub.leave(self.room_group_name, self)
+        else:
+            await self.channel_layer.group_discard(
+                self.room_group_name,
+                self.channel_name
+            )
 
     async def receive(self, text_data=None, bytes_data=None):
         # Receive message from WebSocket
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message
-            }
-        )
+        try:
+            text_data_json = json.loads(text_data)
+        except (ValueError, TypeError):
+            text_data_json = None
+        if not isinstance(text_data_json, dict) \
+                or 'message' not in text_data_json:
+            # dropped, raising would skip disconnect() and leave the socket
+            # in the room, see main.rooms
+            SOCKET_EVENTS.inc(consumer='chat', type='invalid')
+            return None
+        SOCKET_EVENTS.inc(consumer='chat', type='chat_message')
+        with timed(SOCKET_EVENT_SECONDS, consumer='chat',
+                   type='chat_message'):
+            message = text_data_json['message']
+            # Send message to room group
+            with timed(CHANNEL_LAYER_SECONDS, operation='group_send'):
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'chat_message',
+                        'room': self.room_group_name,
+                        'message': message
+                    }
+                )
 
     async def chat_message(self, event):
         # Receive message from room group
@@ -51,295 +111,208 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': message
         }))
 
+    async def evict(self, reason):
+        SLOW_CONSUMERS_EVICTED.inc(reason=reason)
+        await self.close(SLOW_CONSUMER_CLOSE_CODE)
+
+    async def forward(self, text):
+        await self.send(text_data=text)
+
 
 class UserAuthorizationConsumer(AsyncWebsocketConsumer):
-    @sync_to_async
-    def authorize(self, access_token, channel_name):
-        user = User.exists(access_token=access_token)
-        if user:
-            user.channel_name = channel_name
-            user.save()
-            return user
-        return None
+    async def get_user_group_name(self, country_code, phone_number):
+        user_id = await routing_table.get(country_code, phone_number)
+        if user_id is None:
+            return None
+        return user_group_name(user_id)
 
     @sync_to_async
-    def get_user_channel_name(self, country_code, phone_number):
-        return User.exists(country_code=country_code,
-                           phone_number=phone_number).channel_name
+    def pull_undelivered(self, cursor):
+        messages = Message.pull_undelivered(
+            self.user, cursor, settings.MESSAGE_SYNC_PAGE_SIZE
+        )
+        if messages:
+            cursor = messages[-1].id
+        return [message.to_event() for message in messages], cursor
+
+    async def send_undelivered(self):
+        # replay what this user has not acknowledged yet, oldest first, on
+        # every connect until their `message_delivered` receipts come in,
+        # messages to them may still be buffered in this worker
+        if message_writer.is_pending_for(self.user.country_code,
+                                         self.user.phone_number):
+            await message_writer.flush()
+        cursor = 0
+        while True:
+            events, cursor = await self.pull_undelivered(cursor)
+            for event in events:
+                await self.send_event(event)
+            if len(events) < settings.MESSAGE_SYNC_PAGE_SIZE:
+                break
+
+    async def send_event(self, event):
+        await self.send(**self.codec.encode(event))
+
+    async def send_to_group(self, group_name, event):
+        # reaches every connected device of the user, if any
+        if group_name:
+            with timed(CHANNEL_LAYER_SECONDS, operation='group_send'):
+                await self.channel_layer.group_send(group_name, event)
 
     @sync_to_async
-    def delete_socket_session(self, user: User):
-        user.channel_name = ''
-        user.save()
+    def mark_receipts(self, sender_id, batch):
+        return Message.mark_receipts(
+            self.user, sender_id, batch['hashes'], batch['until'],
+            read=batch['type'] == 'message_read'
+        )
+
+    async def send_receipts(self, batch):
+        # one UPDATE and one event for a whole batch, see main.receipts
+        receiver_id = await routing_table.get(
+            batch['receiver_country_code'], batch['receiver_phone_number']
+        )
+        if receiver_id is None:
+            return None
+        # the acknowledged messages may still be buffered in this worker
+        if message_writer.is_pending([*batch['hashes'],
+                                      *filter(None, [batch['until']])]):
+            await message_writer.flush()
+        await self.mark_receipts(receiver_id, batch)
+        if batch['until'] is None:
+            del batch['until']
+        await self.send_to_group(user_group_name(receiver_id), {
+            'type': 'relay',
+            'text': json.dumps(batch),
+            # lets a backed up receiver merge it, see main.outbound
+            'receipt': f"{batch['type']}:{batch['sender_country_code']}"
+                       f"{batch['sender_phone_number']}",
+        })
 
     async def connect(self):
-        self.access_token = self.scope['url_route']['kwargs']['access_token']
-        user = await self.authorize(self.access_token, self.channel_name)
+        self.user = None
+        self.receipts = ReceiptBatcher(self.send_receipts,
+                                       settings.RECEIPT_WINDOW)
+        self.codec = select_codec(self.scope.get('subprotocols', []))
+        self.limiter = RateLimiter(settings.SOCKET_LIMITS['RATE'],
+                                   settings.SOCKET_LIMITS['EVENT_RATES'])
+        self.outbound = OutboundQueue(
+            self.forward, self.evict,
+            settings.SOCKET_LIMITS['OUTBOUND_QUEUE_SIZE'],
+            settings.SOCKET_LIMITS['SLOW_TIMEOUT']
+        )
+        self.access_token = access_token_from_scope(self.scope)
+        user = await authenticate(self.access_token) \
+            if self.access_token else None
         if user:
-            self.connect_users_group = 'connected_users'
             self.user = user
-            await self.accept()
+            self.user_group_name = user_group_name(user.pk)
+            await self.channel_layer.group_add(
+                self.user_group_name,
+                self.channel_name
+            )
+            await routing_table.add(user, self.channel_name)
+            presence.connect(user, self.channel_name)
+            await self.accept(self.codec.subprotocol)
+            OPEN_SOCKETS.inc(consumer='user')
+            await self.send_undelivered()
+            contacts = await presence.contacts(user)
+            if contacts:
+                await self.send_event({'type': 'presence',
+                                       'users': contacts})
         else:
             await self.close(None)
 
     async def disconnect(self, code):
+        if self.user:
+            self.outbound.close()
+            await self.receipts.close()
+            OPEN_SOCKETS.dec(consumer='user')
+            await routing_table.remove(self.user, self.channel_name)
+            presence.disconnect(self.user, self.channel_name)
+            await self.channel_layer.group_discard(
+                self.user_group_name,
+                self.channel_name
+            )
         await self.close(code)
-        # await  self.delete_socket_session(self.user)
+
+    async def evict(self, reason):
+        SLOW_CONSUMERS_EVICTED.inc(reason=reason)
+        await self.close(SLOW_CONSUMER_CLOSE_CODE)
 
     async def receive(self, text_data=None, bytes_data=None):
         # Receive message from WebSocket
-        text_data_json = json.loads(text_data)
-        type = text_data_json['type']
-
-        sender_country_code = text_data_json['sender_country_code']
-        sender_phone_number = text_data_json['sender_phone_number']
-        receiver_country_code = text_data_json['receiver_country_code']
-        receiver_phone_number = text_data_json['receiver_phone_number']
-
-        if type == 'private_message':
-            message = text_data_json['message']
-            hash = text_data_json['hash']
-            timestamp = text_data_json['timestamp']
-            sender_channel_name = await self.get_user_channel_name(
-                sender_country_code, sender_phone_number
-            )
-            receiver_channel_name = await self.get_user_channel_name(
-                receiver_country_code, receiver_phone_number
-            )
-            await self.channel_layer.send(
-                sender_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'message': message,
-                    'hash': hash,
-                    'timestamp': timestamp,
-                }
-            )
-
-            await self.channel_layer.send(
-                receiver_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'message': message,
-                    'hash': hash,
-                    'timestamp': timestamp,
-                }
-            )
-        elif type == 'delete_private_message':
-            hash = text_data_json['hash']
-            sender_channel_name = await self.get_user_channel_name(
-                sender_country_code, sender_phone_number
-            )
-            receiver_channel_name = await self.get_user_channel_name(
-                receiver_country_code, receiver_phone_number
-            )
-            await self.channel_layer.send(
-                sender_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'hash': hash,
-                }
-            )
-
-            await self.channel_layer.send(
-                receiver_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'hash': hash,
-                }
-            )
-
-        elif type == 'message_delivered':
-            hash = text_data_json['hash']
-
-            receiver_channel_name = await self.get_user_channel_name(
-                receiver_country_code, receiver_phone_number
-            )
-
-            await self.channel_layer.send(
-                receiver_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'hash': hash,
-                }
-            )
-
-        elif type == 'message_read':
-            hash = text_data_json['hash']
-
-            receiver_channel_name = await self.get_user_channel_name(
-                receiver_country_code, receiver_phone_number
-            )
-
-            await self.channel_layer.send(
-                receiver_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'hash': hash,
-                }
-            )
-
-        elif type == 'image_message':
-            image = text_data_json['image']
-            timestamp = text_data_json['timestamp']
-            hash = text_data_json['hash']
-            sender_channel_name = await self.get_user_channel_name(
-                sender_country_code, sender_phone_number
-            )
-            receiver_channel_name = await self.get_user_channel_name(
-                receiver_country_code, receiver_phone_number
-            )
-            await self.channel_layer.send(
-                sender_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'image': image,
-                    'timestamp': timestamp,
-                    'hash': hash,
-                }
-            )
-
-            await self.channel_layer.send(
-                receiver_channel_name,
-                {
-                    'type': type,
-                    'sender_country_code': sender_country_code,
-                    'sender_phone_number': sender_phone_number,
-                    'receiver_country_code': receiver_country_code,
-                    'receiver_phone_number': receiver_phone_number,
-                    'image': image,
-                    'timestamp': timestamp,
-                    'hash': hash,
-                }
-            )
-
-    async def private_message(self, event):
-        # Receive message from room group
-        type = event['type']
-        sender_country_code = event['sender_country_code']
-        sender_phone_number = event['sender_phone_number']
-        receiver_country_code = event['receiver_country_code']
-        receiver_phone_number = event['receiver_phone_number']
-        message = event['message']
-        hash = event['hash']
-        timestamp = event['timestamp']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': type,
-            'sender_country_code': sender_country_code,
-            'sender_phone_number': sender_phone_number,
-            'receiver_country_code': receiver_country_code,
-            'receiver_phone_number': receiver_phone_number,
-            'message': message,
-            'hash': hash,
-            'timestamp': timestamp,
-        }))
-
-    async def delete_private_message(self, event):
-        # Receive message from room group
-        type = event['type']
-        sender_country_code = event['sender_country_code']
-        sender_phone_number = event['sender_phone_number']
-        receiver_country_code = event['receiver_country_code']
-        receiver_phone_number = event['receiver_phone_number']
-        hash = event['hash']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': type,
-            'sender_country_code': sender_country_code,
-            'sender_phone_number': sender_phone_number,
-            'receiver_country_code': receiver_country_code,
-            'receiver_phone_number': receiver_phone_number,
-            'hash': hash,
-        }))
-
-    async def message_delivered(self, event):
-        # Receive message from room group
-        type = event['type']
-        sender_country_code = event['sender_country_code']
-        sender_phone_number = event['sender_phone_number']
-        receiver_country_code = event['receiver_country_code']
-        receiver_phone_number = event['receiver_phone_number']
-        hash = event['hash']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': type,
-            'sender_country_code': sender_country_code,
-            'sender_phone_number': sender_phone_number,
-            'receiver_country_code': receiver_country_code,
-            'receiver_phone_number': receiver_phone_number,
-            'hash': hash,
-        }))
-
-    async def message_read(self, event):
-        # Receive message from room group
-        type = event['type']
-        sender_country_code = event['sender_country_code']
-        sender_phone_number = event['sender_phone_number']
-        receiver_country_code = event['receiver_country_code']
-        receiver_phone_number = event['receiver_phone_number']
-        hash = event['hash']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': type,
-            'sender_country_code': sender_country_code,
-            'sender_phone_number': sender_phone_number,
-            'receiver_country_code': receiver_country_code,
-            'receiver_phone_number': receiver_phone_number,
-            'hash': hash,
-        }))
-
-    async def image_message(self, event):
-        # Receive message from room group
-        type = event['type']
-        sender_country_code = event['sender_country_code']
-        sender_phone_number = event['sender_phone_number']
-        receiver_country_code = event['receiver_country_code']
-        receiver_phone_number = event['receiver_phone_number']
-        image = event['image']
-        timestamp = event['timestamp']
-        hash = event['hash']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': type,
-            'sender_country_code': sender_country_code,
-            'sender_phone_number': sender_phone_number,
-            'receiver_country_code': receiver_country_code,
-            'receiver_phone_number': receiver_phone_number,
-            'image': image,
-            'timestamp': timestamp,
-            'hash': hash,
-        }))
+        if not self.limiter.allow_frame():
+            SOCKET_RATE_LIMITED.inc(consumer='user', limit='frames')
+            return None
+        # a frame that fails to decode or validate is dropped, raising here
+        # would skip disconnect() and leak the socket's routes and presence
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except (ValueError, TypeError):
+            data = None
+        if isinstance(data, dict) and data.get('type') == HEARTBEAT:
+            SOCKET_EVENTS.inc(consumer='user', type=HEARTBEAT)
+            presence.heartbeat(self.channel_name, explicit=True)
+            return None
+        try:
+            validated = validate_event(data)
+        except (ValueError, TypeError):
+            validated = None
+        if validated is None:
+            # unknown type or missing fields, drop the frame
+            SOCKET_EVENTS.inc(consumer='user', type='invalid')
+            return None
+        spec, frame = validated
+        # sent as this socket's user, whatever the frame claims
+        frame['sender_country_code'] = self.user.country_code
+        frame['sender_phone_number'] = self.user.phone_number
+        if not self.limiter.allow_event(frame['type']):
+            SOCKET_RATE_LIMITED.inc(consumer='user', limit=frame['type'])
+            return None
+        SOCKET_EVENTS.inc(consumer='user', type=frame['type'])
+        presence.heartbeat(self.channel_name)
+        with timed(SOCKET_EVENT_SECONDS, consumer='user', type=frame['type']):
+            await self.relay_event(spec, frame)
+
+    async def relay_event(self, spec, frame):
+        if spec.coalesce:
+            await self.receipts.add(frame)
+            return None
+        receiver_group_name = await self.get_user_group_name(
+            frame['receiver_country_code'], frame['receiver_phone_number']
+        )
+        # encoded once and forwarded as is to every device
+        event = {'type': 'relay', 'text': json.dumps(frame)}
+        if spec.echo:
+            await self.send_to_group(self.user_group_name, event)
+        await self.send_to_group(receiver_group_name, event)
+
+        if frame['type'] == 'private_message':
+            # persisted in the background, see main.persistence
+            await message_writer.put({
+                'sender_id': self.user.pk,
+                'receiver_country_code': frame['receiver_country_code'],
+                'receiver_phone_number': frame['receiver_phone_number'],
+                'message': frame['message'],
+                'hash': frame['hash'],
+                'timestamp': frame['timestamp'],
+                'creation_date': timezone.now(),
+            })
+        elif frame['type'] == 'delete_private_message':
+            await message_writer.put({
+                'delete': True,
+                'sender_id': self.user.pk,
+                'receiver_country_code': frame['receiver_country_code'],
+                'receiver_phone_number': frame['receiver_phone_number'],
+                'hash': frame['hash'],
+            })
+
+    async def relay(self, event):
+        # Receive a frame from another socket, see receive()
+        await self.outbound.put(event['text'], event.get('receipt'))
+
+    async def heartbeat_timeout(self, event):
+        await self.close(HEARTBEAT_CLOSE_CODE)
+
+    async def forward(self, text):
+        await self.send(**self.codec.forward(text))
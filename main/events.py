@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import re
+from typing import Callable
+from typing import NamedTuple
+from .blobs import BLOB_DIGEST
+
+# every user socket event names both sides of the conversation
+ADDRESS_FIELDS = (
+    'sender_country_code',
+    'sender_phone_number',
+    'receiver_country_code',
+    'receiver_phone_number',
+)
+
+
+# receipts acknowledge at most this many hashes per frame
+MAX_RECEIPT_HASHES = 500
+
+# the lengths of Message.content and Message.timestamp
+MAX_MESSAGE_LENGTH = 250
+MAX_TIMESTAMP_LENGTH = 32
+
+
+def is_blob_digest(value: object) -> bool:
+    return isinstance(value, str) and bool(BLOB_DIGEST.match(value))
+
+
+def is_hash(value: object) -> bool:
+    return isinstance(value, str) and 0 < len(value) <= 128
+
+
+def is_message(value: object) -> bool:
+    return isinstance(value, str) and len(value) <= MAX_MESSAGE_LENGTH
+
+
+def is_timestamp(value: object) -> bool:
+    return isinstance(value, str) and 0 < len(value) <= MAX_TIMESTAMP_LENGTH
+
+
+def is_hash_list(value: object) -> bool:
+    return isinstance(value, list) \
+        and 0 < len(value) <= MAX_RECEIPT_HASHES \
+        and all(is_hash(item) for item in value)
+
+
+class EventSpec(NamedTuple):
+    # fields required on top of the type and ADDRESS_FIELDS
+    fields: tuple[str, ...]
+    # also deliver the event to the sender's other devices
+    echo: bool
+    # checks of the fields that are present
+    validators: dict[str, Callable[[object], bool]] = {}
+    # at least one of these fields is required
+    any_of: tuple[str, ...] = ()
+    # held back and sent in batches, see main.receipts
+    coalesce: bool = False
+
+
+EVENTS: dict[str, EventSpec] = {
+    'private_message': EventSpec(
+        fields=('message', 'hash', 'timestamp'),
+        echo=True,
+        validators={'message': is_message, 'hash': is_hash,
+                    'timestamp': is_timestamp},
+    ),
+    'delete_private_message': EventSpec(
+        fields=('hash',),
+        echo=True,
+        validators={'hash': is_hash},
+    ),
+    # receipts name single messages with `hash` or `hashes`, and/or
+    # every message up to and including the one named by `until`
+    'message_delivered': EventSpec(
+        fields=(),
+        echo=False,
+        validators={'hash': is_hash, 'hashes': is_hash_list,
+                    'until': is_hash},
+        any_of=('hash', 'hashes', 'until'),
+        coalesce=True,
+    ),
+    'message_read': EventSpec(
+        fields=(),
+        echo=False,
+        validators={'hash': is_hash, 'hashes': is_hash_list,
+                    'until': is_hash},
+        any_of=('hash', 'hashes', 'until'),
+        coalesce=True,
+    ),
+    'image_message': EventSpec(
+        # the image itself is uploaded to /blobs/ beforehand
+        fields=('blob', 'timestamp', 'hash'),
+        echo=True,
+        validators={'blob': is_blob_digest, 'hash': is_hash,
+                    'timestamp': is_timestamp},
+    ),
+}
+
+PHONE_FIELD = re.compile(r'^\+?[0-9]{1,20}$')
+
+
+def validate_event(data: object) -> tuple[EventSpec, dict] | None:
+    """
+    The spec and the outgoing frame of a decoded socket event,
+    None if the event is unknown or malformed
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('type'), str):
+        return None
+    spec = EVENTS.get(data['type'])
+    if spec is None:
+        return None
+    frame = {'type': data['type']}
+    for field in ADDRESS_FIELDS:
+        value = data.get(field)
+        if not isinstance(value, str) or not PHONE_FIELD.match(value):
+            return None
+        frame[field] = value
+    for field in spec.fields:
+        if field not in data:
+            return None
+        frame[field] = data[field]
+    if spec.any_of:
+        for field in spec.any_of:
+            if field in data:
+                frame[field] = data[field]
+        if frame.keys().isdisjoint(spec.any_of):
+            return None
+    for field, validator in spec.validators.items():
+        if field in frame and not validator(frame[field]):
+            return None
+    return spec, frame
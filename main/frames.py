@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import json
+import msgpack
+
+JSON_SUBPROTOCOL = 'chat.json.v1'
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+
+# short keys used on the wire by the MessagePack subprotocol
+FIELD_TAGS = {
+    'type': 't',
+    'sender_country_code': 'sc',
+    'sender_phone_number': 'sp',
+    'receiver_country_code': 'rc',
+    'receiver_phone_number': 'rp',
+    'message': 'm',
+    'hash': 'h',
+    'timestamp': 'ts',
+    'blob': 'b',
+}
+FIELD_NAMES = {tag: name for name, tag in FIELD_TAGS.items()}
+
+
+class JSONCodec:
+    """
+    Default text frames, one JSON object per frame
+    """
+
+    def __init__(self, subprotocol: str | None = None):
+        # clients that offer any subprotocol need one selected
+        self.subprotocol = subprotocol
+
+    def decode(self, text_data: str | None, bytes_data: bytes | None) -> dict:
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def encode(self, event: dict) -> dict:
+        return {'text_data': json.dumps(event)}
+
+    def forward(self, text: str) -> dict:
+        # relayed frames already are JSON text
+        return {'text_data': text}
+
+
+class MsgPackCodec:
+    """
+    Binary frames, one MessagePack map per frame with tagged keys
+    """
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def decode(self, text_data: str | None, bytes_data: bytes | None) -> dict:
+        if bytes_data is None:
+            # clients may still fall back to a JSON text frame
+            return json.loads(text_data)
+        data = msgpack.unpackb(bytes_data, raw=False)
+        if not isinstance(data, dict):
+            raise ValueError('frame must be a map')
+        return {FIELD_NAMES.get(key, key): value
+                for key, value in data.items()}
+
+    def encode(self, event: dict) -> dict:
+        return {'bytes_data': msgpack.packb(
+            {FIELD_TAGS.get(key, key): value for key, value in event.items()},
+            use_bin_type=True
+        )}
+
+    def forward(self, text: str) -> dict:
+        return self.encode(json.loads(text))
+
+
+json_codec = JSONCodec()
+json_subprotocol_codec = JSONCodec(JSON_SUBPROTOCOL)
+msgpack_codec = MsgPackCodec()
+
+
+def select_codec(subprotocols: list[str]) -> JSONCodec | MsgPackCodec:
+    """
+    Codec for the subprotocols offered in the WebSocket handshake
+    """
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return msgpack_codec
+    if JSON_SUBPROTOCOL in subprotocols:
+        return json_subprotocol_codec
+    return json_codec
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import zlib
+import msgpack
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+from .metrics import CHANNEL_LAYER_MESSAGES
+from .metrics import CHANNEL_LAYER_MESSAGE_BYTES
+
+# starts the zlib compressed payloads, a packed message is a map and never
+# starts with it
+COMPRESSED = b'\x00'
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that skips Redis for the channels of this process.
+
+    Channels made by `new_channel` get an in-process queue, so a `send`
+    from a socket to another socket of the same worker is a queue put. A
+    `group_send` still reads the members from Redis, then hands the message
+    to the local members directly and sends it to the others through Redis
+    as usual.
+
+    Messages that go through Redis and pack to more than
+    `compression_threshold` bytes are stored zlib compressed, None
+    disables it. Takes the CONFIG of RedisChannelLayer on top of that.
+    """
+
+    def __init__(self, *args, compression_threshold: int | None = 1024,
+                 compression_level: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        # channel name -> queue, for the channels made by this process
+        self.local: dict[str, asyncio.Queue] = {}
+        # pending Redis receive of each local channel, kept across calls
+        self.remote: dict[str, asyncio.Task] = {}
+        self.local_loop: asyncio.AbstractEventLoop | None = None
+
+    async def new_channel(self, prefix: str = 'specific') -> str:
+        channel = await super().new_channel(prefix)
+        self.local_loop = asyncio.get_running_loop()
+        self.local[channel] = asyncio.Queue(self.get_capacity(channel))
+        return channel
+
+    def is_closed(self, channel: str) -> bool:
+        # made by this process but gone, nothing will ever receive it
+        return '!' in channel and channel not in self.local \
+            and self.non_local_name(channel).endswith(
+                self.client_prefix + '!'
+            )
+
+    def local_queue(self, channel: str) -> asyncio.Queue | None:
+        queue = self.local.get(channel)
+        if queue is None \
+                or self.local_loop is not asyncio.get_running_loop():
+            # e.g. async_to_sync from another thread, Redis is thread safe
+            return None
+        return queue
+
+    async def send(self, channel: str, message: dict) -> None:
+        queue = self.local_queue(channel)
+        if queue is None:
+            if self.is_closed(channel):
+                CHANNEL_LAYER_MESSAGES.inc(operation='send',
+                                           delivery='closed')
+                return None
+            CHANNEL_LAYER_MESSAGES.inc(operation='send', delivery='remote')
+            return await super().send(channel, message)
+        assert isinstance(message, dict), 'message is not a dict'
+        try:
+            # a copy, like a message that went through Redis
+            queue.put_nowait(dict(message))
+        except asyncio.QueueFull:
+            raise ChannelFull()
+        CHANNEL_LAYER_MESSAGES.inc(operation='send', delivery='local')
+        return None
+
+    async def receive(self, channel: str) -> dict:
+        queue = self.local.get(channel)
+        if queue is None:
+            return await super().receive(channel)
+        if not queue.empty():
+            return queue.get_nowait()
+        remote = self.remote.get(channel)
+        if remote is None:
+            remote = self.remote[channel] = asyncio.ensure_future(
+                super().receive(channel)
+            )
+        local = asyncio.ensure_future(queue.get())
+        try:
+            await asyncio.wait((local, remote),
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # the consumer is gone, so is its channel
+            local.cancel()
+            self.close(channel)
+            raise
+        if local.done():
+            return local.result()
+        local.cancel()
+        del self.remote[channel]
+        return remote.result()
+
+    def close(self, channel: str) -> None:
+        self.local.pop(channel, None)
+        remote = self.remote.pop(channel, None)
+        if remote is not None:
+            remote.cancel()
+        return None
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # called by group_send with the members of the group, the ones of
+        # this process are delivered here and left out of the Redis sends
+        remote = []
+        for channel in channel_names:
+            queue = self.local_queue(channel)
+            if queue is not None:
+                try:
+                    queue.put_nowait(dict(message))
+                except asyncio.QueueFull:
+                    # like Redis, a full channel misses group messages
+                    delivery = 'full'
+                else:
+                    delivery = 'local'
+            elif self.is_closed(channel):
+                delivery = 'closed'
+            else:
+                remote.append(channel)
+                delivery = 'remote'
+            CHANNEL_LAYER_MESSAGES.inc(operation='group_send',
+                                       delivery=delivery)
+        return super()._map_channel_keys_to_connection(remote, message)
+
+    def serialize(self, message: dict) -> bytes:
+        value = msgpack.packb(message, use_bin_type=True)
+        CHANNEL_LAYER_MESSAGE_BYTES.observe(len(value), stage='packed')
+        if self.compression_threshold is not None \
+                and len(value) > self.compression_threshold:
+            value = COMPRESSED + zlib.compress(value, self.compression_level)
+        if self.crypter:
+            value = self.crypter.encrypt(value)
+        CHANNEL_LAYER_MESSAGE_BYTES.observe(len(value), stage='stored')
+        # unique members of the sorted set, like RedisChannelLayer
+        return random.getrandbits(8 * 12).to_bytes(12, 'big') + value
+
+    def deserialize(self, message: bytes) -> dict:
+        message = message[12:]
+        if self.crypter:
+            message = self.crypter.decrypt(message, self.expiry + 10)
+        if message[:1] == COMPRESSED:
+            message = zlib.decompress(message[1:])
+        return msgpack.unpackb(message, raw=False)
+
+    async def flush(self) -> None:
+        for queue in self.local.values():
+            while not queue.empty():
+                queue.get_nowait()
+        await super().flush()
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second on average and bursts of up to
+    `burst` operations
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    Token buckets of one socket: one for every received frame and one per
+    limited event type, each given as (frames per second, burst)
+    """
+
+    def __init__(self, rate: tuple[float, float],
+                 event_rates: dict[str, tuple[float, float]]):
+        self.frames = TokenBucket(*rate)
+        self.events = {type: TokenBucket(*limit)
+                       for type, limit in event_rates.items()}
+
+    def allow_frame(self) -> bool:
+        return self.frames.take()
+
+    def allow_event(self, type: str) -> bool:
+        bucket = self.events.get(type)
+        return bucket is None or bucket.take()
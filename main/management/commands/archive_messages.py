@@ -0,0 +1,46 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from main.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Moves old messages to the archive and purges deleted ones, ' \
+           'see main.archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age-days', type=int,
+                            default=settings.MESSAGE_ARCHIVE['AGE_DAYS'],
+                            help='archive delivered messages older than '
+                                 'this')
+        parser.add_argument('--no-purge', action='store_true',
+                            help='keep the soft-deleted messages')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['age_days'])
+        archived = 0
+        for shard in settings.MESSAGE_SHARDS:
+            while True:
+                moved = Message.archive(
+                    before, settings.MESSAGE_ARCHIVE['BATCH_SIZE'], shard
+                )
+                if not moved:
+                    break
+                archived += moved
+        self.stdout.write(f'archived {archived} messages')
+        if options['no_purge']:
+            return None
+        purged = 0
+        for shard in settings.MESSAGE_SHARDS:
+            cursor = 0
+            while True:
+                removed, cursor = Message.purge_deleted(
+                    cursor, settings.MESSAGE_ARCHIVE['PURGE_BATCH_SIZE'],
+                    shard
+                )
+                if not removed:
+                    break
+                purged += removed
+        self.stdout.write(f'purged {purged} deleted messages')
+        return None
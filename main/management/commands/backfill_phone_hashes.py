@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from main.models import User
+
+
+class Command(BaseCommand):
+    help = 'Sets User.phone_hash of the users saved before the field ' \
+           'existed, or whose number was changed by an update(). Hashed ' \
+           'contact checks cannot find them until it has run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='users read, and at most updated, per '
+                                 'query')
+
+    def handle(self, *args, **options):
+        updated = self.backfill(options['batch_size'])
+        self.stdout.write(f'updated {updated} phone hashes')
+        return None
+
+    @staticmethod
+    def backfill(batch_size: int) -> int:
+        updated, cursor = 0, 0
+        while True:
+            users = list(User.objects.filter(id__gt=cursor).order_by('id')
+                         .only('id', 'country_code', 'phone_number',
+                               'phone_hash')[:batch_size])
+            if not users:
+                return updated
+            cursor = users[-1].id
+            stale = []
+            for user in users:
+                phone_hash = User.hash_phone_number(user.country_code,
+                                                    user.phone_number)
+                if user.phone_hash != phone_hash:
+                    user.phone_hash = phone_hash
+                    stale.append(user)
+            # save() would rehash too, but one query per user
+            User.objects.bulk_update(stale, ['phone_hash'])
+            updated += len(stale)
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db import transaction
+from main.models import Message
+from main.shards import shard_for
+
+
+class Command(BaseCommand):
+    help = 'Moves messages to the shard of their conversation after ' \
+           'MESSAGE_SHARDS changed, see main.shards. Run `migrate ' \
+           '--database=<alias>` for the new shards first. Until it is ' \
+           'done, the history of a moving conversation can miss messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='messages read, and at most moved, per '
+                                 'transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count the messages to move')
+
+    def handle(self, *args, **options):
+        # every database with messages, also the ones left out of
+        # MESSAGE_SHARDS to be emptied
+        for alias in settings.DATABASES:
+            if 'message' not in connections[alias].introspection \
+                    .table_names():
+                continue
+            moved = self.rebalance(alias, options['batch_size'],
+                                   options['dry_run'])
+            verb = 'would move' if options['dry_run'] else 'moved'
+            self.stdout.write(f'{alias}: {verb} {moved} messages')
+        return None
+
+    @staticmethod
+    def rebalance(alias: str, batch_size: int, dry_run: bool) -> int:
+        moved, cursor = 0, 0
+        while True:
+            messages = list(Message.objects.using(alias).filter(
+                id__gt=cursor
+            ).order_by('id')[:batch_size])
+            if not messages:
+                return moved
+            cursor = messages[-1].id
+            # shard -> its messages found here
+            misplaced: dict[str, list[Message]] = {}
+            for message in messages:
+                shard = shard_for(message.conversation)
+                if shard != alias:
+                    misplaced.setdefault(shard, []).append(message)
+            for shard, shard_messages in misplaced.items():
+                moved += len(shard_messages)
+                if dry_run:
+                    continue
+                ids = [message.id for message in shard_messages]
+                # copied first, a crash in between leaves a copy in both,
+                # which the next run removes
+                with transaction.atomic(using=shard):
+                    copied = set(Message.objects.using(shard).filter(
+                        id__in=ids
+                    ).values_list('id', flat=True))
+                    new = [message for message in shard_messages
+                           if message.id not in copied]
+                    Message.objects.using(shard).bulk_create(new)
+                    Message.index(new, shard)
+                with transaction.atomic(using=alias):
+                    Message.objects.using(alias).filter(id__in=ids).delete()
+                    Message.index(shard_messages, alias, delete=True)
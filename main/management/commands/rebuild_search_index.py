@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from main.search import SEARCH_TABLE
+from main.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Indexes every message again for search, after writes to the ' \
+           '`message` table from outside Django, see main.search. Other ' \
+           'writes to a database wait until its index is rebuilt.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append',
+                            help='only this database, can be repeated')
+
+    def handle(self, *args, **options):
+        for alias in options['database'] or settings.DATABASES:
+            if SEARCH_TABLE not in connections[alias].introspection \
+                    .table_names():
+                continue
+            indexed = rebuild_index(alias)
+            self.stdout.write(f'{alias}: indexed {indexed} messages')
+        return None
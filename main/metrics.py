@@ -0,0 +1,364 @@
+"""
+In-process metrics, exposed in the Prometheus text format at /metrics/.
+
+Every worker process keeps its own values, label the scrape target per
+worker when running more than one.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import hmac
+import ipaddress
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from bisect import bisect_left
+from asgiref.sync import sync_to_async as asgiref_sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+registry: list[Metric] = []
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: dict[tuple[str, ...], object] = {}
+        registry.append(self)
+
+    def key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key: tuple[str, ...], **extra) -> str:
+        pairs = [*zip(self.labels, key), *extra.items()]
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            f'{label}="{value}"' for label, value in pairs
+        ) + '}'
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f'{self.name}{self.format_labels(key)} {value}'
+                    for key, value in self.values.items()]
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}',
+                          f'# TYPE {self.name} {self.type}',
+                          *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) \
+                    + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.values.items():
+                total = 0
+                for bound, count in zip((*self.buckets, '+Inf'), counts):
+                    total += count
+                    lines.append(f'{self.name}_bucket'
+                                 f'{self.format_labels(key, le=bound)} '
+                                 f'{total}')
+                lines.append(f'{self.name}_sum{self.format_labels(key)} '
+                             f'{counts[-1]}')
+                lines.append(f'{self.name}_count{self.format_labels(key)} '
+                             f'{total}')
+        return lines
+
+
+SOCKET_EVENTS = Counter(
+    'chat_socket_events_total',
+    'WebSocket frames received, by consumer and event type',
+    ('consumer', 'type'),
+)
+SOCKET_EVENT_SECONDS = Histogram(
+    'chat_socket_event_seconds',
+    'Time spent handling a received WebSocket frame',
+    ('consumer', 'type'),
+)
+OPEN_SOCKETS = Gauge(
+    'chat_open_sockets',
+    'Accepted WebSocket connections',
+    ('consumer',),
+)
+CHANNEL_LAYER_SECONDS = Histogram(
+    'chat_channel_layer_seconds',
+    'Time spent waiting on channel layer calls',
+    ('operation',),
+)
+CHANNEL_LAYER_MESSAGES = Counter(
+    'chat_channel_layer_messages_total',
+    'Messages sent through main.layers.HybridChannelLayer, by operation '
+    'and delivery: `local` to a channel of this worker, `remote` through '
+    'Redis, `full` or `closed` when dropped',
+    ('operation', 'delivery'),
+)
+CHANNEL_LAYER_MESSAGE_BYTES = Histogram(
+    'chat_channel_layer_message_bytes',
+    'Size of the messages written to Redis by the hybrid channel layer, '
+    '`packed` before compression and `stored` as written',
+    ('stage',),
+    SIZE_BUCKETS,
+)
+THREAD_QUEUE_SECONDS = Histogram(
+    'chat_sync_to_async_queue_seconds',
+    'Time a sync_to_async call waited for a worker thread',
+    ('function',),
+)
+SYNC_CALL_QUERIES = Histogram(
+    'chat_sync_to_async_db_queries',
+    'Database queries made by one sync_to_async call',
+    ('function',),
+    COUNT_BUCKETS,
+)
+SOCKET_RATE_LIMITED = Counter(
+    'chat_socket_rate_limited_total',
+    'Received WebSocket frames dropped by a rate limit, by consumer and '
+    'limit, either `frames` or the event type',
+    ('consumer', 'limit'),
+)
+OUTBOUND_FRAMES = Counter(
+    'chat_outbound_frames_total',
+    'Frames handed to the outbound queues, by outcome',
+    ('outcome',),
+)
+OUTBOUND_QUEUED = Gauge(
+    'chat_outbound_queued_frames',
+    'Frames waiting in the outbound queues',
+)
+SLOW_CONSUMERS_EVICTED = Counter(
+    'chat_slow_consumers_evicted_total',
+    'Sockets closed for falling behind their outbound queue, by reason',
+    ('reason',),
+)
+ROOM_DELIVERIES = Counter(
+    'chat_room_deliveries_total',
+    'Room messages handed to local sockets by the per-worker fan-out',
+)
+HTTP_REQUESTS = Counter(
+    'chat_http_requests_total',
+    'HTTP requests, by view, method and status code',
+    ('view', 'method', 'status'),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'chat_http_request_seconds',
+    'Time spent handling an HTTP request',
+    ('view',),
+)
+HTTP_REQUEST_QUERIES = Histogram(
+    'chat_http_request_db_queries',
+    'Database queries made by one HTTP request',
+    ('view',),
+    COUNT_BUCKETS,
+)
+
+
+class QueryCounter:
+    """
+    Queries counted by count_query while it is the value of a context
+    variable below
+    """
+
+    def __init__(self):
+        self.count = 0
+
+
+# queries of the HTTP request being handled, whichever thread runs them
+request_queries: ContextVar[QueryCounter | None] = ContextVar(
+    'request_queries', default=None
+)
+# queries of the sync_to_async call being run, on any database
+call_queries: ContextVar[QueryCounter | None] = ContextVar(
+    'call_queries', default=None
+)
+
+
+def count_query(execute, sql, params, many, context):
+    for counter in (request_queries.get(), call_queries.get()):
+        if counter is not None:
+            counter.count += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs) -> None:
+    # on every connection of every database. Connections are per thread,
+    # and sync_to_async threads, like the main.shards pool, copy the
+    # caller's context. Inserted first, as execute_wrapper() blocks pop
+    # the last wrapper on exit
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+def sync_to_async(func):
+    """
+    asgiref's sync_to_async that also records how long each call waited
+    for a thread and how many queries it made
+    """
+    name = func.__qualname__
+
+    def call(submitted, *args, **kwargs):
+        THREAD_QUEUE_SECONDS.observe(time.perf_counter() - submitted,
+                                     function=name)
+        # also the connections this thread opened before the receiver
+        # above was connected
+        for db_connection in connections.all():
+            install_query_counter(None, db_connection)
+        queries = QueryCounter()
+        token = call_queries.set(queries)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            call_queries.reset(token)
+            SYNC_CALL_QUERIES.observe(queries.count, function=name)
+
+    run = asgiref_sync_to_async(call)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(time.perf_counter(), *args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    """
+    Observes the duration of a `with` block into `histogram`
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+class MetricsMiddleware:
+    """
+    Counts and times every HTTP request along with its queries
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # lets Django call this middleware without a thread hop
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        queries = QueryCounter()
+        token = request_queries.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        self.observe(request, response, started, queries)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        queries = QueryCounter()
+        token = request_queries.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        self.observe(request, response, started, queries)
+        return response
+
+    @staticmethod
+    def observe(request, response, started: float,
+                queries: QueryCounter) -> None:
+        match = request.resolver_match
+        view = getattr(match.func, 'view_class', match.func).__name__ \
+            if match else 'unresolved'
+        HTTP_REQUESTS.inc(view=view, method=request.method,
+                          status=response.status_code)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                     view=view)
+        HTTP_REQUEST_QUERIES.observe(queries.count, view=view)
+        return None
+
+
+def scrape_allowed(request) -> bool:
+    token = settings.METRICS['TOKEN']
+    if token and hmac.compare_digest(
+            request.META.get('HTTP_AUTHORIZATION', '').encode(),
+            f'Bearer {token}'.encode()
+    ):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network)
+               for network in settings.METRICS['ALLOWED_NETWORKS'])
+
+
+def metrics_view(request):
+    if not scrape_allowed(request):
+        return HttpResponse(status=403)
+    return HttpResponse(
+        '\n'.join(metric.render() for metric in registry) + '\n',
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -1,6 +1,13 @@
 from __future__ import annotations
 
+from datetime import datetime
+from datetime import timedelta
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Q
+from django.db.models import Subquery
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth.models import BaseUserManager
 from django.contrib.auth.models import _user_has_perm
@@ -8,6 +15,14 @@ from django.contrib.auth.models import _user_has_module_perms
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from random import randint
+from hashlib import sha256
+from .archive import from_micros
+from .archive import message_archive
+from .archive import to_micros
+from .search import search as search_index
+from .search import update_index
+from .shards import fan_out
+from .shards import shard_for
 
 
 class UserManager(BaseUserManager):
@@ -34,15 +49,21 @@ class UserManager(BaseUserManager):
 class User(AbstractBaseUser):
     class Meta:
         db_table = 'user'
+        indexes = [
+            models.Index(fields=['country_code', 'phone_number']),
+        ]
 
     country_code = models.CharField(max_length=4, unique=False, null=False)
     phone_number = models.CharField(max_length=20, unique=True, null=False)
+    # sha256 of country_code + phone_number for hashed contact discovery
+    phone_hash = models.CharField(max_length=64, db_index=True, null=False)
     access_token = models.CharField(max_length=1024)
-    channel_name = models.CharField(max_length=1024)
     creation_date = models.DateTimeField(default=timezone.now, null=False)
     is_active = models.BooleanField(default=False, null=False)
     is_staff = models.BooleanField(default=False, null=False)
     is_admin = models.BooleanField(default=False, null=False)
+    # written in batches, see main.presence
+    last_seen = models.DateTimeField(null=True)
     password = None
 
     objects = UserManager()
@@ -56,6 +77,51 @@ class User(AbstractBaseUser):
         except ObjectDoesNotExist:
             return None
 
+    @staticmethod
+    def hash_phone_number(country_code: str, phone_number: str) -> str:
+        return sha256(f'{country_code}{phone_number}'.encode()).hexdigest()
+
+    @staticmethod
+    def registered_phone_numbers(
+            numbers: list[tuple[str, str]], chunk_size: int = 500
+    ) -> set[tuple[str, str]]:
+        """
+        The (country_code, phone_number) pairs that belong to a user,
+        looked up with one query per chunk on the (country_code,
+        phone_number) index.
+        """
+        numbers = list(set(numbers))
+        registered: set[tuple[str, str]] = set()
+        for i in range(0, len(numbers), chunk_size):
+            chunk = numbers[i:i + chunk_size]
+            registered.update(
+                User.objects.filter(
+                    country_code__in={country_code
+                                      for country_code, _ in chunk},
+                    phone_number__in={phone_number
+                                      for _, phone_number in chunk}
+                ).values_list('country_code', 'phone_number')
+            )
+        return registered.intersection(numbers)
+
+    @staticmethod
+    def registered_phone_hashes(hashes: list[str],
+                                chunk_size: int = 500) -> set[str]:
+        hashes = list(set(hashes))
+        registered: set[str] = set()
+        for i in range(0, len(hashes), chunk_size):
+            registered.update(
+                User.objects.filter(
+                    phone_hash__in=hashes[i:i + chunk_size]
+                ).values_list('phone_hash', flat=True)
+            )
+        return registered
+
+    def save(self, *args, **kwargs):
+        self.phone_hash = User.hash_phone_number(self.country_code,
+                                                 self.phone_number)
+        super().save(*args, **kwargs)
+
     def activate(self) -> None:
         self.is_active = True
         self.save()
@@ -83,6 +149,59 @@ class User(AbstractBaseUser):
         return f'{self.phone_number}'
 
 
+class Contact(models.Model):
+    class Meta:
+        db_table = 'contact'
+        unique_together = [('owner', 'contact')]
+
+    # `contact` is in the address book of `owner`
+    owner = models.ForeignKey(User, related_name='contact_set',
+                              on_delete=models.CASCADE, null=False)
+    contact = models.ForeignKey(User, related_name='watcher_set',
+                                on_delete=models.CASCADE, null=False)
+
+    @staticmethod
+    def add(owner: User, phone_hashes: list[str],
+            chunk_size: int = 500) -> None:
+        """
+        Adds the users with these phone hashes to the owner's contacts,
+        one query and one insert per chunk
+        """
+        for i in range(0, len(phone_hashes), chunk_size):
+            contact_ids = User.objects.filter(
+                phone_hash__in=phone_hashes[i:i + chunk_size]
+            ).exclude(pk=owner.pk).values_list('id', flat=True)
+            Contact.objects.bulk_create(
+                [Contact(owner=owner, contact_id=contact_id)
+                 for contact_id in contact_ids],
+                ignore_conflicts=True
+            )
+        return None
+
+    @staticmethod
+    def watchers(user_ids: list[int], chunk_size: int = 500
+                 ) -> list[tuple[int, int, str, str]]:
+        """
+        (contact id, owner id, owner country code, owner phone number) of
+        everyone who has one of these users as a contact
+        """
+        watchers = []
+        for i in range(0, len(user_ids), chunk_size):
+            watchers.extend(Contact.objects.filter(
+                contact_id__in=user_ids[i:i + chunk_size]
+            ).values_list('contact_id', 'owner_id', 'owner__country_code',
+                          'owner__phone_number'))
+        return watchers
+
+    @staticmethod
+    def of(owner: User) -> list[tuple[int, str, str, datetime | None]]:
+        # (id, country code, phone number, last seen) of the contacts
+        return list(Contact.objects.filter(owner=owner).values_list(
+            'contact_id', 'contact__country_code', 'contact__phone_number',
+            'contact__last_seen'
+        ))
+
+
 class OTP(models.Model):
     class Meta:
         db_table = 'otp'
@@ -102,30 +221,401 @@ class OTP(models.Model):
             return False
 
     @staticmethod
-    def update_or_create_otp(user: User) -> tuple[OTP, bool]:
+    def update_or_create_otp(user: User, reuse_for: timedelta = timedelta()
+                             ) -> tuple[OTP, bool]:
+        """
+        A code younger than `reuse_for` is kept, so repeated logins send
+        the same SMS, which main.sms drops as a duplicate
+        """
+        otp = OTP.objects.filter(
+            user=user, creation_date__gt=timezone.now() - reuse_for
+        ).first()
+        if otp:
+            return otp, False
         return OTP.objects.update_or_create(
             user=user,
-            defaults={'user': user, 'otp_code': randint(100000, 999999)}
+            defaults={'user': user, 'otp_code': randint(100000, 999999),
+                      'creation_date': timezone.now(), 'attempts': 0}
         )
 
 
 class Message(models.Model):
     class Meta:
         db_table = 'message'
+        indexes = [
+            # store-and-forward queue of each recipient
+            models.Index(fields=['recipient', 'delivered', 'id']),
+            # keyset pagination of a conversation's history
+            models.Index(fields=['conversation', 'creation_date', 'id']),
+        ]
 
+    # ids come from MessageSequence, users live in the default database
+    # and messages in the shard of their conversation, see main.shards
     sender = models.ForeignKey(User, related_name='sender_set',
-                               on_delete=models.DO_NOTHING, null=False)
+                               on_delete=models.DO_NOTHING, null=False,
+                               db_constraint=False)
     recipient = models.ForeignKey(User, related_name='recipient_set',
-                                  on_delete=models.DO_NOTHING, null=False)
+                                  on_delete=models.DO_NOTHING, null=False,
+                                  db_constraint=False)
+    # both participants' ids, see Message.conversation_key
+    conversation = models.CharField(max_length=41, null=False)
     content = models.CharField(max_length=250, null=False)
+    # client generated id and send time of the message
+    hash = models.CharField(max_length=128, db_index=True, null=False)
+    timestamp = models.CharField(max_length=32, null=False)
     creation_date = models.DateTimeField(default=timezone.now, null=False)
+    # set by the recipient's `message_delivered` receipt only, never from
+    # whether the recipient looked connected when it was sent or from a
+    # replay that may not have reached the client
     delivered = models.BooleanField(default=False, null=False)
     read = models.BooleanField(default=False, null=False)
     deleted = models.BooleanField(default=False, null=False)
 
+    @staticmethod
+    def conversation_key(user_id: int, other_user_id: int) -> str:
+        # the same for both directions of a conversation
+        return f'{min(user_id, other_user_id)}:{max(user_id, other_user_id)}'
+
+    @staticmethod
+    def history(user: User, other_user: User,
+                before: tuple[datetime, int] | None = None,
+                limit: int = 50) -> list[Message]:
+        """
+        Page of a conversation, newest first, strictly older than the
+        (creation_date, id) of `before`. Falls through to main.archive
+        for the messages that were moved there.
+        """
+        conversation = Message.conversation_key(user.pk, other_user.pk)
+        messages = Message.objects.using(shard_for(conversation)).filter(
+            conversation=conversation, deleted=False
+        )
+        if before is not None:
+            creation_date, pk = before
+            messages = messages.filter(
+                Q(creation_date__lt=creation_date)
+                | Q(creation_date=creation_date, id__lt=pk)
+            )
+        users = {user.pk: user, other_user.pk: other_user}
+        messages = Message.with_users(
+            messages.order_by('-creation_date', '-id')[:limit], users
+        )
+        newest_archived = message_archive.newest(conversation)
+        if newest_archived is None or (
+            len(messages) == limit
+            and to_micros(messages[-1].creation_date) > newest_archived
+        ):
+            return messages
+        # undelivered messages stay in the table, so both can overlap
+        merged = {record['id']: Message.from_archive(record, users)
+                  for record in message_archive.history(
+                      conversation,
+                      before and (to_micros(before[0]), before[1]), limit
+                  )}
+        merged.update((message.id, message) for message in messages)
+        return sorted(merged.values(),
+                      key=lambda message: (message.creation_date, message.id),
+                      reverse=True)[:limit]
+
+    @staticmethod
+    def archive(before: datetime, limit: int = 5000,
+                using: str = 'default') -> int:
+        """
+        Moves up to `limit` delivered messages of the shard `using` created
+        before `before` to main.archive, returns how many were moved
+        """
+        messages = list(Message.objects.using(using).filter(
+            creation_date__lt=before, delivered=True, deleted=False
+        ).order_by('id')[:limit])
+        if not messages:
+            return 0
+        with message_archive.writing():
+            # archived first, a crash in between leaves a copy in both
+            message_archive.append([message.to_archive()
+                                    for message in messages])
+            with transaction.atomic(using=using):
+                Message.objects.using(using).filter(
+                    id__in=[message.id for message in messages]
+                ).delete()
+                Message.index(messages, using, delete=True)
+        return len(messages)
+
+    @staticmethod
+    def purge_deleted(after: int = 0, limit: int = 1000,
+                      using: str = 'default') -> tuple[int, int]:
+        """
+        Removes the next `limit` soft-deleted messages of the shard `using`
+        after the id `after`, returns how many were removed and the last id
+        """
+        messages = Message.objects.using(using)
+        ids = list(messages.filter(deleted=True, id__gt=after)
+                   .order_by('id').values_list('id', flat=True)[:limit])
+        if not ids:
+            return 0, after
+        # deleted messages already left the search index
+        messages.filter(id__in=ids).delete()
+        return len(ids), ids[-1]
+
+    @staticmethod
+    def pull_undelivered(user: User, cursor: int = 0,
+                         limit: int = 200) -> list[Message]:
+        """
+        Next page of the user's undelivered messages after `cursor`, read
+        from every shard at once.
+
+        Nothing is marked here, the messages stay undelivered until the
+        client's `message_delivered` receipts, callers page on by `cursor`.
+        """
+        def page(shard: str) -> list[Message]:
+            return list(Message.objects.using(shard).filter(
+                recipient=user, delivered=False, id__gt=cursor
+            ).order_by('id')[:limit])
+
+        messages = sorted((message for messages in fan_out(page)
+                           for message in messages),
+                          key=lambda message: message.id)[:limit]
+        return Message.with_users(messages, {user.pk: user})
+
+    @staticmethod
+    def export(user: User, after: int = 0, limit: int = 2000) -> list[Message]:
+        """
+        Next page of every message the user sent or received, by id,
+        after the id `after`, merged with the ones moved to main.archive
+        """
+        # one range scan of each foreign key index instead of an OR, on
+        # every shard
+        def pages(shard: str) -> list[Message]:
+            return [message for field in ('sender', 'recipient')
+                    for message in Message.objects.using(shard).filter(
+                        deleted=False, id__gt=after, **{field: user}
+                    ).order_by('id')[:limit]]
+
+        messages = {message.id: message
+                    for page in fan_out(pages) for message in page}
+        # undelivered messages stay in the table, so both can overlap
+        archived = {record['id']: record
+                    for record in message_archive.export(user.pk, after,
+                                                         limit)
+                    if record['id'] not in messages}
+        ids = sorted([*messages, *archived])[:limit]
+        users = {user.pk: user}
+        missing = {pk for record in map(archived.get, ids) if record
+                   for pk in (record['sender_id'], record['recipient_id'])
+                   if pk not in users}
+        if missing:
+            users.update(User.objects.in_bulk(missing))
+        return Message.with_users(
+            [messages[pk] if pk in messages
+             else Message.from_archive(archived[pk], users) for pk in ids],
+            users
+        )
+
+    @staticmethod
+    def search(user: User, text: str,
+               after: tuple[float, int] | None = None,
+               limit: int = 50) -> list[tuple[Message, float]]:
+        """
+        Page of the user's messages matching every word of `text`, best
+        first, each with its rank, strictly after the (rank, id) of `after`.
+        See main.search, each shard ranks its own messages.
+        """
+        def page(shard: str) -> list[tuple[float, int, str]]:
+            return [(rank, pk, shard) for pk, rank
+                    in search_index(user.pk, text, after, limit, shard)]
+
+        ranks = sorted(hit for hits in fan_out(page) for hit in hits)[:limit]
+        messages: dict[int, Message] = {}
+        for shard in {shard for _, _, shard in ranks}:
+            messages.update(Message.objects.using(shard).in_bulk(
+                [pk for _, pk, hit_shard in ranks if hit_shard == shard]
+            ))
+        Message.with_users(messages.values(), {user.pk: user})
+        return [(messages[pk], rank) for rank, pk, _ in ranks
+                if pk in messages]
+
+    @staticmethod
+    def soft_delete(sender_id: int, recipient_id: int,
+                    hashes: list[str]) -> int:
+        """
+        Marks messages from `sender_id` to `recipient_id` as deleted in one
+        UPDATE, they stay in the table but leave the history and the search
+        index
+        """
+        conversation = Message.conversation_key(sender_id, recipient_id)
+        shard = shard_for(conversation)
+        with transaction.atomic(using=shard):
+            messages = list(Message.objects.using(shard).filter(
+                conversation=conversation, sender_id=sender_id,
+                hash__in=hashes, deleted=False
+            ))
+            if not messages:
+                return 0
+            Message.index(messages, shard, delete=True)
+            return Message.objects.using(shard).filter(
+                id__in=[message.id for message in messages]
+            ).update(deleted=True)
+
+    @staticmethod
+    def index(messages, using: str, delete: bool = False) -> None:
+        """
+        Adds the messages that are not deleted to the search index of the
+        database `using`, or removes them if `delete`, see main.search
+        """
+        return update_index([(message.id, message.sender_id,
+                              message.recipient_id, message.content)
+                             for message in messages if not message.deleted],
+                            using, delete)
+
+    @staticmethod
+    def mark_receipts(recipient: User, sender_id: int, hashes: list[str],
+                      until: str | None, read: bool) -> int:
+        """
+        Marks messages from `sender_id` to `recipient` as delivered, and
+        read if `read`, in one UPDATE. `until` names the newest message of
+        a high-water mark, every older one is included.
+        """
+        conversation = Message.conversation_key(recipient.pk, sender_id)
+        messages = Message.objects.using(shard_for(conversation)).filter(
+            conversation=conversation, recipient=recipient
+        )
+        condition = Q(hash__in=hashes)
+        if until is not None:
+            condition |= Q(id__lte=Subquery(
+                messages.filter(hash=until).order_by('-id').values('id')[:1]
+            ))
+        if read:
+            return messages.filter(condition, read=False) \
+                .update(delivered=True, read=True)
+        return messages.filter(condition, delivered=False) \
+            .update(delivered=True)
+
+    @staticmethod
+    def with_users(messages, users: dict[int, User] | None = None
+                   ) -> list[Message]:
+        """
+        Sets the sender and recipient of the messages, from `users` or
+        from one query to the default database, instead of a join that
+        cannot cross shards
+        """
+        messages = list(messages)
+        users = dict(users or {})
+        missing = {pk for message in messages
+                   for pk in (message.sender_id, message.recipient_id)
+                   if pk not in users}
+        if missing:
+            users.update(User.objects.in_bulk(missing))
+        for message in messages:
+            message.sender = users[message.sender_id]
+            message.recipient = users[message.recipient_id]
+        return messages
+
+    def to_archive(self) -> dict:
+        return {
+            'id': self.id,
+            'sender_id': self.sender_id,
+            'recipient_id': self.recipient_id,
+            'conversation': self.conversation,
+            'content': self.content,
+            'hash': self.hash,
+            'timestamp': self.timestamp,
+            'creation_date': to_micros(self.creation_date),
+            'delivered': self.delivered,
+            'read': self.read,
+        }
+
+    @staticmethod
+    def from_archive(record: dict, users: dict[int, User]) -> Message:
+        # read only, never saved back
+        return Message(
+            id=record['id'],
+            sender=users[record['sender_id']],
+            recipient=users[record['recipient_id']],
+            conversation=record['conversation'],
+            content=record['content'],
+            hash=record['hash'],
+            timestamp=record['timestamp'],
+            creation_date=from_micros(record['creation_date']),
+            delivered=record['delivered'],
+            read=record['read'],
+        )
+
+    def to_export(self) -> dict:
+        # one line of an export, resumed after its `id`
+        return {
+            'id': self.id,
+            **self.to_event(),
+            'creation_date': self.creation_date.isoformat(),
+            'delivered': self.delivered,
+            'read': self.read,
+        }
+
+    def to_event(self) -> dict:
+        return {
+            'type': 'private_message',
+            'sender_country_code': self.sender.country_code,
+            'sender_phone_number': self.sender.phone_number,
+            'receiver_country_code': self.recipient.country_code,
+            'receiver_phone_number': self.recipient.phone_number,
+            'message': self.content,
+            'hash': self.hash,
+            'timestamp': self.timestamp,
+        }
+
+    def save(self, *args, **kwargs):
+        self.conversation = Message.conversation_key(self.sender_id,
+                                                     self.recipient_id)
+        if self.id is None:
+            self.id = MessageSequence.reserve(1)[0]
+            kwargs.setdefault('force_insert', True)
+        # on its shard, also when create() passes the manager's database
+        kwargs['using'] = shard = shard_for(self.conversation)
+        with transaction.atomic(using=shard):
+            if not kwargs.get('force_insert'):
+                # indexed with the terms of the row being replaced
+                Message.index(Message.objects.using(shard).filter(
+                    pk=self.id
+                ), shard, delete=True)
+            super().save(*args, **kwargs)
+            Message.index([self], shard)
+
+    def delete(self, using=None, keep_parents=False):
+        using = using or self._state.db or shard_for(self.conversation)
+        with transaction.atomic(using=using):
+            Message.index(Message.objects.using(using).filter(pk=self.pk),
+                          using, delete=True)
+            return super().delete(using, keep_parents)
+
     def __repr__(self):
         return f'Message(sender={self.sender!r}, ' \
                f'recipient={self.recipient!r}, content=\'{self.content}\')'
 
     def __str__(self):
         return f'{self.sender.phone_number} -> {self.recipient.phone_number}'
+
+
+class MessageSequence(models.Model):
+    class Meta:
+        db_table = 'message_sequence'
+
+    # ids of the messages of every shard, in the default database
+    next_id = models.BigIntegerField(null=False)
+
+    @staticmethod
+    def reserve(count: int) -> range:
+        """
+        The next `count` message ids, one UPDATE per call
+        """
+        with transaction.atomic(using='default'):
+            if MessageSequence.objects.filter(pk=1).update(
+                next_id=F('next_id') + count
+            ):
+                next_id = MessageSequence.objects.values_list(
+                    'next_id', flat=True
+                ).get(pk=1)
+                return range(next_id - count, next_id)
+        # first use, after the messages saved before sharding
+        last_ids = fan_out(lambda shard: Message.objects.using(shard)
+                           .aggregate(last_id=Max('id'))['last_id'])
+        MessageSequence.objects.get_or_create(pk=1, defaults={
+            'next_id': max(filter(None, last_ids), default=0) + 1
+        })
+        return MessageSequence.reserve(count)
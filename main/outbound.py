@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Awaitable
+from typing import Callable
+from .events import MAX_RECEIPT_HASHES
+from .metrics import OUTBOUND_FRAMES
+from .metrics import OUTBOUND_QUEUED
+from .receipts import dedupe_receipt
+from .receipts import merge_receipt
+
+
+class OutboundQueue:
+    """
+    Bounded queue of the frames one socket still has to send.
+
+    Frames are sent by a task of their own, so a slow client only delays
+    itself. A receipt is merged into a queued receipt with the same `key`,
+    or dropped while `max_size` frames are waiting. Any other frame that
+    does not fit, or a client that took no frame for `slow_timeout`
+    seconds while some were waiting, makes the queue call `evict`.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[None]],
+                 evict: Callable[[str], Awaitable[None]],
+                 max_size: int = 1000, slow_timeout: float = 10.0):
+        self.send = send
+        self.evict = evict
+        self.max_size = max_size
+        self.slow_timeout = slow_timeout
+        # [text, receipt key] pairs, oldest first
+        self.frames: deque[list] = deque()
+        # queued receipts that can still absorb newer ones
+        self.receipts: dict[str, list] = {}
+        # when the client last took a frame, or the queue last got one
+        self.progress = time.monotonic()
+        self.task: asyncio.Task | None = None
+        self.closed = False
+
+    async def put(self, text: str, receipt_key: str | None = None) -> None:
+        if self.closed:
+            return None
+        if receipt_key is not None and self.coalesce(text, receipt_key):
+            OUTBOUND_FRAMES.inc(outcome='coalesced')
+            return None
+        if self.frames \
+                and time.monotonic() - self.progress > self.slow_timeout:
+            await self.evict_for('stalled')
+        elif len(self.frames) >= self.max_size:
+            if receipt_key is not None:
+                # already persisted, see Message.mark_receipts
+                OUTBOUND_FRAMES.inc(outcome='dropped')
+            else:
+                await self.evict_for('overflow')
+        else:
+            entry = [text, receipt_key]
+            self.frames.append(entry)
+            if receipt_key is not None:
+                self.receipts[receipt_key] = entry
+            OUTBOUND_FRAMES.inc(outcome='queued')
+            OUTBOUND_QUEUED.inc()
+            if self.task is None:
+                self.progress = time.monotonic()
+                self.task = asyncio.ensure_future(self.run())
+        return None
+
+    def coalesce(self, text: str, receipt_key: str) -> bool:
+        entry = self.receipts.get(receipt_key)
+        if entry is None:
+            return False
+        queued, frame = json.loads(entry[0]), json.loads(text)
+        merge_receipt(queued, frame)
+        dedupe_receipt(queued)
+        if len(queued['hashes']) > MAX_RECEIPT_HASHES:
+            return False
+        entry[0] = json.dumps(queued)
+        return True
+
+    async def run(self) -> None:
+        while self.frames:
+            text, receipt_key = entry = self.frames.popleft()
+            if self.receipts.get(receipt_key) is entry:
+                del self.receipts[receipt_key]
+            OUTBOUND_QUEUED.dec()
+            await self.send(text)
+            self.progress = time.monotonic()
+        self.task = None
+
+    async def evict_for(self, reason: str) -> None:
+        self.close()
+        await self.evict(reason)
+
+    def close(self) -> None:
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        OUTBOUND_QUEUED.dec(len(self.frames))
+        self.frames.clear()
+        self.receipts.clear()
+        return None
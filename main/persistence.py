@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import InterfaceError
+from django.db import OperationalError
+from django.db import transaction
+from .models import User
+from .metrics import sync_to_async
+from .models import Message
+from .models import MessageSequence
+from .shards import shard_for
+
+logger = logging.getLogger(__name__)
+
+# types of the fields of a queued entry, deletions only have the first four
+ENTRY_FIELDS = {
+    'sender_id': int,
+    'receiver_country_code': str,
+    'receiver_phone_number': str,
+    'hash': str,
+    'message': str,
+    'timestamp': str,
+    'creation_date': datetime,
+}
+DELETE_FIELDS = ('sender_id', 'receiver_country_code',
+                 'receiver_phone_number', 'hash')
+
+# the database is unreachable or busy, saving again can succeed
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def is_valid_entry(entry: dict) -> bool:
+    fields = DELETE_FIELDS if entry.get('delete') else ENTRY_FIELDS
+    return all(isinstance(entry.get(field), ENTRY_FIELDS[field])
+               for field in fields)
+
+
+class MessageWriter:
+    """
+    Write-behind buffer for relayed messages.
+
+    Messages are queued in memory and saved with one bulk_create per batch,
+    either when the batch is full or when its oldest message is too old.
+    Deletions are queued with them, so they always follow the message.
+    When the database falls behind the queue fills up and `put` waits, so
+    the sockets producing messages slow down instead of memory growing.
+    A batch failing for any other reason is saved entry by entry and the
+    entries that still fail are logged and dropped.
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 0.5,
+                 max_pending: int = 10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.queue: asyncio.Queue | None = None
+        self.lock: asyncio.Lock | None = None
+        self.task: asyncio.Task | None = None
+        self.batch: list[dict] = []
+        # hash -> number of its messages queued and not saved yet
+        self.pending: dict[str, int] = {}
+        # (country code, phone number) -> number of messages queued for them
+        self.recipients: dict[tuple[str, str], int] = {}
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue(maxsize=self.max_pending)
+            self.lock = asyncio.Lock()
+            self.batch = []
+            self.pending = {}
+            self.recipients = {}
+            self.task = None
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return None
+
+    async def put(self, entry: dict) -> None:
+        if not is_valid_entry(entry):
+            # would fail the whole batch it is saved with
+            logger.error('dropped invalid message entry %r', entry)
+            return None
+        self.start()
+        if not entry.get('delete'):
+            self.pending[entry['hash']] = \
+                self.pending.get(entry['hash'], 0) + 1
+            recipient = (entry['receiver_country_code'],
+                         entry['receiver_phone_number'])
+            self.recipients[recipient] = \
+                self.recipients.get(recipient, 0) + 1
+        await self.queue.put(entry)
+
+    def is_pending(self, hashes) -> bool:
+        """
+        Whether a message with one of the hashes is still buffered, only
+        then is a flush needed before updating it
+        """
+        return any(hash in self.pending for hash in hashes)
+
+    def is_pending_for(self, country_code: str, phone_number: str) -> bool:
+        """
+        Whether a message to the user is still buffered, only then is a
+        flush needed before reading their undelivered messages
+        """
+        return (country_code, phone_number) in self.recipients
+
+    async def run(self) -> None:
+        while True:
+            self.batch.append(await self.queue.get())
+            deadline = self.loop.time() + self.flush_interval
+            while len(self.batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                # not wait_for(), which can swallow a cancellation
+                getter = asyncio.ensure_future(self.queue.get())
+                done, _ = await asyncio.wait({getter}, timeout=timeout)
+                if not done:
+                    # a cancelled get() leaves its item in the queue
+                    getter.cancel()
+                    break
+                self.batch.append(getter.result())
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Save everything buffered so far.
+        """
+        if self.queue is None:
+            return None
+        async with self.lock:
+            batch, self.batch = self.batch, []
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            taken = list(batch)
+            delay = 0.1
+            while batch:
+                try:
+                    await self.save(batch)
+                    break
+                except TRANSIENT_ERRORS:
+                    # keep holding the batch, producers block meanwhile
+                    logger.exception('failed to save %d messages', len(batch))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+                except DatabaseError:
+                    logger.exception('failed to save %d messages, saving '
+                                     'them one by one', len(batch))
+                    batch = await self.save_each(batch)
+            # saved or dropped
+            for entry in taken:
+                if not entry.get('delete'):
+                    self.release(entry)
+        return None
+
+    def release(self, entry: dict) -> None:
+        for counts, key in ((self.pending, entry['hash']),
+                            (self.recipients,
+                             (entry['receiver_country_code'],
+                              entry['receiver_phone_number']))):
+            count = counts.pop(key, 0) - 1
+            if count > 0:
+                counts[key] = count
+        return None
+
+    async def save_each(self, batch: list[dict]) -> list[dict]:
+        """
+        Saves the entries one at a time, drops the ones the database
+        rejects, returns the rest if it becomes unavailable meanwhile
+        """
+        for i, entry in enumerate(batch):
+            try:
+                await self.save([entry])
+            except TRANSIENT_ERRORS:
+                return batch[i:]
+            except DatabaseError:
+                logger.exception('dropped message entry %r', entry)
+        return []
+
+    @staticmethod
+    @sync_to_async
+    def save(batch: list[dict]) -> None:
+        recipients = User.objects.filter(
+            phone_number__in={entry['receiver_phone_number']
+                              for entry in batch}
+        ).values_list('country_code', 'phone_number', 'id')
+        recipient_ids = {(country_code, phone_number): pk
+                         for country_code, phone_number, pk in recipients}
+        # ids are kept in the entries, so a batch saved again after a failure
+        # inserts nothing twice on the shards that took it already
+        saved_before = [entry['id'] for entry in batch if 'id' in entry]
+        new = [entry for entry in batch
+               if not entry.get('delete') and 'id' not in entry]
+        if new:
+            for entry, pk in zip(new, MessageSequence.reserve(len(new))):
+                entry['id'] = pk
+        # shard -> its messages
+        messages: dict[str, list[Message]] = {}
+        # (sender id, recipient id) -> hashes of the deleted messages
+        deleted: dict[tuple[int, int], list[str]] = {}
+        for entry in batch:
+            recipient_id = recipient_ids.get((entry['receiver_country_code'],
+                                              entry['receiver_phone_number']))
+            if recipient_id is None:
+                continue
+            if entry.get('delete'):
+                deleted.setdefault((entry['sender_id'], recipient_id),
+                                   []).append(entry['hash'])
+                continue
+            conversation = Message.conversation_key(entry['sender_id'],
+                                                    recipient_id)
+            messages.setdefault(shard_for(conversation), []).append(Message(
+                id=entry['id'],
+                sender_id=entry['sender_id'],
+                recipient_id=recipient_id,
+                conversation=conversation,
+                content=entry['message'],
+                hash=entry['hash'],
+                timestamp=entry['timestamp'],
+                creation_date=entry['creation_date'],
+            ))
+        # all or nothing on each shard, a failed batch is saved again
+        for shard, shard_messages in messages.items():
+            if saved_before:
+                saved = set(Message.objects.using(shard).filter(
+                    id__in=saved_before
+                ).values_list('id', flat=True))
+                shard_messages = [message for message in shard_messages
+                                  if message.id not in saved]
+            with transaction.atomic(using=shard):
+                Message.objects.using(shard).bulk_create(shard_messages,
+                                                         batch_size=500)
+                Message.index(shard_messages, shard)
+        # after the messages they delete, wherever those were saved
+        for (sender_id, recipient_id), hashes in deleted.items():
+            Message.soft_delete(sender_id, recipient_id, hashes)
+        return None
+
+
+message_writer = MessageWriter(
+    batch_size=settings.MESSAGE_WRITER['BATCH_SIZE'],
+    flush_interval=settings.MESSAGE_WRITER['FLUSH_INTERVAL'],
+    max_pending=settings.MESSAGE_WRITER['MAX_PENDING'],
+)
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+from .models import Contact
+from .models import User
+from .metrics import sync_to_async
+from .routing_table import routing_table
+from .routing_table import user_group_name
+
+logger = logging.getLogger(__name__)
+
+# sent by clients to keep their last seen time fresh, any frame counts
+HEARTBEAT = 'heartbeat'
+
+
+def presence_entry(country_code: str, phone_number: str, online: bool,
+                   last_seen: datetime | None) -> dict:
+    return {
+        'country_code': country_code,
+        'phone_number': phone_number,
+        'online': online,
+        'last_seen': last_seen.isoformat() if last_seen else None,
+    }
+
+
+class Presence:
+    """
+    Online state and last seen time of the users connected to this worker.
+
+    A user is online while any of their devices is connected, on any
+    worker, see main.routing_table. Every `window` seconds the changes are
+    pushed, as one `presence` frame per watcher, to the connected users
+    who have the user as a contact. Going offline is only pushed after
+    `debounce` seconds without reconnecting, so flapping connections stay
+    quiet. Last seen times are written every `flush_interval` seconds with
+    one bulk UPDATE, and sockets that sent a heartbeat once but none for
+    `heartbeat_timeout` seconds are closed.
+    """
+
+    def __init__(self, window: float = 1.0, debounce: float = 5.0,
+                 flush_interval: float = 30.0,
+                 heartbeat_timeout: float = 90.0):
+        self.window = window
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        # (country_code, phone_number) of the users tracked here
+        self.users: dict[int, tuple[str, str]] = {}
+        # channel name -> [user id, time of the last heartbeat or None]
+        self.sockets: dict[str, list] = {}
+        # state last pushed by this worker, offline when missing
+        self.announced: set[int] = set()
+        # user id -> time of the last connect or disconnect
+        self.changed: dict[int, float] = {}
+        self.last_seen: dict[int, datetime] = {}
+        # last seen times not written yet
+        self.dirty: set[int] = set()
+        self.task: asyncio.Task | None = None
+        self.flushed_at = time.monotonic()
+
+    def start(self) -> None:
+        # one loop per process, started by the first socket
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return None
+
+    def connect(self, user: User, channel_name: str) -> None:
+        self.users[user.pk] = (user.country_code, user.phone_number)
+        self.sockets[channel_name] = [user.pk, None]
+        self.changed[user.pk] = time.monotonic()
+        self.seen(user.pk)
+        self.start()
+        return None
+
+    def disconnect(self, user: User, channel_name: str) -> None:
+        self.sockets.pop(channel_name, None)
+        self.changed[user.pk] = time.monotonic()
+        self.seen(user.pk)
+        return None
+
+    def heartbeat(self, channel_name: str, explicit: bool = False) -> None:
+        socket = self.sockets.get(channel_name)
+        if socket is None:
+            return None
+        if explicit or socket[1] is not None:
+            socket[1] = time.monotonic()
+        self.seen(socket[0])
+        return None
+
+    def seen(self, user_id: int) -> None:
+        self.last_seen[user_id] = timezone.now()
+        self.dirty.add(user_id)
+        return None
+
+    def is_online(self, user_id: int) -> bool:
+        return routing_table.is_connected(*self.users[user_id])
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                await self.announce()
+                if time.monotonic() - self.flushed_at \
+                        >= self.flush_interval:
+                    await self.flush()
+                    await self.expire()
+            except DatabaseError:
+                # retried on the next window
+                logger.exception('failed to update presence')
+
+    async def announce(self) -> None:
+        now = time.monotonic()
+        changes: dict[int, bool] = {}
+        for user_id, changed_at in list(self.changed.items()):
+            online = self.is_online(user_id)
+            if online == (user_id in self.announced):
+                del self.changed[user_id]
+            elif online or now - changed_at >= self.debounce:
+                changes[user_id] = online
+        if not changes:
+            return None
+        watchers = await self.watchers(list(changes))
+        frames: dict[int, list[dict]] = {}
+        for user_id, owner_id, country_code, phone_number in watchers:
+            if routing_table.is_connected(country_code, phone_number):
+                frames.setdefault(owner_id, []).append(presence_entry(
+                    *self.users[user_id], changes[user_id],
+                    self.last_seen.get(user_id)
+                ))
+        for user_id, online in changes.items():
+            if self.changed[user_id] <= now:
+                # unless it changed again while loading the watchers
+                del self.changed[user_id]
+            if online:
+                self.announced.add(user_id)
+            else:
+                self.announced.discard(user_id)
+        channel_layer = get_channel_layer()
+        for owner_id, users in frames.items():
+            await channel_layer.group_send(user_group_name(owner_id), {
+                'type': 'relay',
+                'text': json.dumps({'type': 'presence', 'users': users}),
+            })
+        return None
+
+    @staticmethod
+    @sync_to_async
+    def watchers(user_ids: list[int]) -> list[tuple[int, int, str, str]]:
+        return Contact.watchers(user_ids)
+
+    async def flush(self) -> None:
+        """
+        Write every pending last seen time
+        """
+        self.flushed_at = time.monotonic()
+        dirty, self.dirty = self.dirty, set()
+        if dirty:
+            try:
+                await self.save({user_id: self.last_seen[user_id]
+                                 for user_id in dirty})
+            except DatabaseError:
+                self.dirty |= dirty
+                raise
+        # forget the users that are gone and announced as offline
+        connected = {user_id for user_id, _ in self.sockets.values()}
+        for user_id in list(self.users):
+            if user_id not in connected and user_id not in self.changed \
+                    and user_id not in self.announced \
+                    and user_id not in self.dirty:
+                del self.users[user_id]
+                self.last_seen.pop(user_id, None)
+        return None
+
+    @staticmethod
+    @sync_to_async
+    def save(last_seen: dict[int, datetime]) -> None:
+        User.objects.bulk_update(
+            [User(pk=user_id, last_seen=seen)
+             for user_id, seen in last_seen.items()],
+            ['last_seen'], batch_size=500
+        )
+
+    async def expire(self) -> None:
+        now = time.monotonic()
+        channel_layer = get_channel_layer()
+        for channel_name, (_, heartbeat_at) in list(self.sockets.items()):
+            if heartbeat_at is not None \
+                    and now - heartbeat_at > self.heartbeat_timeout:
+                await channel_layer.send(channel_name,
+                                         {'type': 'heartbeat.timeout'})
+        return None
+
+    async def contacts(self, user: User) -> list[dict]:
+        """
+        Current presence of the user's contacts, sent on connect
+        """
+        return [presence_entry(country_code, phone_number,
+                               routing_table.is_connected(country_code,
+                                                          phone_number),
+                               self.last_seen.get(contact_id, last_seen))
+                for contact_id, country_code, phone_number, last_seen
+                in await self.load_contacts(user)]
+
+    @staticmethod
+    @sync_to_async
+    def load_contacts(user: User
+                      ) -> list[tuple[int, str, str, datetime | None]]:
+        return Contact.of(user)
+
+
+presence = Presence(
+    window=settings.PRESENCE['WINDOW'],
+    debounce=settings.PRESENCE['DEBOUNCE'],
+    flush_interval=settings.PRESENCE['FLUSH_INTERVAL'],
+    heartbeat_timeout=settings.PRESENCE['HEARTBEAT_TIMEOUT'],
+)
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable
+from typing import Callable
+from .events import ADDRESS_FIELDS
+from .events import MAX_RECEIPT_HASHES
+
+
+def merge_receipt(batch: dict, frame: dict) -> None:
+    """
+    Adds the hashes and `until` of a receipt frame to `batch`
+    """
+    if 'hash' in frame:
+        batch['hashes'].append(frame['hash'])
+    batch['hashes'].extend(frame.get('hashes', ()))
+    if 'until' in frame:
+        # receipts of one socket arrive in order, the last one is newest
+        batch['until'] = frame['until']
+    return None
+
+
+def dedupe_receipt(batch: dict) -> None:
+    # drop duplicates, keep the order
+    batch['hashes'] = list(dict.fromkeys(batch['hashes']))
+    if len(batch['hashes']) == 1:
+        # clients that only know single receipts
+        batch['hash'] = batch['hashes'][0]
+    else:
+        batch.pop('hash', None)
+    return None
+
+
+class ReceiptBatcher:
+    """
+    Coalesces the delivery and read receipts sent by one socket.
+
+    Receipts for the same conversation and type that arrive within
+    `window` seconds are merged into one frame with every `hashes` and the
+    newest `until`, which `send` then handles once.
+    """
+
+    def __init__(self, send: Callable[[dict], Awaitable[None]],
+                 window: float = 0.2):
+        self.send = send
+        self.window = window
+        self.pending: dict[tuple[str, str, str], dict] = {}
+        self.task: asyncio.Task | None = None
+
+    async def add(self, frame: dict) -> None:
+        key = (frame['type'], frame['receiver_country_code'],
+               frame['receiver_phone_number'])
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = {
+                'type': frame['type'],
+                **{field: frame[field] for field in ADDRESS_FIELDS},
+                'hashes': [],
+                'until': None,
+            }
+        merge_receipt(batch, frame)
+        if len(batch['hashes']) >= MAX_RECEIPT_HASHES:
+            # full, no point in waiting
+            await self.send_batch(self.pending.pop(key))
+        elif self.task is None:
+            self.task = asyncio.ensure_future(self.flush_later())
+        return None
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self.task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        pending, self.pending = self.pending, {}
+        for batch in pending.values():
+            await self.send_batch(batch)
+
+    async def send_batch(self, batch: dict) -> None:
+        dedupe_receipt(batch)
+        await self.send(batch)
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
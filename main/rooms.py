@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from collections import deque
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .metrics import CHANNEL_LAYER_SECONDS
+from .metrics import ROOM_DELIVERIES
+from .metrics import timed
+from .routing_table import REJOIN_INTERVAL
+
+
+class RoomHistory:
+    """
+    Last messages of the rooms a worker relays, replayed to new members.
+
+    Keeps up to `size` JSON encoded messages per room, for at most
+    `max_rooms` rooms and about `max_bytes` of messages in total; past
+    that, the least recently used rooms are dropped.
+    """
+
+    def __init__(self, size: int = 50, max_rooms: int = 1000,
+                 max_bytes: int = 16 * 2 ** 20):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.rooms: OrderedDict[str, deque[str]] = OrderedDict()
+        self.bytes = 0
+
+    def __contains__(self, group_name: str) -> bool:
+        return group_name in self.rooms
+
+    def add(self, group_name: str, message: str) -> list[str]:
+        """
+        Records a message, returns the rooms dropped to make room for it
+        """
+        if not self.size:
+            return []
+        messages = self.rooms.get(group_name)
+        if messages is None:
+            messages = self.rooms[group_name] = deque(maxlen=self.size)
+        self.rooms.move_to_end(group_name)
+        if len(messages) == self.size:
+            self.bytes -= len(messages[0])
+        messages.append(message)
+        self.bytes += len(message)
+        dropped = []
+        while len(self.rooms) > 1 and (len(self.rooms) > self.max_rooms
+                                       or self.bytes > self.max_bytes):
+            dropped.append(self.discard(next(iter(self.rooms))))
+        return dropped
+
+    def get(self, group_name: str) -> list[str]:
+        messages = self.rooms.get(group_name)
+        if messages is None:
+            return []
+        self.rooms.move_to_end(group_name)
+        return list(messages)
+
+    def discard(self, group_name: str) -> str:
+        messages = self.rooms.pop(group_name, ())
+        self.bytes -= sum(len(message) for message in messages)
+        return group_name
+
+
+class RoomHub:
+    """
+    Process-wide fan-out of chat room messages.
+
+    The process joins the channel layer group of a room once, with a
+    channel of its own, while any of its sockets is in the room. Every
+    room message is encoded once and handed to the outbound queue of each
+    local member, so it costs one group_send and one delivery per worker
+    instead of one per member.
+
+    Rooms stay joined after their last local member left for as long as
+    `history` keeps them, so the history has no gaps. Every joined room is
+    joined again each REJOIN_INTERVAL, before the layer's group_expiry.
+    """
+
+    def __init__(self, history: RoomHistory):
+        self.history = history
+        # group name -> consumers in the room, on this worker
+        self.members: dict[str, set] = {}
+        self.joined_at: dict[str, float] = {}
+        self.channel_name: str | None = None
+        self.listener: asyncio.Task | None = None
+        self.refresher: asyncio.Task | None = None
+        self.lock: asyncio.Lock | None = None
+
+    async def start(self) -> None:
+        # one listener per process, started by the first socket
+        if self.listener and not self.listener.done():
+            return None
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.listener and not self.listener.done():
+                return None
+            channel_layer = get_channel_layer()
+            self.channel_name = await channel_layer.new_channel('rooms.')
+            # a new channel is in no group yet
+            self.joined_at.clear()
+            self.listener = asyncio.ensure_future(self.listen(channel_layer))
+            self.refresher = asyncio.ensure_future(self.refresh())
+        return None
+
+    async def listen(self, channel_layer) -> None:
+        while True:
+            event = await channel_layer.receive(self.channel_name)
+            await self.deliver(event)
+
+    async def refresh(self) -> None:
+        # also the rooms no socket of this worker joins for that long
+        while True:
+            await asyncio.sleep(REJOIN_INTERVAL / 2)
+            for group_name in list(self.joined_at):
+                # unless discarded meanwhile
+                if group_name in self.joined_at:
+                    await self.rejoin(group_name)
+
+    async def rejoin(self, group_name: str) -> None:
+        joined_at = self.joined_at.get(group_name)
+        # re-join well before the layer's group_expiry
+        if joined_at is None or time.monotonic() - joined_at \
+                > REJOIN_INTERVAL:
+            self.joined_at[group_name] = time.monotonic()
+            with timed(CHANNEL_LAYER_SECONDS, operation='group_add'):
+                await get_channel_layer().group_add(group_name,
+                                                    self.channel_name)
+        return None
+
+    async def deliver(self, event: dict) -> None:
+        group_name = event.get('room')
+        members = self.members.get(group_name)
+        if not members and group_name not in self.history:
+            return None
+        # encoded once, for the history and every member
+        message = json.dumps(event['message'])
+        for dropped in self.history.add(group_name, message):
+            if dropped not in self.members:
+                await self.discard(dropped)
+        if not members:
+            return None
+        text = f'{{"message": {message}}}'
+        ROOM_DELIVERIES.inc(len(members))
+        for member in list(members):
+            await member.outbound.put(text)
+        return None
+
+    async def join(self, group_name: str, consumer) -> None:
+        """
+        Adds an accepted socket to a room, its first frame is the room's
+        history
+        """
+        await self.start()
+        await self.rejoin(group_name)
+        # nothing below yields to the loop, put() only waits to evict a
+        # full queue, so every message goes either to the history or to
+        # the socket
+        self.members.setdefault(group_name, set()).add(consumer)
+        messages = self.history.get(group_name)
+        if messages:
+            await consumer.outbound.put(
+                f'{{"messages": [{", ".join(messages)}]}}'
+            )
+        return None
+
+    async def leave(self, group_name: str, consumer) -> None:
+        members = self.members.get(group_name)
+        if members is None:
+            return None
+        members.discard(consumer)
+        if not members:
+            del self.members[group_name]
+            if group_name not in self.history:
+                await self.discard(group_name)
+        return None
+
+    async def discard(self, group_name: str) -> None:
+        if self.joined_at.pop(group_name, None) is not None:
+            with timed(CHANNEL_LAYER_SECONDS, operation='group_discard'):
+                await get_channel_layer().group_discard(group_name,
+                                                        self.channel_name)
+        return None
+
+
+room_hub = RoomHub(RoomHistory(
+    settings.CHAT_ROOMS['HISTORY_SIZE'],
+    settings.CHAT_ROOMS['HISTORY_MAX_ROOMS'],
+    settings.CHAT_ROOMS['HISTORY_MAX_BYTES'],
+))
@@ -4,5 +4,6 @@ from .consumers import UserAuthorizationConsumer
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_name>\w+)/$', ChatConsumer.as_asgi()),
-    re_path(r'ws/user/(?P<access_token>.+)/$', UserAuthorizationConsumer.as_asgi()),
+    # the access token is sent in the handshake, see main.auth
+    re_path(r'ws/user/$', UserAuthorizationConsumer.as_asgi()),
 ]
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from channels.layers import get_channel_layer
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .models import User
+from .metrics import sync_to_async
+
+ROUTING_GROUP = 'routing_table'
+# re-join the broadcast group well before the layer's group_expiry
+REJOIN_INTERVAL = 3600
+# every worker announces its devices again this often, and forgets the
+# devices of other workers that were not announced for ROUTE_TTL, e.g.
+# when their worker died without removing them
+REFRESH_INTERVAL = 30
+ROUTE_TTL = 3 * REFRESH_INTERVAL
+# devices per route.refresh message
+REFRESH_CHUNK_SIZE = 500
+# numbers without a user are looked up again after this, a user created in
+# another process is only seen once it connects or the miss expires
+MISS_TTL = 5
+MAX_MISSES = 10000
+
+
+def user_group_name(user_id: int) -> str:
+    # every socket of a user joins this group
+    return f'user_{user_id}'
+
+
+class RoutingTable:
+    """
+    Process-wide map of (country_code, phone_number) -> user id, plus the
+    channel names of the user's connected devices.
+
+    Every connect and disconnect is broadcast to the other workers through
+    the channel layer; an unknown user id falls back to the database, and
+    a number without a user is not looked up again for MISS_TTL. The
+    devices of this worker are announced again every REFRESH_INTERVAL, and
+    to every new worker, so the devices of a worker that is gone expire.
+    """
+
+    def __init__(self):
+        self.user_ids: dict[tuple[str, str], int] = {}
+        # (country code, phone number) -> expiry of a failed lookup
+        self.misses: dict[tuple[str, str], float] = {}
+        # (country code, phone number) -> channel name -> expiry time,
+        # infinite for the devices of this worker
+        self.devices: dict[tuple[str, str], dict[str, float]] = {}
+        # channel name -> (user id, country code, phone number) of the
+        # devices of this worker
+        self.local: dict[str, tuple[int, str, str]] = {}
+        self.channel_name: str | None = None
+        self.listener: asyncio.Task | None = None
+        self.refresher: asyncio.Task | None = None
+        self.lock: asyncio.Lock | None = None
+        self.joined_at: float = 0.0
+
+    async def start(self) -> None:
+        # one listener per process, started by the first socket
+        if self.listener and not self.listener.done():
+            await self.rejoin()
+            return None
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.listener and not self.listener.done():
+                return None
+            channel_layer = get_channel_layer()
+            self.channel_name = await channel_layer.new_channel('routing.')
+            await channel_layer.group_add(ROUTING_GROUP, self.channel_name)
+            self.joined_at = time.monotonic()
+            self.listener = asyncio.ensure_future(self.listen(channel_layer))
+            self.refresher = asyncio.ensure_future(self.refresh())
+            # the other workers announce their devices to this new one
+            await channel_layer.group_send(ROUTING_GROUP, {
+                'type': 'route.sync',
+                'origin': self.channel_name,
+            })
+        return None
+
+    async def rejoin(self) -> None:
+        if time.monotonic() - self.joined_at > REJOIN_INTERVAL:
+            self.joined_at = time.monotonic()
+            await get_channel_layer().group_add(ROUTING_GROUP,
+                                                self.channel_name)
+        return None
+
+    async def listen(self, channel_layer) -> None:
+        while True:
+            message = await channel_layer.receive(self.channel_name)
+            if message.get('origin') == self.channel_name:
+                continue
+            if message['type'] == 'route.sync':
+                await self.announce()
+                continue
+            if message['type'] == 'route.refresh':
+                routes = message['routes']
+            else:
+                routes = [(message['user_id'], message['country_code'],
+                           message['phone_number'], message['channel_name'])]
+            for user_id, country_code, phone_number, channel_name in routes:
+                key = (country_code, phone_number)
+                if message['type'] == 'route.remove':
+                    self.discard(key, channel_name)
+                    continue
+                self.user_ids[key] = user_id
+                self.misses.pop(key, None)
+                self.devices.setdefault(key, {})[channel_name] = \
+                    time.monotonic() + ROUTE_TTL
+
+    async def refresh(self) -> None:
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            # also when no socket connects to this worker for that long
+            await self.rejoin()
+            await self.announce()
+            self.expire()
+
+    async def announce(self) -> None:
+        # every device of this worker, in a few messages
+        routes = [(user_id, country_code, phone_number, channel_name)
+                  for channel_name, (user_id, country_code, phone_number)
+                  in self.local.items()]
+        for i in range(0, len(routes), REFRESH_CHUNK_SIZE):
+            await get_channel_layer().group_send(ROUTING_GROUP, {
+                'type': 'route.refresh',
+                'origin': self.channel_name,
+                'routes': routes[i:i + REFRESH_CHUNK_SIZE],
+            })
+        return None
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        for key, devices in list(self.devices.items()):
+            for channel_name, expiry in list(devices.items()):
+                if expiry < now:
+                    self.discard(key, channel_name)
+        return None
+
+    def discard(self, key: tuple[str, str], channel_name: str) -> None:
+        devices = self.devices.get(key)
+        if devices is not None:
+            devices.pop(channel_name, None)
+            if not devices:
+                del self.devices[key]
+        return None
+
+    async def broadcast(self, type: str, user: User,
+                        channel_name: str) -> None:
+        await get_channel_layer().group_send(ROUTING_GROUP, {
+            'type': type,
+            'origin': self.channel_name,
+            'user_id': user.pk,
+            'country_code': user.country_code,
+            'phone_number': user.phone_number,
+            'channel_name': channel_name,
+        })
+
+    async def add(self, user: User, channel_name: str) -> None:
+        await self.start()
+        key = (user.country_code, user.phone_number)
+        self.user_ids[key] = user.pk
+        self.misses.pop(key, None)
+        self.devices.setdefault(key, {})[channel_name] = math.inf
+        self.local[channel_name] = (user.pk, *key)
+        await self.broadcast('route.add', user, channel_name)
+
+    async def remove(self, user: User, channel_name: str) -> None:
+        self.discard((user.country_code, user.phone_number), channel_name)
+        self.local.pop(channel_name, None)
+        await self.broadcast('route.remove', user, channel_name)
+
+    def is_connected(self, country_code: str, phone_number: str) -> bool:
+        # a device of another worker counts until its route expires
+        now = time.monotonic()
+        return any(expiry >= now for expiry in self.devices.get(
+            (country_code, phone_number), {}
+        ).values())
+
+    async def get(self, country_code: str, phone_number: str) -> int | None:
+        key = (country_code, phone_number)
+        user_id = self.user_ids.get(key)
+        if user_id is None:
+            if self.misses.get(key, 0) > time.monotonic():
+                return None
+            user_id = await self.load(country_code, phone_number)
+            if user_id is not None:
+                self.user_ids[key] = user_id
+                self.misses.pop(key, None)
+            else:
+                self.miss(key)
+        return user_id
+
+    def miss(self, key: tuple[str, str]) -> None:
+        if len(self.misses) >= MAX_MISSES:
+            # drop the oldest entry
+            self.misses.pop(next(iter(self.misses), None), None)
+        self.misses[key] = time.monotonic() + MISS_TTL
+        return None
+
+    def forget_miss(self, country_code: str, phone_number: str) -> None:
+        self.misses.pop((country_code, phone_number), None)
+        return None
+
+    @staticmethod
+    @sync_to_async
+    def load(country_code: str, phone_number: str) -> int | None:
+        # user ids never change, so a hit is cached for good
+        return User.objects.filter(
+            country_code=country_code, phone_number=phone_number
+        ).values_list('id', flat=True).first()
+
+
+routing_table = RoutingTable()
+
+
+@receiver(post_save, sender=User)
+def forget_missing_user(sender, instance: User, created: bool,
+                        **kwargs) -> None:
+    # in this process, the other ones hear of the user on route.add
+    if created:
+        routing_table.forget_miss(instance.country_code,
+                                  instance.phone_number)
@@ -0,0 +1,150 @@
+"""
+Full-text search of the messages, an SQLite FTS5 index of each shard.
+
+The index is kept in sync by the code writing messages, Message.save,
+Message.delete and the helpers of Message calling `update_index`; a
+QuerySet.update of the content or QuerySet.delete bypasses it. Other
+programs can write to `message` too, e.g. the sqlite3 shell, run
+`manage.py rebuild_search_index` after such writes.
+"""
+from __future__ import annotations
+
+import re
+from django.db import connections
+from django.db import transaction
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+
+SEARCH_TABLE = 'message_search'
+
+# split like the unicode61 tokenizer, which also folds case and diacritics
+SEARCH_WORD = re.compile(r'[^\W_]+')
+
+
+def user_terms(user_id: int, text: str) -> list[str]:
+    # a word is indexed once per participant, as `u<user id>x<word>`, so
+    # the postings and the bm25 statistics of a term are one user's only
+    return [f'u{user_id}x{word}' for word in SEARCH_WORD.findall(text)]
+
+
+def search_terms(sender_id: int, recipient_id: int, content: str) -> str:
+    """
+    Indexed text of a message
+    """
+    terms = user_terms(sender_id, content)
+    if recipient_id != sender_id:
+        terms += user_terms(recipient_id, content)
+    return ' '.join(terms)
+
+
+# Contentless FTS5 index of the messages that are not deleted, with the
+# message id as rowid. A row is removed with the terms it was added with,
+# computed again from the stored message.
+SEARCH_TABLE_SQL = f"""
+    CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(
+        terms, content='', tokenize='unicode61 remove_diacritics 2'
+    )
+"""
+
+# kept the index before, they call a function only Django's connections had
+OLD_SEARCH_TRIGGERS = [f'{SEARCH_TABLE}_insert', f'{SEARCH_TABLE}_update',
+                       f'{SEARCH_TABLE}_delete']
+
+
+def update_index(rows: list[tuple[int, int, int, str]], using: str,
+                 delete: bool = False) -> None:
+    """
+    Adds messages, as (id, sender id, recipient id, content), to the index
+    of the database `using`, or removes them if `delete`. Call it in the
+    transaction writing them.
+    """
+    connection = connections[using]
+    if not rows or connection.vendor != 'sqlite':
+        return None
+    if delete:
+        sql = f"""
+            INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, terms)
+            VALUES ('delete', %s, %s)
+        """
+    else:
+        sql = f'INSERT INTO {SEARCH_TABLE} (rowid, terms) VALUES (%s, %s)'
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            (pk, search_terms(sender_id, recipient_id, content))
+            for pk, sender_id, recipient_id, content in rows
+        ])
+    return None
+
+
+def rebuild_index(using: str = 'default', batch_size: int = 1000) -> int:
+    """
+    Indexes the messages of `using` again from scratch, in one
+    transaction, returns how many were indexed
+    """
+    indexed, last_id = 0, 0
+    with transaction.atomic(using=using), \
+            connections[using].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) "
+                       f"VALUES ('delete-all')")
+        while True:
+            cursor.execute(
+                'SELECT id, sender_id, recipient_id, content FROM message '
+                'WHERE NOT deleted AND id > %s ORDER BY id LIMIT %s',
+                [last_id, batch_size]
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                return indexed
+            update_index(rows, using)
+            indexed += len(rows)
+            last_id = rows[-1][0]
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using: str = 'default', **kwargs) -> None:
+    if sender.name != 'main':
+        return None
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return None
+    # on the databases holding messages, see main.shards
+    tables = connection.introspection.table_names()
+    if 'message' not in tables:
+        return None
+    with connection.cursor() as cursor:
+        for name in OLD_SEARCH_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        if SEARCH_TABLE in tables:
+            return None
+        with transaction.atomic(using=using):
+            cursor.execute(SEARCH_TABLE_SQL)
+            rebuild_index(using)
+    return None
+
+
+def search(user_id: int, text: str, after: tuple[float, int] | None = None,
+           limit: int = 50, using: str = 'default') -> list[tuple[int, float]]:
+    """
+    (message id, rank) of the messages of `user_id` with every word of
+    `text`, best first, strictly after the (rank, id) of `after`
+    """
+    terms = user_terms(user_id, text)[:16]
+    if not terms:
+        return []
+    # words only, quoted, so no FTS5 syntax gets through; lower bm25 ranks
+    # better
+    sql = f"""
+        SELECT id, rank FROM (
+            SELECT rowid AS id, rank FROM {SEARCH_TABLE}
+            WHERE {SEARCH_TABLE} MATCH %s
+        )
+    """
+    params: list = [' '.join(f'"{term}"' for term in terms)]
+    if after is not None:
+        sql += ' WHERE rank > %s OR (rank = %s AND id > %s)'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY rank, id LIMIT %s'
+    params.append(limit)
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
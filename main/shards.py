@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from typing import Callable
+from typing import TypeVar
+from django.conf import settings
+
+T = TypeVar('T')
+
+# models stored by conversation, in every database of MESSAGE_SHARDS
+SHARDED_MODELS = {'message'}
+
+executor = ThreadPoolExecutor(max_workers=4 * len(settings.MESSAGE_SHARDS),
+                              thread_name_prefix='shards')
+
+
+@functools.lru_cache(maxsize=65536)
+def shard_for(conversation: str) -> str:
+    """
+    Database of a conversation, see Message.conversation_key.
+
+    Rendezvous hashing: adding a shard only moves the conversations that
+    now rank it first, about 1/N of them.
+    """
+    return max(settings.MESSAGE_SHARDS, key=lambda shard: sha256(
+        f'{shard}:{conversation}'.encode()
+    ).digest())
+
+
+def fan_out(function: Callable[[str], T]) -> list[T]:
+    """
+    function(shard) for every shard, in parallel when there are several
+    """
+    if len(settings.MESSAGE_SHARDS) == 1:
+        return [function(settings.MESSAGE_SHARDS[0])]
+    # each pool thread keeps its own connections, and runs in a copy of the
+    # caller's context, so main.metrics counts its queries for the caller
+    return [future.result() for future in [
+        executor.submit(contextvars.copy_context().run, function, shard)
+        for shard in settings.MESSAGE_SHARDS
+    ]]
+
+
+class MessageRouter:
+    """
+    Keeps the sharded models in MESSAGE_SHARDS and everything else in the
+    default database.
+
+    Saving a message picks its shard from its conversation, queries have
+    to name theirs with `using()`, see Message.
+    """
+
+    def db_for_read(self, model, **hints) -> str | None:
+        return self.db_for_instance(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints) -> str | None:
+        return self.db_for_instance(model, hints.get('instance'))
+
+    @staticmethod
+    def db_for_instance(model, instance) -> str | None:
+        if model._meta.app_label != 'main':
+            return None
+        if model._meta.model_name not in SHARDED_MODELS:
+            return 'default'
+        if instance is not None and getattr(instance, 'conversation', ''):
+            return shard_for(instance.conversation)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool | None:
+        # messages point at users across databases, without constraints
+        if obj1._meta.app_label == obj2._meta.app_label == 'main':
+            return True
+        return None
+
+    def allow_migrate(self, db: str, app_label: str,
+                      model_name: str | None = None, **hints) -> bool | None:
+        if app_label == 'main' and model_name in SHARDED_MODELS:
+            return db in settings.MESSAGE_SHARDS
+        # e.g. the admin log points at users, which only default has
+        return db == 'default'
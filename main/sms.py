@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.utils.module_loading import import_string
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+logger = logging.getLogger(__name__)
+
+
+class SMSError(Exception):
+    def __init__(self, message: str, retry: bool = True):
+        super().__init__(message)
+        # False when sending again cannot succeed, e.g. an invalid number
+        self.retry = retry
+
+
+class TwilioProvider:
+    """
+    Sends through one Twilio client, reusing its pooled HTTP session
+    """
+
+    def __init__(self):
+        self.from_ = os.environ['TWILIO_PHONE_NUMBER']
+        self.client = Client(os.environ['TWILIO_ACCOUNT_SID'],
+                             os.environ['TWILIO_AUTH_TOKEN'],
+                             http_client=TwilioHttpClient(
+                                 pool_connections=True, timeout=10
+                             ))
+
+    def send(self, to: str, body: str) -> None:
+        try:
+            self.client.messages.create(body=body, from_=self.from_, to=to)
+        except TwilioRestException as error:
+            # 4xx other than rate limiting will fail again
+            raise SMSError(str(error), retry=error.status == 429
+                           or error.status >= 500)
+        except OSError as error:
+            raise SMSError(str(error))
+
+
+class FakeProvider:
+    """
+    Keeps sent messages in memory, for tests and benchmarks
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent: list[tuple[str, str]] = []
+
+    def send(self, to: str, body: str) -> None:
+        time.sleep(self.delay)
+        self.sent.append((to, body))
+
+
+class SMSQueue:
+    """
+    Sends SMS in the background so requests never wait on the provider.
+
+    At most `concurrency` messages are in flight and `max_pending` queued.
+    Failures are retried with exponential backoff, and the same body sent
+    to the same number within `dedupe_window` seconds is only sent once.
+    """
+
+    def __init__(self, provider_path: str, concurrency: int = 4,
+                 max_pending: int = 1000, retries: int = 3,
+                 backoff: float = 0.5, dedupe_window: float = 60):
+        self.provider_path = provider_path
+        self.provider = None
+        self.retries = retries
+        self.backoff = backoff
+        self.dedupe_window = dedupe_window
+        self.executor = ThreadPoolExecutor(max_workers=concurrency,
+                                           thread_name_prefix='sms')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.recent: dict[tuple[str, str], float] = {}
+
+    def get_provider(self):
+        # built on first use, the credentials may not be set at import
+        with self.lock:
+            if self.provider is None:
+                self.provider = import_string(self.provider_path)()
+            return self.provider
+
+    def send(self, to: str, body: str) -> bool:
+        """
+        Queues an SMS, False if the queue is full
+        """
+        now = time.monotonic()
+        with self.lock:
+            sent_at = self.recent.get((to, body))
+            if sent_at is not None and now - sent_at < self.dedupe_window:
+                return True
+            if not self.slots.acquire(blocking=False):
+                return False
+            if len(self.recent) >= 1000:
+                self.recent = {key: sent_at
+                               for key, sent_at in self.recent.items()
+                               if now - sent_at < self.dedupe_window}
+            self.recent[(to, body)] = now
+        self.executor.submit(self.deliver, to, body)
+        return True
+
+    def deliver(self, to: str, body: str) -> None:
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.get_provider().send(to, body)
+                    return None
+                except SMSError as error:
+                    if not error.retry or attempt == self.retries:
+                        logger.warning('SMS to %s failed: %s', to, error)
+                        self.forget(to, body)
+                        return None
+                    time.sleep(self.backoff * 2 ** attempt)
+        except Exception:
+            # e.g. missing credentials or a provider bug, nothing else
+            # would see it on the executor's thread
+            logger.exception('SMS to %s failed', to)
+            self.forget(to, body)
+        finally:
+            self.slots.release()
+
+    def forget(self, to: str, body: str) -> None:
+        with self.lock:
+            # allow the user to ask for it again
+            self.recent.pop((to, body), None)
+        return None
+
+    def send_otp(self, phone_number: str, otp_code: int) -> bool:
+        return self.send(phone_number,
+                         'Welcome to SGB\'s Utopia'
+                         f'! this is your code: {otp_code}')
+
+
+sms_queue = SMSQueue(
+    settings.SMS['PROVIDER'],
+    concurrency=settings.SMS['CONCURRENCY'],
+    max_pending=settings.SMS['MAX_PENDING'],
+    retries=settings.SMS['RETRIES'],
+    backoff=settings.SMS['BACKOFF'],
+    dedupe_window=settings.SMS['DEDUPE_WINDOW'],
+)
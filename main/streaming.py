@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import django
+from typing import AsyncGenerator
+from typing import Awaitable
+from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as BaseASGIHandler
+from django.http import StreamingHttpResponse
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    Streaming response over an async generator of bytes.
+
+    Django 3.2 iterates streaming responses on the event loop, where the
+    ORM cannot be used, so this one is sent by ASGIHandler below and can
+    fetch each part with sync_to_async. Outside of it, e.g. under WSGI,
+    the parts are fetched one by one with async_to_sync.
+    """
+
+    def __init__(self, streaming_content: AsyncGenerator[bytes, None],
+                 *args, **kwargs):
+        self.async_content = streaming_content
+        super().__init__(self.iterate(), *args, **kwargs)
+
+    def iterate(self):
+        while True:
+            # started here rather than in the event loop of async_to_sync,
+            # whose shutdown would close the generator after one part
+            part = self.async_content.__anext__()
+            try:
+                yield async_to_sync(self.wait)(part)
+            except StopAsyncIteration:
+                return
+
+    @staticmethod
+    async def wait(part: Awaitable[bytes]) -> bytes:
+        return await part
+
+
+class ASGIHandler(BaseASGIHandler):
+    """
+    Django's ASGI handler, also sending AsyncStreamingHttpResponse
+    """
+
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            response_headers.append((
+                b'Set-Cookie',
+                cookie.output(header='').encode('ascii').strip()
+            ))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+        try:
+            async for part in response.async_content:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+            await send({'type': 'http.response.body'})
+        finally:
+            await response.async_content.aclose()
+            await sync_to_async(response.close, thread_sensitive=True)()
+        return None
+
+
+def get_asgi_application() -> ASGIHandler:
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+from main.models import User
+
+
+def create_user(phone_number: str, country_code: str = '+44') -> User:
+    user = User(country_code=country_code, phone_number=phone_number,
+                is_active=True)
+    user.save()
+    user.access_token = str(RefreshToken.for_user(user).access_token)
+    user.save()
+    return user
+
+
+def message_entry(sender: User, recipient: User, hash: str,
+                  **fields) -> dict:
+    # as queued by UserAuthorizationConsumer
+    return {
+        'sender_id': sender.pk,
+        'receiver_country_code': recipient.country_code,
+        'receiver_phone_number': recipient.phone_number,
+        'message': f'message {hash}',
+        'hash': hash,
+        'timestamp': '1',
+        'creation_date': timezone.now(),
+        **fields,
+    }
@@ -0,0 +1,45 @@
+# flake8: noqa
+
+"""
+Settings for the tests, run with
+
+    python manage.py test main --settings=main.tests.settings
+
+Messages are sharded over three SQLite files and the sockets use the
+in-memory channel layer, nothing else has to run.
+"""
+import tempfile
+
+from chat.settings import *
+
+TEST_DIR = Path(tempfile.mkdtemp(prefix='chat-tests-'))
+
+# files rather than in-memory databases, main.shards reads them from other
+# threads
+DATABASES = {
+    alias: {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': TEST_DIR / f'{alias}.sqlite3',
+        'TEST': {'NAME': TEST_DIR / f'test-{alias}.sqlite3'},
+    }
+    for alias in ('default', 'messages-1', 'messages-2')
+}
+MESSAGE_SHARDS = ['default', 'messages-1', 'messages-2']
+
+# create the main tables straight from the models
+MIGRATION_MODULES = {'main': None}
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+# the limits have tests of their own
+SOCKET_LIMITS = {**SOCKET_LIMITS, 'RATE': (1e6, 1e6), 'EVENT_RATES': {}}
+MESSAGE_WRITER = {**MESSAGE_WRITER, 'FLUSH_INTERVAL': 0.05}
+BLOB_ROOT = TEST_DIR / 'blobs'
+MESSAGE_ARCHIVE = {**MESSAGE_ARCHIVE, 'ROOT': TEST_DIR / 'archive',
+                   'BLOCK_SIZE': 4}
+RECEIPT_WINDOW = 0.05
+SMS = {**SMS, 'PROVIDER': 'main.sms.FakeProvider'}
@@ -0,0 +1,189 @@
+import gzip
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.utils import timezone
+from main.archive import MessageArchive
+from main.archive import archived_until
+from main.archive import message_archive
+from main.archive import to_micros
+from main.models import Message
+from main.shards import fan_out
+from .helpers import create_user
+
+
+def record(pk: int, conversation: str, creation_date: int) -> dict:
+    return {'id': pk, 'conversation': conversation,
+            'creation_date': creation_date}
+
+
+class MessageArchiveTests(SimpleTestCase):
+    def setUp(self):
+        self.archive = MessageArchive(tempfile.mkdtemp(), block_size=3)
+        self.start = to_micros(timezone.now() - timedelta(days=400))
+
+    def test_blocks_are_gzip_members_indexed_by_conversation(self):
+        records = [record(i, f'1:{i % 4 + 2}', self.start + i)
+                   for i in range(10)]
+        with self.archive.writing():
+            self.archive.append(records)
+        [month] = self.archive.months()
+        with gzip.open(self.archive.path(month, '.ndjson.gz')) as blocks:
+            lines = [json.loads(line) for line in blocks]
+        self.assertEqual(sorted(line['id'] for line in lines),
+                         list(range(10)))
+        entries = self.archive.index(month)
+        self.assertEqual(len(entries), 4)
+        for entry in entries:
+            self.assertEqual(
+                set(entry['conversations']),
+                {line['conversation']
+                 for line in self.archive.read_block(month, entry)}
+            )
+        self.assertEqual(self.archive.newest('1:2'), self.start + 8)
+        self.assertEqual(self.archive.newest(), self.start + 9)
+
+    def test_reads_only_the_blocks_of_a_conversation(self):
+        with self.archive.writing():
+            for run in range(5):
+                self.archive.append([
+                    record(run * 10 + i, f'1:{i + 2}', self.start + run)
+                    for i in range(9)
+                ])
+        [month] = self.archive.months()
+        self.assertEqual(len(self.archive.index(month)), 15)
+        self.assertEqual(len(self.archive.blocks(month, '1:2')), 5)
+        self.assertEqual(self.archive.blocks(month, '5:6'), [])
+        self.assertIsNone(self.archive.newest('5:6'))
+        self.assertEqual(len(self.archive.conversation(month, '1:2')), 5)
+
+    def test_history_pages_and_dedupes(self):
+        records = [record(i, '1:2', self.start + i) for i in range(7)]
+        with self.archive.writing():
+            self.archive.append(records)
+            # an interrupted run archives the same messages again
+            self.archive.append(records[3:])
+        page = self.archive.history('1:2', None, 4)
+        self.assertEqual([line['id'] for line in page], [6, 5, 4, 3])
+        before = (page[-1]['creation_date'], page[-1]['id'])
+        self.assertEqual([line['id'] for line in self.archive.history(
+            '1:2', before, 4
+        )], [2, 1, 0])
+
+    def test_export_pages_a_user_by_id(self):
+        records = [record(i, ('1:2', '2:3', '1:13')[i % 3], self.start + i)
+                   for i in range(12)]
+        with self.archive.writing():
+            self.archive.append(records)
+            self.archive.append(records[:3])
+        self.assertEqual([line['id'] for line in self.archive.export(1, 0,
+                                                                     5)],
+                         [2, 3, 5, 6, 8])
+        self.assertEqual([line['id'] for line in self.archive.export(1, 8,
+                                                                     5)],
+                         [9, 11])
+        self.assertEqual(self.archive.export(4, 0, 5), [])
+
+    def test_ignores_an_index_line_cut_short(self):
+        with self.archive.writing():
+            self.archive.append([record(1, '1:2', self.start)])
+        [month] = self.archive.months()
+        with open(self.archive.path(month, '.index'), 'a') as index:
+            index.write('{"offset": 9')
+        self.assertEqual(len(self.archive.index(month)), 1)
+
+
+class ArchiveMessagesTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.root = message_archive.root
+        message_archive.root = Path(tempfile.mkdtemp())
+        message_archive.indexes.clear()
+        self.users = [create_user(f'700000000{i}') for i in range(4)]
+        now = timezone.now()
+        for i in range(60):
+            sender, recipient = self.users[i % 4], self.users[(i + 1) % 4]
+            Message(sender=sender, recipient=recipient, content=f'm{i}',
+                    hash=f'h{i}', timestamp='1',
+                    creation_date=now - timedelta(days=500 - i * 5),
+                    delivered=i % 7 != 0, deleted=i % 11 == 0).save()
+
+    def tearDown(self):
+        message_archive.root = self.root
+        message_archive.indexes.clear()
+
+    def history(self, user, other_user, page: int = 4) -> list[int]:
+        ids, before = [], None
+        while True:
+            messages = Message.history(user, other_user, before, page)
+            ids += [message.id for message in messages]
+            if len(messages) < page:
+                return ids
+            before = (messages[-1].creation_date, messages[-1].id)
+
+    def test_history_is_the_same_after_archiving(self):
+        pairs = [(self.users[i], self.users[(i + 1) % 4]) for i in range(4)]
+        before = [self.history(*pair) for pair in pairs]
+        output = StringIO()
+        call_command('archive_messages', age_days=365, stdout=output)
+        self.assertIn('purged', output.getvalue())
+        left = sum(fan_out(lambda shard: Message.objects.using(shard)
+                           .filter(creation_date__lt=timezone.now()
+                                   - timedelta(days=365),
+                                   delivered=True).count()))
+        self.assertEqual(left, 0)
+        self.assertTrue(message_archive.months())
+        self.assertEqual([self.history(*pair) for pair in pairs], before)
+        # archived again after a crash, before the delete
+        for month in message_archive.months():
+            with message_archive.writing():
+                message_archive.append([
+                    line for entry in message_archive.index(month)
+                    for line in message_archive.read_block(month, entry)
+                ])
+        self.assertEqual([self.history(*pair) for pair in pairs], before)
+
+    def export(self, user, **params) -> list[dict]:
+        response = self.client.get(
+            '/export/', params,
+            HTTP_AUTHORIZATION=f'Bearer {user.access_token}'
+        )
+        return [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+
+    @override_settings(MESSAGE_EXPORT_CHUNK_SIZE=4)
+    def test_export_is_the_same_after_archiving(self):
+        user = self.users[0]
+        before = self.export(user)
+        call_command('archive_messages', age_days=365, stdout=StringIO())
+        archived = {line['id'] for line in message_archive.export(
+            user.pk, 0, 1000
+        )}
+        self.assertTrue(archived)
+        self.assertEqual(self.export(user), before)
+        # resumed from the last archived message, the rest is in the table
+        last = max(archived)
+        self.assertTrue(any(line['id'] > last for line in before))
+        self.assertEqual(self.export(user, cursor=last),
+                         [line for line in before if line['id'] > last])
+        # and from the middle of the archived ones
+        middle = sorted(archived)[len(archived) // 2]
+        self.assertEqual(self.export(user, cursor=middle),
+                         [line for line in before if line['id'] > middle])
+
+    def test_search_says_what_it_leaves_out(self):
+        user = self.users[0]
+        call_command('archive_messages', age_days=365, stdout=StringIO())
+        until = archived_until()
+        self.assertIsNotNone(until)
+        response = self.client.post('/search/', {
+            'access_token': user.access_token, 'query': 'm1',
+        }, content_type='application/json')
+        self.assertEqual(response.json()['archived_until'], until)
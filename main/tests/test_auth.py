@@ -0,0 +1,64 @@
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.test import TransactionTestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from main.auth import access_token_from_scope
+from main.auth import authenticate
+from main.auth import user_cache
+from .helpers import create_user
+
+
+class AccessTokenFromScopeTests(TransactionTestCase):
+    def test_bearer_header(self):
+        self.assertEqual(access_token_from_scope({
+            'headers': [(b'host', b'x'), (b'authorization', b'Bearer abc')],
+        }), 'abc')
+        self.assertIsNone(access_token_from_scope({
+            'headers': [(b'authorization', b'Basic abc')],
+        }))
+
+    def test_subprotocol(self):
+        self.assertEqual(access_token_from_scope({
+            'subprotocols': ['chat.json.v1', 'access_token.abc'],
+        }), 'abc')
+        self.assertIsNone(access_token_from_scope({'subprotocols': []}))
+
+
+class AuthenticateTests(TransactionTestCase):
+    def setUp(self):
+        user_cache.users.clear()
+        self.user = create_user('7000000001')
+
+    async def test_valid_token_is_cached(self):
+        token = self.user.access_token
+        self.assertEqual((await authenticate(token)).pk, self.user.pk)
+        # no database round trip
+        with mock.patch('main.auth.load_user') as load_user:
+            self.assertEqual((await authenticate(token)).pk, self.user.pk)
+        load_user.assert_not_called()
+
+    async def test_rejects_garbage_and_refresh_tokens(self):
+        self.assertIsNone(await authenticate('nope'))
+        refresh = await sync_to_async(RefreshToken.for_user)(self.user)
+        self.assertIsNone(await authenticate(str(refresh)))
+
+    async def test_only_the_latest_token_is_accepted(self):
+        old = self.user.access_token
+        await authenticate(old)
+        self.user.access_token = str(await sync_to_async(
+            lambda: RefreshToken.for_user(self.user).access_token
+        )())
+        await sync_to_async(self.user.save)()
+        self.assertIsNone(await authenticate(old))
+        self.assertIsNotNone(await authenticate(self.user.access_token))
+
+    async def test_inactive_users_are_rejected(self):
+        self.user.is_active = False
+        await sync_to_async(self.user.save)()
+        self.assertIsNone(await authenticate(self.user.access_token))
+
+    async def test_saving_a_user_drops_the_cached_copy(self):
+        await authenticate(self.user.access_token)
+        self.assertIsNotNone(user_cache.get(self.user.pk))
+        await sync_to_async(self.user.save)()
+        self.assertIsNone(user_cache.get(self.user.pk))
@@ -0,0 +1,115 @@
+import io
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from unittest import mock
+from django.test import SimpleTestCase
+from django.test import TestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from main.blobs import BlobStore
+from main.blobs import BlobTooLarge
+from main.blobs import blob_store
+from .helpers import create_user
+
+CONTENT = bytes(range(256)) * 40
+DIGEST = sha256(CONTENT).hexdigest()
+
+
+class BlobStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = BlobStore(Path(tempfile.mkdtemp()), chunk_size=1000)
+
+    def test_stores_content_by_digest_once(self):
+        self.assertEqual(self.store.write(io.BytesIO(CONTENT), 1 << 20),
+                         (DIGEST, True))
+        self.assertEqual(self.store.write(io.BytesIO(CONTENT), 1 << 20),
+                         (DIGEST, False))
+        self.assertTrue(self.store.exists(DIGEST))
+        self.assertEqual(self.store.size(DIGEST), len(CONTENT))
+        self.assertEqual(b''.join(self.store.read(DIGEST)), CONTENT)
+        # nothing left behind in tmp/
+        self.assertEqual(list((self.store.root / 'tmp').iterdir()), [])
+
+    def test_reads_a_range(self):
+        self.store.write(io.BytesIO(CONTENT), 1 << 20)
+        self.assertEqual(b''.join(self.store.read(DIGEST, 999, 2500)),
+                         CONTENT[999:2501])
+
+    def test_rejects_blobs_over_the_limit(self):
+        with self.assertRaises(BlobTooLarge):
+            self.store.write(io.BytesIO(CONTENT), len(CONTENT) - 1)
+        self.assertFalse(self.store.exists(DIGEST))
+        self.assertEqual(list((self.store.root / 'tmp').iterdir()), [])
+
+    def test_only_digests_exist(self):
+        self.assertFalse(self.store.exists('../settings.py'))
+
+
+class BlobViewTests(TestCase):
+    def setUp(self):
+        self.user = create_user('7000000001')
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {self.user.access_token}'}
+        # an empty store for each test
+        patcher = mock.patch.object(blob_store, 'root',
+                                    Path(tempfile.mkdtemp()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, content: bytes = CONTENT, **headers):
+        return self.client.post('/blobs/', content,
+                                content_type='application/octet-stream',
+                                **headers)
+
+    def test_upload_and_download(self):
+        response = self.upload(**self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['blob'], DIGEST)
+        self.assertEqual(self.upload(**self.auth).status_code, 200)
+        response = self.client.get(f'/blobs/{DIGEST}/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), CONTENT)
+        self.assertEqual(response['ETag'], f'"{DIGEST}"')
+
+    def test_range_requests(self):
+        self.upload(**self.auth)
+        response = self.client.get(f'/blobs/{DIGEST}/',
+                                   HTTP_RANGE='bytes=10-19', **self.auth)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'],
+                         f'bytes 10-19/{len(CONTENT)}')
+        self.assertEqual(b''.join(response.streaming_content),
+                         CONTENT[10:20])
+        response = self.client.get(f'/blobs/{DIGEST}/', HTTP_RANGE='bytes=-5',
+                                   **self.auth)
+        self.assertEqual(b''.join(response.streaming_content), CONTENT[-5:])
+        response = self.client.get(f'/blobs/{DIGEST}/',
+                                   HTTP_RANGE=f'bytes={len(CONTENT)}-',
+                                   **self.auth)
+        self.assertEqual(response.status_code, 416)
+
+    def test_rejects_a_malformed_content_length(self):
+        for length in ('abc', '-1', '1.5'):
+            with self.subTest(length=length):
+                self.assertEqual(self.upload(CONTENT_LENGTH=length,
+                                             **self.auth).status_code, 400)
+
+    def test_requires_an_access_token(self):
+        self.assertEqual(self.upload().status_code, 401)
+        self.assertEqual(self.client.get(f'/blobs/{DIGEST}/').status_code,
+                         401)
+
+    def test_only_the_latest_token_of_an_active_user(self):
+        superseded = {'HTTP_AUTHORIZATION': 'Bearer ' + str(
+            RefreshToken.for_user(self.user).access_token
+        )}
+        self.assertEqual(self.upload(**superseded).status_code, 401)
+        self.assertEqual(self.upload(HTTP_AUTHORIZATION='Bearer garbage')
+                         .status_code, 401)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(f'/blobs/{DIGEST}/', **self.auth)
+                         .status_code, 401)
+
+    def test_unknown_blob(self):
+        self.assertEqual(self.client.get(f'/blobs/{"0" * 64}/',
+                                         **self.auth).status_code, 404)
@@ -0,0 +1,390 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from unittest import mock
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from django.test import override_settings
+from chat.asgi import application
+from main.frames import MSGPACK_SUBPROTOCOL
+from main.frames import msgpack_codec
+from main.models import Message
+from main.persistence import message_writer
+from main.presence import presence
+from main.routing_table import routing_table
+from main.shards import fan_out
+from .helpers import create_user
+
+
+def private_message(sender, recipient, hash: str) -> dict:
+    return {
+        'type': 'private_message',
+        'sender_country_code': sender.country_code,
+        'sender_phone_number': sender.phone_number,
+        'receiver_country_code': recipient.country_code,
+        'receiver_phone_number': recipient.phone_number,
+        'message': f'message {hash}',
+        'hash': hash,
+        'timestamp': '1',
+    }
+
+
+def message_values(*fields: str) -> list[tuple]:
+    # from every shard, in id order
+    return [values[1:] for values in sorted(
+        values for rows in fan_out(lambda shard: list(
+            Message.objects.using(shard).values_list('id', *fields)
+        )) for values in rows
+    )]
+
+
+@sync_to_async
+def stored_messages() -> list[tuple[int, int, str]]:
+    return message_values('sender_id', 'recipient_id', 'hash')
+
+
+@sync_to_async
+def delivered() -> list[bool]:
+    return [value for value, in message_values('delivered')]
+
+
+@sync_to_async
+def read() -> list[bool]:
+    return [value for value, in message_values('read')]
+
+
+class UserConsumerTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        self.carol = create_user('7000000003')
+        # the workers of the previous test ran on another event loop
+        routing_table.__init__()
+        presence.__init__()
+
+    async def connect(self, user,
+                      subprotocols: list[str] | None = None
+                      ) -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(
+            application, '/ws/user/',
+            headers=[(b'authorization',
+                      f'Bearer {user.access_token}'.encode())],
+            subprotocols=subprotocols
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def stop(self, *communicators: WebsocketCommunicator) -> None:
+        for communicator in communicators:
+            await communicator.disconnect()
+        await message_writer.flush()
+        for task in (routing_table.listener, routing_table.refresher,
+                     presence.task, message_writer.task):
+            if task is not None:
+                task.cancel()
+        await asyncio.sleep(0)
+
+    async def test_unknown_token_is_rejected(self):
+        communicator = WebsocketCommunicator(
+            application, '/ws/user/', headers=[(b'authorization',
+                                                b'Bearer nope')]
+        )
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_token_in_a_subprotocol(self):
+        communicator = WebsocketCommunicator(
+            application, '/ws/user/',
+            subprotocols=['chat.json.v1',
+                          f'access_token.{self.alice.access_token}']
+        )
+        connected, subprotocol = await communicator.connect()
+        try:
+            self.assertTrue(connected)
+            # the token is never echoed back
+            self.assertEqual(subprotocol, 'chat.json.v1')
+        finally:
+            await self.stop(communicator)
+
+    async def test_message_is_relayed_to_both_sides(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h1')
+            self.assertEqual((await alice.receive_json_from())['hash'], 'h1')
+            await message_writer.flush()
+            self.assertEqual(await stored_messages(),
+                             [(self.alice.pk, self.bob.pk, 'h1')])
+            # until the recipient acknowledges it
+            self.assertEqual(await delivered(), [False])
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_every_device_gets_the_message(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        alice_phone = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        bob_phone = await self.connect(self.bob)
+        try:
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            # the sender's other devices get the echo
+            for device in (alice, alice_phone, bob, bob_phone):
+                self.assertEqual((await device.receive_json_from())['hash'],
+                                 'h1')
+        finally:
+            await self.stop(alice, alice_phone, bob, bob_phone)
+
+    async def test_msgpack_and_json_clients_talk(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice, [MSGPACK_SUBPROTOCOL])
+        bob = await self.connect(self.bob)
+        try:
+            event = private_message(self.alice, self.bob, 'h1')
+            await alice.send_to(bytes_data=msgpack_codec.encode(event)[
+                'bytes_data'
+            ])
+            self.assertEqual(await bob.receive_json_from(), event)
+            echo = await alice.receive_output()
+            self.assertEqual(msgpack_codec.decode(None, echo['bytes']),
+                             event)
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_image_message_carries_a_blob_digest(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            event = {**private_message(self.alice, self.bob, 'h1'),
+                     'type': 'image_message', 'blob': 'not a digest'}
+            del event['message']
+            await alice.send_json_to(event)
+            self.assertTrue(await bob.receive_nothing(0.1))
+            await alice.send_json_to({**event, 'blob': 'a' * 64})
+            self.assertEqual((await bob.receive_json_from())['blob'],
+                             'a' * 64)
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_malformed_frames_are_dropped(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            await alice.send_to(text_data='not json')
+            await alice.send_to(bytes_data=b'\x00')
+            await alice.send_json_to({'type': 'nope'})
+            incomplete = private_message(self.alice, self.bob, 'h1')
+            del incomplete['timestamp']
+            await alice.send_json_to(incomplete)
+            self.assertTrue(await bob.receive_nothing(0.1))
+            # the socket stays usable
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h1')
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_unhashable_types_leave_the_socket_usable(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            await alice.send_json_to({'type': ['private_message']})
+            await alice.send_to(bytes_data=b'\x81\xa1t\x91\xa1x')
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h1')
+            await alice.disconnect()
+            # disconnect() ran, nothing of alice's socket is left
+            self.assertFalse(routing_table.is_connected(
+                self.alice.country_code, self.alice.phone_number
+            ))
+            self.assertEqual(routing_table.local.keys(),
+                             presence.sockets.keys())
+            self.assertEqual(len(presence.sockets), 1)
+        finally:
+            await self.stop(bob)
+
+    @override_settings(SOCKET_LIMITS={
+        'RATE': (1e6, 1e6), 'EVENT_RATES': {'private_message': (0.01, 2)},
+        'OUTBOUND_QUEUE_SIZE': 1000, 'SLOW_TIMEOUT': 10,
+    })
+    async def test_frames_over_the_limit_are_dropped(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            for hash in ('h1', 'h2', 'h3'):
+                await alice.send_json_to(private_message(self.alice, self.bob,
+                                                         hash))
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h1')
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h2')
+            self.assertTrue(await bob.receive_nothing(0.1))
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_sender_is_the_socket_user(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            # claims to come from carol
+            await alice.send_json_to(private_message(self.carol, self.bob,
+                                                     'h1'))
+            received = await bob.receive_json_from()
+            self.assertEqual((received['sender_country_code'],
+                              received['sender_phone_number']),
+                             (self.alice.country_code,
+                              self.alice.phone_number))
+            await message_writer.flush()
+            self.assertEqual(await stored_messages(),
+                             [(self.alice.pk, self.bob.pk, 'h1')])
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_malformed_messages_are_dropped(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            for fields in ({'message': 'x' * 251}, {'message': ['x']},
+                           {'hash': 1}, {'timestamp': 1},
+                           {'timestamp': ''}):
+                await alice.send_json_to({**private_message(
+                    self.alice, self.bob, 'h1'
+                ), **fields})
+            await alice.send_to(text_data=json.dumps('not an event'))
+            self.assertTrue(await bob.receive_nothing(0.2))
+            await message_writer.flush()
+            self.assertEqual(await stored_messages(), [])
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_receipts_are_coalesced(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            for hash in ('h1', 'h2'):
+                await alice.send_json_to(private_message(self.alice, self.bob,
+                                                         hash))
+                await bob.receive_json_from()
+                await alice.receive_json_from()
+            for hash in ('h1', 'h2', 'h2'):
+                await bob.send_json_to({
+                    'type': 'message_read',
+                    'sender_country_code': self.bob.country_code,
+                    'sender_phone_number': self.bob.phone_number,
+                    'receiver_country_code': self.alice.country_code,
+                    'receiver_phone_number': self.alice.phone_number,
+                    'hash': hash,
+                })
+            # after RECEIPT_WINDOW, one frame for all three
+            receipt = await alice.receive_json_from()
+            self.assertEqual((receipt['type'], receipt['hashes']),
+                             ('message_read', ['h1', 'h2']))
+            self.assertTrue(await alice.receive_nothing(0.1))
+            self.assertEqual(await read(), [True, True])
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_unacknowledged_message_is_replayed(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            await bob.receive_json_from()
+            await alice.receive_json_from()
+            await message_writer.flush()
+            await bob.disconnect()
+            bob = await self.connect(self.bob)
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h1')
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_delivery_receipt_stops_the_replay(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        try:
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            await bob.receive_json_from()
+            await alice.receive_json_from()
+            await bob.send_json_to({
+                'type': 'message_delivered',
+                'sender_country_code': self.bob.country_code,
+                'sender_phone_number': self.bob.phone_number,
+                'receiver_country_code': self.alice.country_code,
+                'receiver_phone_number': self.alice.phone_number,
+                'hash': 'h1',
+            })
+            # after RECEIPT_WINDOW
+            receipt = await alice.receive_json_from()
+            self.assertEqual((receipt['type'], receipt['hash']),
+                             ('message_delivered', 'h1'))
+            self.assertEqual(await delivered(), [True])
+            await bob.disconnect()
+            bob = await self.connect(self.bob)
+            self.assertTrue(await bob.receive_nothing(0.2))
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_message_to_an_offline_user_is_replayed(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = None
+        try:
+            await alice.send_json_to(private_message(self.alice, self.bob,
+                                                     'h1'))
+            # echoed to the sender only
+            self.assertEqual((await alice.receive_json_from())['hash'], 'h1')
+            await message_writer.flush()
+            self.assertEqual(await delivered(), [False])
+            bob = await self.connect(self.bob)
+            received = await bob.receive_json_from()
+            self.assertEqual((received['type'], received['hash'],
+                              received['sender_phone_number']),
+                             ('private_message', 'h1', '7000000001'))
+            # not until bob acknowledges it, replayed again meanwhile
+            self.assertEqual(await delivered(), [False])
+            await bob.disconnect()
+            bob = await self.connect(self.bob)
+            self.assertEqual((await bob.receive_json_from())['hash'], 'h1')
+        finally:
+            await self.stop(alice, *filter(None, [bob]))
+
+    async def test_connect_flushes_only_for_messages_to_the_user(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = carol = None
+        try:
+            with mock.patch.object(message_writer, 'flush_interval', 60):
+                await alice.send_json_to(private_message(
+                    self.alice, self.carol, 'h1'
+                ))
+                await alice.receive_json_from()
+                with mock.patch.object(message_writer, 'flush',
+                                       wraps=message_writer.flush) as flush:
+                    # nothing buffered for bob
+                    bob = await self.connect(self.bob)
+                    flush.assert_not_called()
+                    carol = await self.connect(self.carol)
+                    flush.assert_called_once()
+            self.assertEqual((await carol.receive_json_from())['hash'], 'h1')
+        finally:
+            await self.stop(alice, *filter(None, [bob, carol]))
@@ -0,0 +1,110 @@
+from io import StringIO
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from main.models import Contact
+from main.models import User
+from .helpers import create_user
+
+
+def number(phone_number: str, country_code: str = '+44') -> dict:
+    return {'country_code': country_code, 'phone_number': phone_number}
+
+
+class RegisteredContactsTests(TestCase):
+    def setUp(self):
+        self.users = [create_user(f'700000000{i}') for i in range(5)]
+
+    def test_phone_hash_is_kept_on_save(self):
+        user = self.users[0]
+        self.assertEqual(user.phone_hash,
+                         User.hash_phone_number('+44', '7000000000'))
+        user.country_code = '+33'
+        user.save()
+        self.assertEqual(User.objects.get(pk=user.pk).phone_hash,
+                         User.hash_phone_number('+33', '7000000000'))
+
+    def test_registered_phone_numbers_in_chunks(self):
+        numbers = [('+44', f'700000000{i}') for i in range(8)]
+        # same number, other country
+        numbers.append(('+33', '7000000001'))
+        with self.assertNumQueries(5):
+            registered = User.registered_phone_numbers(numbers, chunk_size=2)
+        self.assertEqual(registered, set(numbers[:5]))
+
+    def test_registered_phone_numbers_use_the_composite_index(self):
+        with self.assertNumQueries(1) as queries:
+            User.registered_phone_numbers([('+44', '7000000001'),
+                                           ('+33', '7000000002')])
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('(country_code=? AND phone_number=?)', plan)
+
+    def test_registered_phone_hashes(self):
+        hashes = [User.hash_phone_number('+44', f'700000000{i}')
+                  for i in range(8)]
+        with self.assertNumQueries(3):
+            registered = User.registered_phone_hashes(hashes, chunk_size=3)
+        self.assertEqual(registered, set(hashes[:5]))
+
+
+class BackfillPhoneHashesTests(TestCase):
+    def test_sets_missing_and_stale_hashes(self):
+        users = [create_user(f'700000000{i}') for i in range(5)]
+        User.objects.filter(pk__in=[users[0].pk, users[3].pk]) \
+            .update(phone_hash='')
+        User.objects.filter(pk=users[4].pk).update(country_code='+33')
+        stdout = StringIO()
+        call_command('backfill_phone_hashes', batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'updated 3 phone hashes\n')
+        hashes = [User.hash_phone_number('+44', '7000000000'),
+                  User.hash_phone_number('+44', '7000000003'),
+                  User.hash_phone_number('+33', '7000000004')]
+        self.assertEqual(User.registered_phone_hashes(hashes), set(hashes))
+
+
+class ContactsVerificationViewTests(TestCase):
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+
+    def check(self, **fields):
+        return self.client.post('/check-contacts/', {
+            'access_token': self.alice.access_token, **fields
+        }, content_type='application/json')
+
+    def test_only_registered_contacts_are_returned(self):
+        response = self.check(phone_numbers=[
+            number('7000000001'), number('7000000002'),
+            number('7000000003'), number('7000000002', '+33'), 'garbage',
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['phone_numbers'],
+                         [number('7000000002')])
+        # kept for the presence frames
+        self.assertEqual(Contact.of(self.alice),
+                         [(self.bob.pk, '+44', '7000000002', None)])
+
+    def test_hashed_contacts(self):
+        hashes = [User.hash_phone_number('+44', f'700000000{i}')
+                  for i in range(1, 4)]
+        response = self.check(phone_hashes=hashes)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['phone_hashes'], [hashes[1]])
+
+    def test_contacts_are_required(self):
+        self.assertEqual(self.check(phone_numbers=[]).status_code, 406)
+
+    def test_contacts_must_be_lists(self):
+        for fields in ({'phone_numbers': 5}, {'phone_numbers': 'garbage'},
+                       {'phone_numbers': number('7000000002')},
+                       {'phone_hashes': 5}, {'phone_hashes': 'a' * 64}):
+            with self.subTest(fields=fields):
+                self.assertEqual(self.check(**fields).status_code, 406)
+
+    def test_rejects_malformed_tokens(self):
+        response = self.client.post('/check-contacts/', {
+            'access_token': 'garbage', 'phone_numbers': [number('7000000002')]
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
@@ -0,0 +1,58 @@
+from django.test import SimpleTestCase
+from main.events import EVENTS
+from main.events import validate_event
+
+ADDRESS = {
+    'sender_country_code': '+44',
+    'sender_phone_number': '7000000001',
+    'receiver_country_code': '+44',
+    'receiver_phone_number': '7000000002',
+}
+
+
+class ValidateEventTests(SimpleTestCase):
+    def test_builds_the_frame_from_the_spec(self):
+        spec, frame = validate_event({
+            'type': 'private_message', **ADDRESS, 'message': 'hello',
+            'hash': 'h1', 'timestamp': '1', 'extra': 'dropped',
+        })
+        self.assertIs(spec, EVENTS['private_message'])
+        self.assertEqual(frame, {'type': 'private_message', **ADDRESS,
+                                 'message': 'hello', 'hash': 'h1',
+                                 'timestamp': '1'})
+
+    def test_rejects_unknown_and_malformed_events(self):
+        for data in (
+            None, [], 'private_message', {'type': 'nope', **ADDRESS},
+            # not hashable
+            {'type': ['private_message'], **ADDRESS},
+            {'type': {'private_message': 1}, **ADDRESS},
+            # missing field
+            {'type': 'delete_private_message', **ADDRESS},
+            # not a phone number
+            {'type': 'delete_private_message', **ADDRESS, 'hash': 'h1',
+             'sender_phone_number': '7000 0000'},
+            {'type': 'delete_private_message', **ADDRESS, 'hash': 'h1',
+             'receiver_country_code': 44},
+            {'type': 'image_message', **ADDRESS, 'hash': 'h1',
+             'timestamp': '1', 'blob': 'not a digest'},
+        ):
+            with self.subTest(data=data):
+                self.assertIsNone(validate_event(data))
+
+    def test_image_message_needs_a_digest(self):
+        self.assertIsNotNone(validate_event({
+            'type': 'image_message', **ADDRESS, 'hash': 'h1',
+            'timestamp': '1', 'blob': 'a' * 64,
+        }))
+
+    def test_message_fields_fit_their_columns(self):
+        message = {'type': 'private_message', **ADDRESS, 'message': 'x',
+                   'hash': 'h1', 'timestamp': '1'}
+        for fields in ({'message': 'x' * 251}, {'message': ['x']},
+                       {'hash': 1}, {'hash': 'h' * 129}, {'timestamp': 1},
+                       {'timestamp': ''}):
+            with self.subTest(fields=fields):
+                self.assertIsNone(validate_event({**message, **fields}))
+        self.assertIsNotNone(validate_event({**message,
+                                             'message': 'x' * 250}))
@@ -0,0 +1,132 @@
+import gzip
+import json
+from channels.testing import HttpCommunicator
+from django.test import TransactionTestCase
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from chat.asgi import application
+from main.models import Message
+from .helpers import create_user
+
+
+def lines(content: bytes) -> list[dict]:
+    return [json.loads(line) for line in content.decode().splitlines()]
+
+
+@override_settings(MESSAGE_EXPORT_CHUNK_SIZE=2)
+class ExportViewTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        self.carol = create_user('7000000003')
+        for i in range(5):
+            sender, recipient = (self.alice, self.bob) if i % 2 \
+                else (self.bob, self.alice)
+            Message.objects.create(sender=sender, recipient=recipient,
+                                   content=f'message {i}', hash=f'h{i}',
+                                   timestamp='1')
+        Message.objects.create(sender=self.alice, recipient=self.bob,
+                               content='gone', hash='gone', timestamp='1',
+                               deleted=True)
+        Message.objects.create(sender=self.bob, recipient=self.carol,
+                               content='other', hash='other', timestamp='1')
+
+    def export(self, caller, **params):
+        return self.client.get('/export/', params,
+                               HTTP_AUTHORIZATION=f'Bearer '
+                                                  f'{caller.access_token}')
+
+    def test_every_message_oldest_first(self):
+        response = self.export(self.alice)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        exported = lines(b''.join(response.streaming_content))
+        self.assertEqual([line['hash'] for line in exported],
+                         [f'h{i}' for i in range(5)])
+        self.assertEqual(exported[0]['sender_phone_number'], '7000000002')
+        self.assertFalse(exported[0]['read'])
+
+    def test_resumes_after_the_cursor(self):
+        first = lines(b''.join(self.export(self.alice).streaming_content))
+        response = self.export(self.alice, cursor=first[2]['id'])
+        self.assertEqual([line['hash'] for line in
+                          lines(b''.join(response.streaming_content))],
+                         ['h3', 'h4'])
+
+    def test_gzip(self):
+        response = self.client.get(
+            '/export/', HTTP_AUTHORIZATION=f'Bearer {self.alice.access_token}',
+            HTTP_ACCEPT_ENCODING='gzip, deflate'
+        )
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.decompress(b''.join(response.streaming_content))
+        self.assertEqual(len(lines(content)), 5)
+
+    def test_other_users_are_for_staff_only(self):
+        self.assertEqual(self.export(self.alice, user=self.carol.pk)
+                         .status_code, 403)
+        self.alice.is_staff = True
+        self.alice.save()
+        response = self.export(self.alice, user=self.carol.pk)
+        self.assertEqual([line['hash'] for line in
+                          lines(b''.join(response.streaming_content))],
+                         ['other'])
+        self.assertEqual(self.export(self.alice, user=9999).status_code, 404)
+
+    def test_rejects_anonymous_users_and_bad_cursors(self):
+        self.assertEqual(self.client.get('/export/').status_code, 401)
+        self.assertEqual(self.export(self.alice, cursor='-1').status_code,
+                         406)
+        # too large for an SQLite INTEGER
+        self.alice.is_staff = True
+        self.alice.save()
+        for params in ({'cursor': '99999999999999999999'},
+                       {'user': '99999999999999999999'},
+                       {'cursor': str(2 ** 63)}):
+            self.assertEqual(self.export(self.alice, **params).status_code,
+                             406)
+        response = self.export(self.alice, cursor=str(2 ** 63 - 1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_rejects_superseded_tokens(self):
+        access_token = str(RefreshToken.for_user(self.alice).access_token)
+        response = self.client.get('/export/',
+                                   HTTP_AUTHORIZATION=f'Bearer {access_token}')
+        self.assertEqual(response.status_code, 401)
+
+
+class ASGIStreamingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        bob = create_user('7000000002')
+        for i in range(3):
+            Message.objects.create(sender=self.alice, recipient=bob,
+                                   content=f'message {i}', hash=f'h{i}',
+                                   timestamp='1')
+
+    @override_settings(MESSAGE_EXPORT_CHUNK_SIZE=1)
+    async def test_pages_are_fetched_off_the_event_loop(self):
+        communicator = HttpCommunicator(
+            application, 'GET', '/export/',
+            headers=[(b'host', b'testserver'),
+                     (b'authorization',
+                      f'Bearer {self.alice.access_token}'.encode())]
+        )
+        await communicator.send_input({'type': 'http.request'})
+        start = await communicator.receive_output()
+        self.assertEqual(start['status'], 200)
+        parts = []
+        while True:
+            message = await communicator.receive_output()
+            parts.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        # one page per part
+        self.assertEqual([line['hash'] for line in lines(b''.join(parts))],
+                         ['h0', 'h1', 'h2'])
+        self.assertEqual(len(parts), 4)
@@ -0,0 +1,52 @@
+import json
+import msgpack
+from django.test import SimpleTestCase
+from main.frames import MSGPACK_SUBPROTOCOL
+from main.frames import json_codec
+from main.frames import msgpack_codec
+from main.frames import select_codec
+
+EVENT = {
+    'type': 'private_message',
+    'sender_country_code': '+44',
+    'sender_phone_number': '7000000001',
+    'receiver_country_code': '+44',
+    'receiver_phone_number': '7000000002',
+    'message': 'hello',
+    'hash': 'h1',
+    'timestamp': '1',
+}
+
+
+class CodecTests(SimpleTestCase):
+    def test_select_codec(self):
+        self.assertIs(select_codec([]), json_codec)
+        self.assertIs(select_codec(['other', MSGPACK_SUBPROTOCOL]),
+                      msgpack_codec)
+
+    def test_json_roundtrip(self):
+        frame = json_codec.encode(EVENT)
+        self.assertEqual(json.loads(frame['text_data']), EVENT)
+        self.assertEqual(json_codec.decode(frame['text_data'], None), EVENT)
+
+    def test_msgpack_uses_short_keys(self):
+        frame = msgpack_codec.encode(EVENT)
+        packed = msgpack.unpackb(frame['bytes_data'], raw=False)
+        self.assertEqual(packed['sc'], '+44')
+        self.assertEqual(packed['m'], 'hello')
+        self.assertNotIn('message', packed)
+        self.assertLess(len(frame['bytes_data']), len(json.dumps(EVENT)))
+        self.assertEqual(msgpack_codec.decode(None, frame['bytes_data']),
+                         EVENT)
+
+    def test_msgpack_keeps_unknown_keys(self):
+        frame = msgpack_codec.encode({**EVENT, 'extra': 1})
+        self.assertEqual(msgpack_codec.decode(None, frame['bytes_data']),
+                         {**EVENT, 'extra': 1})
+
+    def test_msgpack_socket_accepts_json_text(self):
+        self.assertEqual(msgpack_codec.decode(json.dumps(EVENT), None), EVENT)
+
+    def test_msgpack_frame_must_be_a_map(self):
+        with self.assertRaises(ValueError):
+            msgpack_codec.decode(None, msgpack.packb([1, 2]))
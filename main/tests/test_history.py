@@ -0,0 +1,106 @@
+from datetime import timedelta
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+from main.models import Message
+from main.models import User
+from main.shards import shard_for
+from .helpers import create_user
+
+
+class HistoryTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        self.carol = create_user('7000000003')
+        now = timezone.now()
+        for i in range(7):
+            sender, recipient = (self.alice, self.bob) if i % 2 \
+                else (self.bob, self.alice)
+            # pairs of messages sent in the same microsecond
+            Message.objects.create(
+                sender=sender, recipient=recipient, content=f'message {i}',
+                hash=f'h{i}', timestamp='1',
+                creation_date=now + timedelta(seconds=i // 2),
+            )
+        Message.objects.create(sender=self.alice, recipient=self.carol,
+                               content='other', hash='other', timestamp='1')
+
+    def history(self, user, other, **fields):
+        return self.client.post('/history/', {
+            'access_token': user.access_token,
+            'country_code': other.country_code,
+            'phone_number': other.phone_number,
+            **fields,
+        }, content_type='application/json')
+
+    def test_conversation_key_is_symmetric(self):
+        self.assertEqual(Message.conversation_key(2, 10),
+                         Message.conversation_key(10, 2))
+
+    def test_pages_newest_first_across_ties(self):
+        hashes, cursor = [], None
+        for page in range(4):
+            response = self.history(self.bob, self.alice, limit=2,
+                                    **({'cursor': cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            hashes += [event['hash'] for event in response.data['messages']]
+            cursor = response.data['cursor']
+            if not response.data['has_more']:
+                break
+        self.assertEqual(hashes, [f'h{i}' for i in reversed(range(7))])
+
+    def test_deleted_messages_are_left_out(self):
+        Message.objects.using(shard_for(
+            Message.conversation_key(self.alice.pk, self.bob.pk)
+        )).filter(hash='h6').update(deleted=True)
+        response = self.history(self.alice, self.bob, limit=1)
+        self.assertEqual(response.data['messages'][0]['hash'], 'h5')
+
+    def test_one_index_range_per_page(self):
+        shard = shard_for(Message.conversation_key(self.alice.pk,
+                                                   self.bob.pk))
+        with self.assertNumQueries(1, using=shard):
+            Message.history(self.alice, self.bob, limit=3)
+
+    def test_rejects_bad_cursors_and_numbers(self):
+        self.assertEqual(self.history(self.alice, self.bob,
+                                      cursor='nope').status_code, 406)
+        self.assertEqual(self.history(self.alice, self.bob,
+                                      limit='2').status_code, 406)
+        # fields too large for a datetime or an SQLite INTEGER
+        for cursor in ('99999999999999999999.1', '1.99999999999999999999',
+                       f'1.{2 ** 63}'):
+            self.assertEqual(self.history(self.alice, self.bob,
+                                          cursor=cursor).status_code, 406)
+        self.assertEqual(self.history(self.alice, self.bob,
+                                      cursor=f'1.{2 ** 63 - 1}').status_code,
+                         200)
+        response = self.client.post('/history/', {
+            'access_token': self.alice.access_token,
+            'country_code': '44', 'phone_number': '7000000002',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 406)
+
+    def test_unknown_user(self):
+        stranger = User(country_code='+44', phone_number='7000000009')
+        self.assertEqual(self.history(self.alice, stranger).status_code,
+                         404)
+
+    def test_rejects_malformed_and_superseded_tokens(self):
+        response = self.client.post('/history/', {
+            'access_token': 'garbage', 'country_code': '+44',
+            'phone_number': '7000000002',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.history(self.alice, self.bob,
+                                      country_code=44).status_code, 406)
+        old = User(pk=self.alice.pk, access_token=self.alice.access_token)
+        self.alice.access_token = str(
+            RefreshToken.for_user(self.alice).access_token
+        )
+        self.alice.save()
+        # only the latest token is accepted
+        self.assertEqual(self.history(old, self.bob).status_code, 401)
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import unittest
+from channels.exceptions import ChannelFull
+from django.test import SimpleTestCase
+from main.layers import HybridChannelLayer
+
+# e.g. 127.0.0.1, the tests that go through Redis are skipped without it
+REDIS_HOST = os.environ.get('TEST_REDIS_HOST')
+
+
+def make_layer(**config) -> HybridChannelLayer:
+    return HybridChannelLayer(hosts=[(REDIS_HOST or '127.0.0.1', 6379)],
+                              **config)
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    async def test_local_send_skips_redis(self):
+        layer = make_layer()
+        channel = await layer.new_channel()
+        message = {'type': 'relay', 'text': 'hello'}
+        await layer.send(channel, message)
+        received = await asyncio.wait_for(layer.receive(channel), 1)
+        self.assertEqual(received, message)
+        # a copy, like a message that went through Redis
+        self.assertIsNot(received, message)
+        self.assertEqual(layer.remote, {})
+
+    async def test_send_to_closed_channel_is_dropped(self):
+        layer = make_layer()
+        channel = await layer.new_channel()
+        layer.close(channel)
+        self.assertTrue(layer.is_closed(channel))
+        # returns without connecting to Redis
+        await asyncio.wait_for(layer.send(channel, {'type': 'relay'}), 1)
+        self.assertNotIn(channel, layer.local)
+
+    async def test_full_local_channel(self):
+        layer = make_layer(capacity=1)
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'relay'})
+        with self.assertRaises(ChannelFull):
+            await layer.send(channel, {'type': 'relay'})
+
+    def test_compression_roundtrip(self):
+        layer = make_layer(compression_threshold=100)
+        small = {'type': 'relay', 'text': 'hello'}
+        large = {'type': 'relay', 'text': 'hello ' * 1000}
+        self.assertEqual(layer.deserialize(layer.serialize(small)), small)
+        stored = layer.serialize(large)
+        self.assertEqual(stored[12:13], b'\x00')
+        self.assertLess(len(stored), 1000)
+        self.assertEqual(layer.deserialize(stored), large)
+
+    def test_compression_disabled(self):
+        layer = make_layer(compression_threshold=None)
+        large = {'type': 'relay', 'text': 'hello ' * 1000}
+        stored = layer.serialize(large)
+        self.assertGreater(len(stored), 6000)
+        self.assertEqual(layer.deserialize(stored), large)
+
+
+@unittest.skipUnless(REDIS_HOST, 'TEST_REDIS_HOST is not set')
+class HybridChannelLayerRedisTests(SimpleTestCase):
+    async def start_workers(self):
+        # two workers sharing Redis
+        self.here = make_layer()
+        self.there = make_layer()
+        await self.here.flush()
+
+    async def stop_workers(self):
+        await self.here.flush()
+        await self.here.close_pools()
+        await self.there.close_pools()
+
+    async def test_send_to_another_worker(self):
+        await self.start_workers()
+        try:
+            channel = await self.here.new_channel()
+            await self.there.send(channel, {'type': 'relay', 'text': 'x'})
+            received = await asyncio.wait_for(self.here.receive(channel), 5)
+            self.assertEqual(received['text'], 'x')
+        finally:
+            await self.stop_workers()
+
+    async def test_group_send_to_local_and_remote_members(self):
+        await self.start_workers()
+        try:
+            local = await self.here.new_channel()
+            remote = await self.there.new_channel()
+            await self.here.group_add('members', local)
+            await self.here.group_add('members', remote)
+            await self.here.group_send('members', {'type': 'relay',
+                                                   'text': 'x' * 2000})
+            for layer, channel in ((self.here, local),
+                                   (self.there, remote)):
+                received = await asyncio.wait_for(layer.receive(channel), 5)
+                self.assertEqual(received['text'], 'x' * 2000)
+        finally:
+            await self.stop_workers()
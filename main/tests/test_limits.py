@@ -0,0 +1,31 @@
+from unittest import mock
+from django.test import SimpleTestCase
+from main.limits import RateLimiter
+from main.limits import TokenBucket
+
+
+class TokenBucketTests(SimpleTestCase):
+    @mock.patch('main.limits.time.monotonic')
+    def test_bursts_then_refills_at_the_rate(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)],
+                         [True, True, True, False])
+        monotonic.return_value = 100.5
+        self.assertEqual([bucket.take() for _ in range(2)], [True, False])
+        # never more than the burst
+        monotonic.return_value = 200.0
+        self.assertEqual([bucket.take() for _ in range(4)],
+                         [True, True, True, False])
+
+
+class RateLimiterTests(SimpleTestCase):
+    @mock.patch('main.limits.time.monotonic', return_value=100.0)
+    def test_limits_frames_and_single_event_types(self, monotonic):
+        limiter = RateLimiter((1, 3), {'image_message': (1, 1)})
+        self.assertTrue(limiter.allow_event('image_message'))
+        self.assertFalse(limiter.allow_event('image_message'))
+        # other types only count as frames
+        self.assertTrue(limiter.allow_event('private_message'))
+        self.assertEqual([limiter.allow_frame() for _ in range(4)],
+                         [True, True, True, False])
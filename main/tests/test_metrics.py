@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.test import SimpleTestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from main.metrics import Counter
+from main.metrics import Histogram
+from main.metrics import SYNC_CALL_QUERIES
+from main.metrics import registry
+from main.metrics import sync_to_async
+from main.models import Message
+from main.shards import fan_out
+from .helpers import create_user
+
+
+class MetricTests(SimpleTestCase):
+    def metric(self, metric):
+        self.addCleanup(registry.remove, metric)
+        return metric
+
+    def test_counter(self):
+        counter = self.metric(Counter('test_total', 'Test', ('kind',)))
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b')
+        self.assertEqual(counter.render(), '\n'.join([
+            '# HELP test_total Test',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3',
+            'test_total{kind="b"} 1',
+        ]))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.metric(Histogram('test_seconds', 'Test',
+                                          buckets=(1, 5)))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.samples(), [
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="5"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 14.5',
+            'test_seconds_count 4',
+        ])
+
+
+class QueryCountTests(TransactionTestCase):
+    databases = '__all__'
+
+    async def test_counts_the_queries_of_every_shard(self):
+        @sync_to_async
+        def count_messages():
+            return fan_out(lambda shard: Message.objects.using(shard)
+                           .count())
+
+        await count_messages()
+        self.assertIn(
+            f'chat_sync_to_async_db_queries_sum{{function='
+            f'"{count_messages.__qualname__}"}} '
+            f'{float(len(settings.MESSAGE_SHARDS))}',
+            SYNC_CALL_QUERIES.samples()
+        )
+
+
+class MetricsViewTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_counts_requests_and_queries(self):
+        user = create_user('7000000001')
+        self.client.post('/sync/', {'access_token': user.access_token},
+                         content_type='application/json')
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('chat_http_requests_total{view="SyncView",'
+                      'method="POST",status="200"}', text)
+        self.assertIn('chat_http_request_db_queries_bucket{view="SyncView"',
+                      text)
+
+    @override_settings(METRICS={'ALLOWED_NETWORKS': ['10.0.0.0/8'],
+                                'TOKEN': 'secret'})
+    def test_scrapes_from_allowed_networks_or_with_the_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/',
+                                         REMOTE_ADDR='10.1.2.3').status_code,
+                         200)
+        self.assertEqual(self.client.get(
+            '/metrics/', HTTP_AUTHORIZATION='Bearer secret'
+        ).status_code, 200)
+        self.assertEqual(self.client.get(
+            '/metrics/', HTTP_AUTHORIZATION='Bearer nope'
+        ).status_code, 403)
@@ -0,0 +1,75 @@
+import asyncio
+import json
+from django.test import SimpleTestCase
+from main.outbound import OutboundQueue
+
+
+def receipt(*hashes: str) -> str:
+    return json.dumps({'type': 'message_read', 'hashes': list(hashes),
+                       'until': None})
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.evicted = []
+        # set to hold the client back
+        self.blocked = asyncio.Event()
+
+    async def send(self, text: str) -> None:
+        while self.blocked.is_set():
+            await asyncio.sleep(0.01)
+        self.sent.append(text)
+
+    async def evict(self, reason: str) -> None:
+        self.evicted.append(reason)
+
+    async def test_sends_frames_in_order(self):
+        queue = OutboundQueue(self.send, self.evict)
+        for text in ('a', 'b', 'c'):
+            await queue.put(text)
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, ['a', 'b', 'c'])
+        self.assertIsNone(queue.task)
+
+    async def test_merges_receipts_of_a_backed_up_client(self):
+        self.blocked.set()
+        queue = OutboundQueue(self.send, self.evict)
+        await queue.put('a')
+        await asyncio.sleep(0)
+        await queue.put(receipt('h1'), 'message_read:+447000000001')
+        await queue.put(receipt('h2', 'h1'), 'message_read:+447000000001')
+        await queue.put(receipt('h9'), 'message_read:+447000000009')
+        self.assertEqual(len(queue.frames), 2)
+        self.blocked.clear()
+        await asyncio.sleep(0.05)
+        self.assertEqual([json.loads(text)['hashes']
+                          for text in self.sent[1:]], [['h1', 'h2'], ['h9']])
+        queue.close()
+
+    async def test_full_queue_drops_receipts_and_evicts_on_frames(self):
+        self.blocked.set()
+        queue = OutboundQueue(self.send, self.evict, max_size=2)
+        await queue.put('a')
+        await asyncio.sleep(0)
+        await queue.put('b')
+        await queue.put('c')
+        await queue.put(receipt('h1'), 'message_read:+447000000001')
+        self.assertEqual(self.evicted, [])
+        await queue.put('d')
+        self.assertEqual(self.evicted, ['overflow'])
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue.frames), 0)
+        # closed for good
+        await queue.put('e')
+        self.assertEqual(self.evicted, ['overflow'])
+
+    async def test_evicts_a_stalled_client(self):
+        self.blocked.set()
+        queue = OutboundQueue(self.send, self.evict, slow_timeout=0.05)
+        await queue.put('a')
+        await queue.put('b')
+        await asyncio.sleep(0.1)
+        await queue.put('c')
+        self.assertEqual(self.evicted, ['stalled'])
+        self.assertEqual(self.sent, [])
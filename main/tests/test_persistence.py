@@ -0,0 +1,216 @@
+import asyncio
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.db import OperationalError
+from django.test import TransactionTestCase
+from main.models import Message
+from main.models import MessageSequence
+from main.persistence import MessageWriter
+from main.shards import fan_out
+from main.shards import shard_for
+from .helpers import create_user
+from .helpers import message_entry
+
+
+@sync_to_async
+def all_messages() -> list[Message]:
+    return sorted((message for messages in fan_out(
+        lambda shard: list(Message.objects.using(shard).all())
+    ) for message in messages), key=lambda message: message.id)
+
+
+class MessageWriterTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.users = [create_user(f'700000000{i}') for i in range(4)]
+        self.writer = MessageWriter(batch_size=100, flush_interval=0.01)
+
+    async def test_saves_buffered_messages(self):
+        sender = self.users[0]
+        for i, recipient in enumerate(self.users[1:] * 3):
+            await self.writer.put(message_entry(sender, recipient, f'h{i}'))
+        await self.writer.flush()
+        messages = await all_messages()
+        self.assertEqual([message.hash for message in messages],
+                         [f'h{i}' for i in range(9)])
+        self.assertEqual(messages[0].sender_id, sender.pk)
+        self.assertEqual(messages[0].recipient_id, self.users[1].pk)
+        self.assertEqual(messages[0].content, 'message h0')
+
+    async def test_flushes_after_the_interval(self):
+        await self.writer.put(message_entry(self.users[0], self.users[1],
+                                            'h1'))
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(await all_messages()), 1)
+
+    async def test_flushes_a_full_batch(self):
+        writer = MessageWriter(batch_size=2, flush_interval=60)
+        saved = []
+
+        async def save(batch):
+            saved.append(len(batch))
+
+        with mock.patch.object(writer, 'save', save):
+            for i in range(5):
+                await writer.put(message_entry(self.users[0], self.users[1],
+                                               f'h{i}'))
+            await asyncio.sleep(0.05)
+            # without waiting for the interval
+            self.assertEqual(sum(saved), 5)
+            writer.task.cancel()
+
+    async def test_skips_unknown_recipients(self):
+        stranger = await sync_to_async(create_user)('7000000099')
+        await sync_to_async(stranger.delete)()
+        await self.writer.put(message_entry(self.users[0], stranger, 'h1'))
+        await self.writer.put(message_entry(self.users[0], self.users[1],
+                                            'h2'))
+        await self.writer.flush()
+        self.assertEqual([message.hash for message in await all_messages()],
+                         ['h2'])
+
+    async def test_retries_failed_batches(self):
+        calls = []
+        save = MessageWriter.save
+
+        async def flaky(batch):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            await save(batch)
+
+        await self.writer.put(message_entry(self.users[0], self.users[1],
+                                            'h1'))
+        with mock.patch.object(MessageWriter, 'save', staticmethod(flaky)), \
+                self.assertLogs('main.persistence', 'ERROR'):
+            await self.writer.flush()
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(len(await all_messages()), 1)
+
+    async def test_deletes_follow_the_message(self):
+        sender, recipient = self.users[0], self.users[1]
+        await self.writer.put(message_entry(sender, recipient, 'h1'))
+        await self.writer.put(message_entry(sender, recipient, 'h2'))
+        await self.writer.put({
+            'delete': True,
+            'sender_id': sender.pk,
+            'receiver_country_code': recipient.country_code,
+            'receiver_phone_number': recipient.phone_number,
+            'hash': 'h1',
+        })
+        await self.writer.flush()
+        self.assertEqual([(message.hash, message.deleted)
+                          for message in await all_messages()],
+                         [('h1', True), ('h2', False)])
+
+    async def test_drops_invalid_entries_before_queueing(self):
+        with self.assertLogs('main.persistence', 'ERROR') as logs:
+            await self.writer.put(message_entry(
+                self.users[0], self.users[1], 'h1', message=None
+            ))
+            await self.writer.put(message_entry(
+                self.users[0], self.users[1], ['h2']
+            ))
+        self.assertEqual(len(logs.output), 2)
+        self.assertIsNone(self.writer.queue)
+
+    async def test_rejected_entry_does_not_block_the_others(self):
+        save = MessageWriter.save
+
+        async def strict(batch):
+            if any(entry['hash'] == 'bad' for entry in batch):
+                raise IntegrityError('NOT NULL constraint failed')
+            return await save(batch)
+
+        await self.writer.put(message_entry(self.users[0], self.users[1],
+                                            'bad'))
+        await self.writer.put(message_entry(self.users[0], self.users[1],
+                                            'good'))
+        with mock.patch.object(MessageWriter, 'save', staticmethod(strict)), \
+                self.assertLogs('main.persistence', 'ERROR') as logs:
+            await asyncio.wait_for(self.writer.flush(), 5)
+        self.assertIn('bad', logs.output[-1])
+        self.assertEqual([message.hash for message in await all_messages()],
+                         ['good'])
+
+    async def test_not_null_failures_are_not_ignored(self):
+        self.writer.start()
+        # past the validation of put(), rejected by the database
+        await self.writer.queue.put(message_entry(
+            self.users[0], self.users[1], 'bad', message=None
+        ))
+        await self.writer.put(message_entry(self.users[0], self.users[1],
+                                            'good'))
+        with self.assertLogs('main.persistence', 'ERROR') as logs:
+            await asyncio.wait_for(self.writer.flush(), 5)
+        self.assertIn('bad', logs.output[-1])
+        self.assertEqual([message.hash for message in await all_messages()],
+                         ['good'])
+
+    async def test_tracks_the_hashes_still_buffered(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60)
+        for hash in ('h1', 'h2', 'h2'):
+            await writer.put(message_entry(self.users[0], self.users[1],
+                                           hash))
+        self.assertTrue(writer.is_pending(['h0', 'h2']))
+        self.assertFalse(writer.is_pending(['h0', 'h3']))
+        await writer.flush()
+        self.assertFalse(writer.is_pending(['h1', 'h2']))
+        writer.task.cancel()
+
+    async def test_tracks_the_recipients_still_buffered(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60)
+        for recipient in self.users[1:3]:
+            await writer.put(message_entry(self.users[0], recipient, 'h1'))
+        await writer.put({'delete': True, **message_entry(
+            self.users[0], self.users[3], 'h1'
+        )})
+        for user, pending in zip(self.users, (False, True, True, False)):
+            self.assertEqual(writer.is_pending_for(user.country_code,
+                                                   user.phone_number),
+                             pending)
+        await writer.flush()
+        self.assertFalse(writer.is_pending_for(self.users[1].country_code,
+                                               self.users[1].phone_number))
+        writer.task.cancel()
+
+    async def test_saving_a_batch_again_inserts_nothing_twice(self):
+        batch = [message_entry(self.users[0], recipient, f'h{i}')
+                 for i, recipient in enumerate(self.users[1:])]
+        await MessageWriter.save(batch)
+        await MessageWriter.save(batch)
+        self.assertEqual(len(await all_messages()), 3)
+
+
+class MessageSequenceTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_reserves_consecutive_blocks(self):
+        first = MessageSequence.reserve(3)
+        second = MessageSequence.reserve(2)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(second.start, first.stop)
+
+    def test_starts_after_the_messages_saved_before(self):
+        sender, recipient = create_user('7000000001'), \
+            create_user('7000000002')
+        Message.objects.using('messages-2').create(
+            id=41, sender=sender, recipient=recipient, conversation='x',
+            content='', hash='h', timestamp='1'
+        )
+        self.assertEqual(MessageSequence.reserve(1).start, 42)
+
+    def test_message_save_takes_an_id_on_its_shard(self):
+        sender, recipient = create_user('7000000001'), \
+            create_user('7000000002')
+        messages = [Message(sender=sender, recipient=recipient, content='hi',
+                            hash=f'h{i}', timestamp='1') for i in range(2)]
+        for message in messages:
+            message.save()
+        self.assertEqual(messages[1].id, messages[0].id + 1)
+        shard = shard_for(Message.conversation_key(sender.pk, recipient.pk))
+        self.assertEqual({message._state.db for message in messages},
+                         {shard})
+        self.assertEqual(Message.objects.using(shard).count(), 2)
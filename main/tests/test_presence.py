@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from chat.asgi import application
+from main.models import Contact
+from main.models import User
+from main.persistence import message_writer
+from main.presence import presence
+from main.routing_table import routing_table
+from .helpers import create_user
+
+
+class PresenceTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        Contact.objects.create(owner=self.alice, contact=self.bob)
+        # the workers of the previous test ran on another event loop
+        routing_table.__init__()
+        presence.__init__(window=0.02, debounce=0.2, flush_interval=60,
+                          heartbeat_timeout=0.1)
+
+    async def connect(self, user) -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(
+            application, '/ws/user/',
+            headers=[(b'authorization',
+                      f'Bearer {user.access_token}'.encode())]
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def stop(self, *communicators: WebsocketCommunicator) -> None:
+        for communicator in communicators:
+            await communicator.disconnect()
+        for task in (routing_table.listener, routing_table.refresher,
+                     presence.task, message_writer.task):
+            if task is not None:
+                task.cancel()
+        await asyncio.sleep(0)
+
+    async def presence_of(self, communicator: WebsocketCommunicator
+                          ) -> list[tuple[str, bool]]:
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'presence')
+        return [(user['phone_number'], user['online'])
+                for user in frame['users']]
+
+    async def test_contacts_are_sent_on_connect(self):
+        await get_channel_layer().flush()
+        bob = await self.connect(self.bob)
+        alice = await self.connect(self.alice)
+        try:
+            self.assertEqual(await self.presence_of(alice),
+                             [('7000000002', True)])
+            # bob has no contacts
+            self.assertTrue(await bob.receive_nothing(0.1))
+        finally:
+            await self.stop(alice, bob)
+
+    async def test_changes_are_pushed_to_watchers(self):
+        await get_channel_layer().flush()
+        alice = await self.connect(self.alice)
+        bob = None
+        try:
+            self.assertEqual(await self.presence_of(alice),
+                             [('7000000002', False)])
+            bob = await self.connect(self.bob)
+            self.assertEqual(await self.presence_of(alice),
+                             [('7000000002', True)])
+            # a quick reconnect is not pushed
+            await bob.disconnect()
+            bob = await self.connect(self.bob)
+            self.assertTrue(await alice.receive_nothing(0.3))
+            await bob.disconnect()
+            bob = None
+            self.assertEqual(await self.presence_of(alice),
+                             [('7000000002', False)])
+        finally:
+            await self.stop(alice, *filter(None, [bob]))
+
+    async def test_last_seen_is_written_in_bulk(self):
+        await get_channel_layer().flush()
+        bob = await self.connect(self.bob)
+        try:
+            await presence.flush()
+            last_seen = await sync_to_async(
+                lambda: User.objects.get(pk=self.bob.pk).last_seen
+            )()
+            self.assertEqual(last_seen, presence.last_seen[self.bob.pk])
+        finally:
+            await self.stop(bob)
+
+    async def test_silent_heartbeat_closes_the_socket(self):
+        await get_channel_layer().flush()
+        bob = await self.connect(self.bob)
+        try:
+            await bob.send_json_to({'type': 'heartbeat'})
+            await asyncio.sleep(0.2)
+            await presence.expire()
+            self.assertEqual(await bob.receive_output(),
+                             {'type': 'websocket.close', 'code': 4000})
+        finally:
+            await self.stop()
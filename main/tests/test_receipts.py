@@ -0,0 +1,112 @@
+import asyncio
+from django.test import SimpleTestCase
+from django.test import TestCase
+from main.events import MAX_RECEIPT_HASHES
+from main.models import Message
+from main.receipts import ReceiptBatcher
+from main.shards import shard_for
+from .helpers import create_user
+
+
+def receipt(type: str = 'message_delivered', receiver: str = '7000000001',
+            **fields) -> dict:
+    return {
+        'type': type,
+        'sender_country_code': '+44',
+        'sender_phone_number': '7000000000',
+        'receiver_country_code': '+44',
+        'receiver_phone_number': receiver,
+        **fields,
+    }
+
+
+class ReceiptBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, batch: dict) -> None:
+        self.sent.append(batch)
+
+    async def test_coalesces_receipts_within_the_window(self):
+        batcher = ReceiptBatcher(self.send, window=0.05)
+        await batcher.add(receipt(hash='h1'))
+        await batcher.add(receipt(hashes=['h2', 'h1']))
+        await batcher.add(receipt(until='h3'))
+        await batcher.add(receipt(until='h4'))
+        self.assertEqual(self.sent, [])
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]['hashes'], ['h1', 'h2'])
+        self.assertEqual(self.sent[0]['until'], 'h4')
+        self.assertNotIn('hash', self.sent[0])
+
+    async def test_single_hash_is_also_sent_as_hash(self):
+        batcher = ReceiptBatcher(self.send, window=0.05)
+        await batcher.add(receipt(hash='h1'))
+        await batcher.add(receipt(hash='h1'))
+        await batcher.close()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]['hash'], 'h1')
+        self.assertEqual(self.sent[0]['hashes'], ['h1'])
+        self.assertIsNone(self.sent[0]['until'])
+
+    async def test_keeps_types_and_conversations_apart(self):
+        batcher = ReceiptBatcher(self.send, window=0.05)
+        await batcher.add(receipt(hash='h1'))
+        await batcher.add(receipt('message_read', hash='h1'))
+        await batcher.add(receipt(receiver='7000000002', hash='h2'))
+        await batcher.close()
+        self.assertEqual(
+            sorted((batch['type'], batch['receiver_phone_number'],
+                    batch['hash']) for batch in self.sent),
+            [('message_delivered', '7000000001', 'h1'),
+             ('message_delivered', '7000000002', 'h2'),
+             ('message_read', '7000000001', 'h1')]
+        )
+
+    async def test_sends_a_full_batch_right_away(self):
+        batcher = ReceiptBatcher(self.send, window=60)
+        hashes = [f'h{i}' for i in range(MAX_RECEIPT_HASHES)]
+        await batcher.add(receipt(hashes=hashes[:-1]))
+        self.assertEqual(self.sent, [])
+        await batcher.add(receipt(hash=hashes[-1]))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]['hashes'], hashes)
+        self.assertEqual(batcher.pending, {})
+        await batcher.close()
+        self.assertEqual(len(self.sent), 1)
+
+
+class MarkReceiptsTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        for i in range(5):
+            Message.objects.create(sender=self.alice, recipient=self.bob,
+                                   content='', hash=f'h{i}', timestamp='1')
+        # the other direction is left alone
+        Message.objects.create(sender=self.bob, recipient=self.alice,
+                               content='', hash='h9', timestamp='1')
+        self.shard = shard_for(Message.conversation_key(self.alice.pk,
+                                                        self.bob.pk))
+
+    def flags(self) -> list[tuple[str, bool, bool]]:
+        return list(Message.objects.using(self.shard).order_by('id')
+                    .values_list('hash', 'delivered', 'read'))
+
+    def test_hashes_and_until_in_one_update(self):
+        with self.assertNumQueries(1, using=self.shard):
+            updated = Message.mark_receipts(self.bob, self.alice.pk, ['h4'],
+                                            'h1', read=False)
+        self.assertEqual(updated, 3)
+        self.assertEqual(self.flags(), [
+            ('h0', True, False), ('h1', True, False), ('h2', False, False),
+            ('h3', False, False), ('h4', True, False), ('h9', False, False),
+        ])
+
+    def test_read_implies_delivered(self):
+        Message.mark_receipts(self.bob, self.alice.pk, ['h2'], None,
+                              read=True)
+        self.assertIn(('h2', True, True), self.flags())
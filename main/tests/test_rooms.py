@@ -0,0 +1,162 @@
+import asyncio
+from unittest import mock
+from channels.layers import InMemoryChannelLayer
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase
+from django.test import override_settings
+from chat.asgi import application
+from main.rooms import RoomHistory
+from main.rooms import room_hub
+
+
+class RoomHistoryTests(SimpleTestCase):
+    def test_keeps_the_last_messages_of_a_room(self):
+        history = RoomHistory(size=2)
+        for message in ('"a"', '"b"', '"c"'):
+            self.assertEqual(history.add('chat_lobby', message), [])
+        self.assertEqual(history.get('chat_lobby'), ['"b"', '"c"'])
+        self.assertEqual(history.bytes, 6)
+        self.assertEqual(history.get('chat_other'), [])
+
+    def test_drops_the_least_recently_used_rooms(self):
+        history = RoomHistory(size=10, max_rooms=2)
+        history.add('chat_a', '"a"')
+        history.add('chat_b', '"b"')
+        history.get('chat_a')
+        self.assertEqual(history.add('chat_c', '"c"'), ['chat_b'])
+        self.assertNotIn('chat_b', history)
+        history = RoomHistory(size=10, max_bytes=8)
+        history.add('chat_a', '"aaa"')
+        self.assertEqual(history.add('chat_b', '"bbb"'), ['chat_a'])
+        self.assertEqual(history.bytes, 5)
+
+    def test_size_zero_keeps_nothing(self):
+        history = RoomHistory(size=0)
+        history.add('chat_lobby', '"a"')
+        self.assertNotIn('chat_lobby', history)
+
+
+class RoomTests(SimpleTestCase):
+    def setUp(self):
+        # the hub of the previous test ran on another event loop
+        room_hub.__init__(RoomHistory(size=2))
+
+    async def join(self, room: str) -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{room}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def stop(self, *communicators: WebsocketCommunicator) -> None:
+        for communicator in communicators:
+            await communicator.disconnect()
+        for task in (room_hub.listener, room_hub.refresher):
+            if task is not None:
+                task.cancel()
+        await asyncio.sleep(0)
+
+    async def test_members_of_the_room_get_its_messages(self):
+        channel_layer = get_channel_layer()
+        await channel_layer.flush()
+        first, second = await self.join('lobby'), await self.join('lobby')
+        elsewhere = await self.join('other')
+        try:
+            await first.send_json_to({'message': 'hi'})
+            for member in (first, second):
+                self.assertEqual(await member.receive_json_from(),
+                                 {'message': 'hi'})
+            self.assertTrue(await elsewhere.receive_nothing(0.1))
+            # one group member per worker, not per socket
+            self.assertEqual(list(channel_layer.groups['chat_lobby']),
+                             [room_hub.channel_name])
+        finally:
+            await self.stop(first, second, elsewhere)
+
+    async def test_malformed_frames_are_dropped(self):
+        await get_channel_layer().flush()
+        first, second = await self.join('lobby'), await self.join('lobby')
+        try:
+            await first.send_to(text_data='not json')
+            await first.send_to(bytes_data=b'\x00')
+            await first.send_json_to(['hi'])
+            await first.send_json_to({'text': 'hi'})
+            self.assertTrue(await second.receive_nothing(0.1))
+            await first.send_json_to({'message': 'hi'})
+            self.assertEqual(await second.receive_json_from(),
+                             {'message': 'hi'})
+            await first.disconnect()
+            # disconnect() ran and left the room
+            self.assertEqual(len(room_hub.members['chat_lobby']), 1)
+        finally:
+            await self.stop(second)
+
+    async def test_the_hub_leaves_with_the_last_member(self):
+        channel_layer = get_channel_layer()
+        await channel_layer.flush()
+        first, second = await self.join('lobby'), await self.join('lobby')
+        try:
+            await first.disconnect()
+            self.assertIn('chat_lobby', channel_layer.groups)
+            await second.disconnect()
+            self.assertNotIn('chat_lobby', channel_layer.groups)
+            self.assertEqual(room_hub.members, {})
+        finally:
+            await self.stop()
+
+    async def test_new_members_get_the_recent_messages(self):
+        channel_layer = get_channel_layer()
+        await channel_layer.flush()
+        first = await self.join('lobby')
+        try:
+            for message in ('a', 'b', 'c'):
+                await first.send_json_to({'message': message})
+                await first.receive_json_from()
+            await first.disconnect()
+            # still joined while the history keeps the room
+            self.assertEqual(list(channel_layer.groups['chat_lobby']),
+                             [room_hub.channel_name])
+            second = await self.join('lobby')
+            self.assertEqual(await second.receive_json_from(),
+                             {'messages': ['b', 'c']})
+            await second.send_json_to({'message': 'd'})
+            self.assertEqual(await second.receive_json_from(),
+                             {'message': 'd'})
+        finally:
+            await self.stop(second)
+
+    async def test_rooms_stay_joined_without_new_members(self):
+        channel_layer = InMemoryChannelLayer(group_expiry=1)
+        received = []
+        member = mock.Mock()
+        member.outbound.put = mock.AsyncMock(side_effect=received.append)
+        with mock.patch('main.rooms.get_channel_layer',
+                        return_value=channel_layer), \
+                mock.patch('main.rooms.REJOIN_INTERVAL', 0.2):
+            try:
+                await room_hub.join('chat_lobby', member)
+                # no other socket joins the room meanwhile
+                await asyncio.sleep(2.5)
+                await channel_layer.group_send('chat_lobby', {
+                    'type': 'chat_message',
+                    'room': 'chat_lobby',
+                    'message': 'hi',
+                })
+                await asyncio.sleep(0.05)
+                self.assertEqual(received, ['{"message": "hi"}'])
+            finally:
+                await self.stop()
+
+    @override_settings(CHAT_ROOMS={'FANOUT': 'member'})
+    async def test_every_member_can_join_the_group(self):
+        channel_layer = get_channel_layer()
+        await channel_layer.flush()
+        first, second = await self.join('lobby'), await self.join('lobby')
+        try:
+            await second.send_json_to({'message': 'hi'})
+            for member in (first, second):
+                self.assertEqual(await member.receive_json_from(),
+                                 {'message': 'hi'})
+            self.assertEqual(len(channel_layer.groups['chat_lobby']), 2)
+        finally:
+            await self.stop(first, second)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import asyncio
+from unittest import mock
+from channels.layers import InMemoryChannelLayer
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+from django.test import TestCase
+from main.models import User
+from main.routing_table import RoutingTable
+from main.routing_table import routing_table
+from .helpers import create_user
+
+ALICE = User(pk=1, country_code='+44', phone_number='7000000001')
+
+
+async def stop(*tables: RoutingTable) -> None:
+    # like the worker dying, without removing its devices
+    for table in tables:
+        for task in (table.listener, table.refresher):
+            if task is not None:
+                task.cancel()
+    await asyncio.sleep(0)
+
+
+class RoutingTableTests(SimpleTestCase):
+    async def test_other_workers_see_added_and_removed_devices(self):
+        await get_channel_layer().flush()
+        here, there = RoutingTable(), RoutingTable()
+        await there.start()
+        try:
+            await here.add(ALICE, 'socket-1')
+            await asyncio.sleep(0.01)
+            self.assertTrue(there.is_connected('+44', '7000000001'))
+            self.assertEqual(await there.get('+44', '7000000001'), 1)
+            await here.remove(ALICE, 'socket-1')
+            await asyncio.sleep(0.01)
+            self.assertFalse(there.is_connected('+44', '7000000001'))
+        finally:
+            await stop(here, there)
+
+    async def test_new_worker_syncs_existing_devices(self):
+        await get_channel_layer().flush()
+        here, there = RoutingTable(), RoutingTable()
+        try:
+            await here.add(ALICE, 'socket-1')
+            await there.start()
+            await asyncio.sleep(0.01)
+            self.assertTrue(there.is_connected('+44', '7000000001'))
+        finally:
+            await stop(here, there)
+
+    async def test_devices_of_a_dead_worker_expire(self):
+        await get_channel_layer().flush()
+        here, there = RoutingTable(), RoutingTable()
+        with mock.patch('main.routing_table.ROUTE_TTL', 0.05):
+            await there.start()
+            try:
+                await here.add(ALICE, 'socket-1')
+                await asyncio.sleep(0.01)
+                await stop(here)
+                self.assertTrue(there.is_connected('+44', '7000000001'))
+                await asyncio.sleep(0.1)
+                # not connected even before the next refresh drops it
+                self.assertFalse(there.is_connected('+44', '7000000001'))
+                there.expire()
+                self.assertEqual(there.devices, {})
+            finally:
+                await stop(here, there)
+
+    async def test_refresh_keeps_live_devices(self):
+        await get_channel_layer().flush()
+        here, there = RoutingTable(), RoutingTable()
+        with mock.patch('main.routing_table.ROUTE_TTL', 0.05), \
+                mock.patch('main.routing_table.REFRESH_INTERVAL', 0.02):
+            await there.start()
+            try:
+                await here.add(ALICE, 'socket-1')
+                await asyncio.sleep(0.15)
+                self.assertTrue(there.is_connected('+44', '7000000001'))
+                # its own devices never expire
+                self.assertTrue(here.is_connected('+44', '7000000001'))
+            finally:
+                await stop(here, there)
+
+    async def test_idle_workers_stay_in_the_group(self):
+        channel_layer = InMemoryChannelLayer(group_expiry=1)
+        here, there = RoutingTable(), RoutingTable()
+        with mock.patch('main.routing_table.get_channel_layer',
+                        return_value=channel_layer), \
+                mock.patch('main.routing_table.REJOIN_INTERVAL', 0.2), \
+                mock.patch('main.routing_table.REFRESH_INTERVAL', 0.1):
+            await there.start()
+            try:
+                # no socket connects to `there` meanwhile
+                await asyncio.sleep(2.5)
+                await here.add(ALICE, 'socket-1')
+                await asyncio.sleep(0.01)
+                self.assertTrue(there.is_connected('+44', '7000000001'))
+            finally:
+                await stop(here, there)
+
+    async def test_other_workers_forget_misses_on_route_add(self):
+        await get_channel_layer().flush()
+        here, there = RoutingTable(), RoutingTable()
+        await there.start()
+        try:
+            with mock.patch.object(there, 'load',
+                                   mock.AsyncMock(return_value=None)):
+                self.assertIsNone(await there.get('+44', '7000000001'))
+                await here.add(ALICE, 'socket-1')
+                await asyncio.sleep(0.01)
+                self.assertEqual(await there.get('+44', '7000000001'), 1)
+        finally:
+            await stop(here, there)
+
+
+class UnknownNumberTests(TestCase):
+    def setUp(self):
+        routing_table.__init__()
+        self.load = mock.AsyncMock(return_value=None)
+        patcher = mock.patch.object(routing_table, 'load', self.load)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, phone_number: str) -> int | None:
+        return async_to_sync(routing_table.get)('+44', phone_number)
+
+    def test_misses_are_cached_for_a_while(self):
+        self.assertIsNone(self.get('7000000001'))
+        self.assertIsNone(self.get('7000000001'))
+        self.assertEqual(self.load.call_count, 1)
+        with mock.patch('main.routing_table.MISS_TTL', -1):
+            self.get('7000000002')
+            self.get('7000000002')
+        self.assertEqual(self.load.call_count, 3)
+
+    def test_creating_the_user_ends_the_miss(self):
+        self.get('7000000001')
+        create_user('7000000001')
+        self.get('7000000001')
+        self.assertEqual(self.load.call_count, 2)
@@ -0,0 +1,163 @@
+import sqlite3
+import tempfile
+from contextlib import closing
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connections
+from django.test import TransactionTestCase
+from django.utils import timezone
+from main.archive import message_archive
+from main.models import Message
+from main.persistence import MessageWriter
+from main.search import SEARCH_TABLE
+from main.search import create_search_index
+from main.search import search_terms
+from main.shards import shard_for
+from .helpers import create_user
+from .helpers import message_entry
+
+
+class SearchIndexTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        self.carol = create_user('7000000003')
+        self.hello = self.message(self.alice, self.bob, 'Hello wörld')
+        self.other = self.message(self.carol, self.bob, 'hello carol')
+
+    def message(self, sender, recipient, content: str) -> Message:
+        return Message.objects.create(sender=sender, recipient=recipient,
+                                      content=content, hash=content,
+                                      timestamp='1')
+
+    def ids(self, user, text: str) -> list[int]:
+        return [message.id for message, _ in Message.search(user, text)]
+
+    def test_terms_of_both_participants(self):
+        self.assertEqual(search_terms(1, 2, 'Hi, there'),
+                         'u1xHi u1xthere u2xHi u2xthere')
+        self.assertEqual(search_terms(1, 1, 'note'), 'u1xnote')
+
+    def test_only_the_callers_messages_with_every_word(self):
+        self.assertEqual(self.ids(self.alice, 'hello'), [self.hello.pk])
+        self.assertEqual(sorted(self.ids(self.bob, 'HELLO')),
+                         [self.hello.pk, self.other.pk])
+        # case and diacritics folded
+        self.assertEqual(self.ids(self.bob, 'world hello'), [self.hello.pk])
+        self.assertEqual(self.ids(self.alice, 'hello carol'), [])
+        self.assertEqual(self.ids(self.alice, '" OR *'), [])
+
+    def test_the_index_follows_updates_and_deletes(self):
+        self.hello.content = 'goodbye'
+        self.hello.save()
+        self.assertEqual(self.ids(self.alice, 'hello'), [])
+        self.assertEqual(self.ids(self.alice, 'goodbye'), [self.hello.pk])
+        Message.soft_delete(self.alice.pk, self.bob.pk, ['Hello wörld'])
+        self.assertEqual(self.ids(self.alice, 'goodbye'), [])
+        self.other.delete()
+        self.assertEqual(self.ids(self.bob, 'hello'), [])
+
+    def test_buffered_and_archived_messages(self):
+        async_to_sync(MessageWriter.save)([
+            message_entry(self.alice, self.bob, 'h1', message='lunch')
+        ])
+        self.assertEqual(len(self.ids(self.alice, 'lunch')), 1)
+        root = message_archive.root
+        message_archive.root = Path(tempfile.mkdtemp())
+        try:
+            Message.objects.using(shard_for(self.hello.conversation)) \
+                .update(delivered=True)
+            Message.archive(timezone.now() + timedelta(days=1),
+                            using=shard_for(self.hello.conversation))
+        finally:
+            message_archive.root = root
+            message_archive.indexes.clear()
+        self.assertEqual(self.ids(self.alice, 'lunch'), [])
+        self.assertEqual(self.ids(self.alice, 'hello'), [])
+
+    def test_writes_from_outside_django_are_indexed_on_rebuild(self):
+        shard = self.hello._state.db
+        # like the sqlite3 shell, without any function of Django's
+        with closing(sqlite3.connect(
+            connections[shard].settings_dict['NAME']
+        )) as connection, connection:
+            connection.execute(
+                'INSERT INTO message (id, sender_id, recipient_id, '
+                'conversation, content, hash, timestamp, creation_date, '
+                'delivered, read, deleted) '
+                "VALUES (1000, ?, ?, ?, 'hello outside', 'h', '1', "
+                "'2020-01-01 00:00:00', 0, 0, 0)",
+                (self.alice.pk, self.bob.pk, self.hello.conversation)
+            )
+        self.assertEqual(self.ids(self.alice, 'outside'), [])
+        output = StringIO()
+        call_command('rebuild_search_index', stdout=output)
+        self.assertIn(f'{shard}: indexed', output.getvalue())
+        self.assertEqual(self.ids(self.alice, 'outside'), [1000])
+        self.assertEqual(self.ids(self.alice, 'hello'),
+                         [self.hello.pk, 1000])
+
+    def test_old_triggers_are_dropped_after_migrate(self):
+        shard = self.hello._state.db
+        with connections[shard].cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TRIGGER {SEARCH_TABLE}_insert AFTER INSERT ON message
+                BEGIN SELECT search_terms(1, 2, 'x'); END
+            """)
+        create_search_index(apps.get_app_config('main'), using=shard)
+        later = self.message(self.alice, self.bob, 'hello later')
+        self.assertEqual(self.ids(self.alice, 'later'), [later.pk])
+
+
+class SearchViewTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        for i in range(5):
+            Message.objects.create(sender=self.alice, recipient=self.bob,
+                                   content=f'lunch {"today " * i}',
+                                   hash=f'h{i}', timestamp='1')
+
+    def search(self, **fields):
+        return self.client.post('/search/', {
+            'access_token': self.bob.access_token, **fields
+        }, content_type='application/json')
+
+    def test_pages_by_cursor(self):
+        hashes, cursor = [], None
+        while True:
+            response = self.search(query='lunch', limit=2,
+                                   **({'cursor': cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            hashes += [event['hash'] for event in response.json()['messages']]
+            cursor = response.json()['cursor']
+            if not response.json()['has_more']:
+                break
+        self.assertEqual(sorted(hashes), [f'h{i}' for i in range(5)])
+        self.assertEqual(len(hashes), 5)
+
+    def test_rejects_bad_queries_and_cursors(self):
+        for fields in ({'query': ''}, {'query': 'x' * 257},
+                       {'query': 'lunch', 'cursor': 'nope'},
+                       {'query': 'lunch',
+                        'cursor': '1.0:99999999999999999999'},
+                       {'query': 'lunch', 'cursor': f'1.0:{2 ** 63}'},
+                       {'query': 'lunch', 'cursor': '1e999:1'},
+                       {'query': 'lunch', 'cursor': '-1e999:1'},
+                       {'query': 'lunch', 'limit': '2'},
+                       {'query': 'lunch', 'page': 2}):
+            self.assertEqual(self.search(**fields).status_code, 406)
+
+    def test_rejects_malformed_tokens(self):
+        response = self.client.post('/search/', {
+            'access_token': 'garbage', 'query': 'lunch'
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
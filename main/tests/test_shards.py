@@ -0,0 +1,149 @@
+import asyncio
+from io import StringIO
+from django.core.management import call_command
+from django.db import connections
+from django.test import SimpleTestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from main.models import Message
+from main.models import User
+from main.persistence import MessageWriter
+from main.shards import MessageRouter
+from main.shards import shard_for
+from .helpers import create_user
+from .helpers import message_entry
+
+SHARDS = ['default', 'messages-1', 'messages-2']
+
+
+class ShardForTests(SimpleTestCase):
+    def tearDown(self):
+        shard_for.cache_clear()
+
+    def test_is_stable_and_spreads_conversations(self):
+        conversations = [f'{i}:{i + 1}' for i in range(300)]
+        shards = [shard_for(conversation) for conversation in conversations]
+        shard_for.cache_clear()
+        self.assertEqual(shards, [shard_for(conversation)
+                                  for conversation in conversations])
+        for shard in SHARDS:
+            self.assertGreater(shards.count(shard), 50)
+
+    def test_adding_a_shard_only_moves_conversations_to_it(self):
+        conversations = [f'{i}:{i + 1}' for i in range(300)]
+        with override_settings(MESSAGE_SHARDS=SHARDS[:2]):
+            before = [shard_for(conversation)
+                      for conversation in conversations]
+        shard_for.cache_clear()
+        after = [shard_for(conversation) for conversation in conversations]
+        moved = [new for old, new in zip(before, after) if old != new]
+        self.assertTrue(moved)
+        self.assertEqual(set(moved), {'messages-2'})
+
+
+class MessageRouterTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_keeps_messages_on_shards_and_the_rest_on_default(self):
+        router = MessageRouter()
+        message = Message(conversation='1:2')
+        self.assertEqual(router.db_for_write(Message, instance=message),
+                         shard_for('1:2'))
+        self.assertEqual(router.db_for_read(User), 'default')
+        self.assertTrue(router.allow_migrate('messages-1', 'main',
+                                             'message'))
+        self.assertFalse(router.allow_migrate('messages-1', 'main', 'user'))
+        self.assertFalse(router.allow_migrate('messages-1', 'admin',
+                                              'logentry'))
+        tables = connections['messages-1'].introspection.table_names()
+        self.assertIn('message', tables)
+        self.assertNotIn('user', tables)
+
+
+class ShardedMessageTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.users = [create_user(f'70000000{i:02d}') for i in range(12)]
+        self.user = self.users[0]
+        batch = [message_entry(self.users[i % 12],
+                               self.users[(i * 5 + 1) % 12], f'h{i}',
+                               message=f'hello number {i}')
+                 for i in range(120) if i % 12 != (i * 5 + 1) % 12]
+        asyncio.run(MessageWriter.save(batch))
+        self.count = len(batch)
+
+    def tearDown(self):
+        shard_for.cache_clear()
+
+    def conversations_of(self, user):
+        return {other for other in self.users if other != user
+                and Message.history(user, other, None, 1)}
+
+    def test_messages_are_stored_on_their_shard(self):
+        counts = {shard: Message.objects.using(shard).count()
+                  for shard in SHARDS}
+        self.assertEqual(sum(counts.values()), self.count)
+        self.assertEqual(len([count for count in counts.values() if count]),
+                         3)
+        for shard in SHARDS:
+            for conversation in Message.objects.using(shard) \
+                    .values_list('conversation', flat=True):
+                self.assertEqual(shard_for(conversation), shard)
+
+    def test_fan_out_reads_every_shard(self):
+        expected = sum(Message.objects.using(shard).filter(
+            recipient=self.user
+        ).count() for shard in SHARDS)
+        self.assertGreater(expected, 0)
+        pages, cursor = [], 0
+        while True:
+            received = Message.pull_undelivered(self.user, cursor, 3)
+            if not received:
+                break
+            pages += received
+            cursor = received[-1].id
+        self.assertEqual(len(pages), expected)
+        self.assertEqual([message.id for message in pages],
+                         sorted(message.id for message in pages))
+        self.assertEqual(Message.pull_undelivered(self.user, cursor), [])
+
+        exported = Message.export(self.user, 0, 1000)
+        self.assertEqual(len(exported), sum(
+            Message.objects.using(shard).filter(
+                conversation__in=[
+                    Message.conversation_key(self.user.pk, other.pk)
+                    for other in self.users
+                ]
+            ).count() for shard in SHARDS
+        ))
+        found, after = [], None
+        while True:
+            page = Message.search(self.user, 'hello', after, 4)
+            found += page
+            if len(page) < 4:
+                break
+            after = (page[-1][1], page[-1][0].id)
+        self.assertEqual(sorted(message.id for message, _ in found),
+                         [message.id for message in exported])
+
+    def test_rebalance_moves_messages_to_their_new_shard(self):
+        histories = {other.pk: [message.id for message in Message.history(
+            self.user, other, None, 100
+        )] for other in self.users[1:]}
+        with override_settings(MESSAGE_SHARDS=SHARDS[:2]):
+            shard_for.cache_clear()
+            output = StringIO()
+            call_command('rebalance_messages', batch_size=7, stdout=output)
+            self.assertIn('messages-2: moved', output.getvalue())
+            self.assertEqual(Message.objects.using('messages-2').count(), 0)
+            self.assertEqual(sum(Message.objects.using(shard).count()
+                                 for shard in SHARDS[:2]), self.count)
+            self.assertEqual(histories, {
+                other.pk: [message.id for message in Message.history(
+                    self.user, other, None, 100
+                )] for other in self.users[1:]
+            })
+            self.assertEqual(len(Message.search(self.user, 'hello',
+                                                None, 50)),
+                             len(Message.export(self.user, 0, 1000)))
@@ -0,0 +1,125 @@
+import threading
+import time
+from unittest import mock
+from django.test import SimpleTestCase
+from django.test import TestCase
+from main.models import OTP
+from main.sms import FakeProvider
+from main.sms import SMSError
+from main.sms import SMSQueue
+from main.sms import sms_queue
+
+
+def wait_until(condition, timeout: float = 2) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class FlakyProvider(FakeProvider):
+    """
+    Fails the first `failures` sends with `error`
+    """
+
+    def __init__(self, failures: int, error: Exception):
+        super().__init__()
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+
+    def send(self, to: str, body: str) -> None:
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise self.error
+        super().send(to, body)
+
+
+class SMSQueueTests(SimpleTestCase):
+    def make_queue(self, provider, **options) -> SMSQueue:
+        queue = SMSQueue('main.sms.FakeProvider', backoff=0.001, **options)
+        queue.provider = provider
+        self.addCleanup(queue.executor.shutdown)
+        return queue
+
+    def test_sends_in_the_background_once(self):
+        provider = FakeProvider()
+        queue = self.make_queue(provider)
+        self.assertTrue(queue.send('+447000000001', 'code 1'))
+        # a duplicate within the window
+        self.assertTrue(queue.send('+447000000001', 'code 1'))
+        self.assertTrue(queue.send('+447000000001', 'code 2'))
+        self.assertTrue(wait_until(lambda: len(provider.sent) == 2))
+        time.sleep(0.02)
+        self.assertEqual(sorted(provider.sent),
+                         [('+447000000001', 'code 1'),
+                          ('+447000000001', 'code 2')])
+
+    def test_retries_temporary_failures(self):
+        provider = FlakyProvider(2, SMSError('busy'))
+        queue = self.make_queue(provider)
+        queue.send('+447000000001', 'code')
+        self.assertTrue(wait_until(lambda: provider.sent))
+        self.assertEqual(provider.attempts, 3)
+
+    def test_permanent_failure_allows_sending_again(self):
+        provider = FlakyProvider(1, SMSError('invalid number', retry=False))
+        queue = self.make_queue(provider)
+        with self.assertLogs('main.sms', 'WARNING'):
+            queue.send('+447000000001', 'code')
+            self.assertTrue(wait_until(lambda: not queue.recent))
+        self.assertEqual(provider.attempts, 1)
+        queue.send('+447000000001', 'code')
+        self.assertTrue(wait_until(lambda: provider.sent))
+
+    def test_unexpected_errors_are_logged_and_forgotten(self):
+        provider = FlakyProvider(1, KeyError('TWILIO_PHONE_NUMBER'))
+        queue = self.make_queue(provider)
+        with self.assertLogs('main.sms', 'ERROR') as logs:
+            queue.send('+447000000001', 'code')
+            self.assertTrue(wait_until(lambda: not queue.recent))
+        self.assertIn('Traceback', logs.output[0])
+        self.assertEqual(provider.attempts, 1)
+        queue.send('+447000000001', 'code')
+        self.assertTrue(wait_until(lambda: provider.sent))
+
+    def test_full_queue_refuses(self):
+        release = threading.Event()
+        provider = FakeProvider()
+        provider.send = lambda to, body: release.wait(2)
+        queue = self.make_queue(provider, concurrency=1, max_pending=2)
+        self.assertTrue(queue.send('+447000000001', 'a'))
+        self.assertTrue(queue.send('+447000000002', 'b'))
+        self.assertFalse(queue.send('+447000000003', 'c'))
+        release.set()
+        self.assertTrue(wait_until(lambda: queue.send('+447000000003', 'c')))
+
+
+class LoginViewTests(TestCase):
+    def setUp(self):
+        self.provider = FakeProvider()
+        patcher = mock.patch.object(sms_queue, 'provider', self.provider)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sms_queue.recent.clear()
+
+    def login(self):
+        return self.client.post('/login/', {
+            'country_code': '+44', 'phone_number': '7000000001',
+        }, content_type='application/json')
+
+    def test_repeated_logins_send_one_code(self):
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login().status_code, 200)
+        self.assertTrue(wait_until(lambda: self.provider.sent))
+        time.sleep(0.02)
+        self.assertEqual(len(self.provider.sent), 1)
+        to, body = self.provider.sent[0]
+        self.assertEqual(to, '+447000000001')
+        self.assertIn(str(OTP.objects.get().otp_code), body)
+
+    def test_busy_queue(self):
+        with mock.patch.object(sms_queue, 'send', return_value=False):
+            self.assertEqual(self.login().status_code, 503)
@@ -0,0 +1,115 @@
+from unittest import mock
+from urllib.parse import urlencode
+from django.test import TransactionTestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from main.models import Message
+from main.models import OTP
+from main.sms import sms_queue
+from .helpers import create_user
+
+
+def hashes(response) -> list[str]:
+    return [event['hash'] for event in response.data['messages']]
+
+
+class SyncViewTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.alice = create_user('7000000001')
+        self.bob = create_user('7000000002')
+        for i in range(5):
+            Message.objects.create(sender=self.alice, recipient=self.bob,
+                                   content=f'message {i}', hash=f'h{i}',
+                                   timestamp='1', delivered=i == 0)
+
+    def sync(self, user, **fields):
+        return self.client.post('/sync/', {'access_token': user.access_token,
+                                           **fields},
+                                content_type='application/json')
+
+    def test_pages_through_undelivered_messages(self):
+        response = self.sync(self.bob, limit=3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(hashes(response), ['h1', 'h2', 'h3'])
+        self.assertTrue(response.data['has_more'])
+        response = self.sync(self.bob, cursor=response.data['cursor'],
+                             limit=3)
+        self.assertEqual(hashes(response), ['h4'])
+        self.assertFalse(response.data['has_more'])
+        # handed out again until they are acknowledged
+        self.assertEqual(hashes(self.sync(self.bob)), ['h1', 'h2', 'h3', 'h4'])
+        Message.mark_receipts(self.bob, self.alice.pk, [], 'h4', read=False)
+        self.assertEqual(self.sync(self.bob).data['messages'], [])
+
+    def test_rejects_unknown_fields_and_bad_cursors(self):
+        self.assertEqual(self.sync(self.bob, since=1).status_code, 406)
+        self.assertEqual(self.sync(self.bob, cursor='1').status_code, 406)
+        for cursor in (-1, 2 ** 63, 10 ** 30):
+            self.assertEqual(self.sync(self.bob, cursor=cursor).status_code,
+                             406)
+        self.assertEqual(self.client.post(
+            '/sync/', {}, content_type='application/json'
+        ).status_code, 406)
+
+    def test_rejects_malformed_tokens(self):
+        response = self.client.post('/sync/', {'access_token': 'garbage'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+
+class AuthFlowTests(TransactionTestCase):
+    databases = '__all__'
+
+    def post(self, path: str, **data):
+        return self.client.post(path, data, content_type='application/json')
+
+    def test_login_verify_and_details(self):
+        with mock.patch.object(sms_queue, 'send', return_value=True):
+            response = self.post('/login/', country_code='+44',
+                                 phone_number='7000000001')
+        self.assertEqual(response.status_code, 200)
+        otp = OTP.objects.get()
+        response = self.post('/verify-otp/', country_code='+44',
+                             phone_number='7000000001',
+                             otp=otp.otp_code + 1)
+        self.assertEqual(response.status_code, 406)
+        response = self.post('/verify-otp/', country_code='+44',
+                             phone_number='7000000001', otp=otp.otp_code)
+        self.assertEqual(response.status_code, 200)
+        access_token = response.json()['access_token']
+        response = self.post('/user-details/', access_token=access_token)
+        self.assertEqual(response.json(), {'phone_number': '7000000001'})
+
+    def test_validation_errors(self):
+        self.assertEqual(self.post('/login/', country_code='44',
+                                   phone_number='7000000001').status_code,
+                         406)
+        self.assertEqual(self.post('/verify-otp/', country_code='+44',
+                                   phone_number='7000000001',
+                                   otp='123456').status_code, 406)
+        self.assertEqual(self.post('/user-details/').status_code, 406)
+
+    def test_details_reject_malformed_and_superseded_tokens(self):
+        user = create_user('7000000001')
+        for access_token in ('garbage', str(RefreshToken.for_user(user)
+                                            .access_token)):
+            response = self.post('/user-details/', access_token=access_token)
+            self.assertEqual(response.status_code, 401)
+
+    def test_form_and_multipart_bodies(self):
+        user = create_user('7000000001')
+        response = self.client.post('/user-details/',
+                                    {'access_token': user.access_token})
+        self.assertEqual(response.json(), {'phone_number': '7000000001'})
+        response = self.client.post(
+            '/user-details/', urlencode({'access_token': user.access_token}),
+            content_type='application/x-www-form-urlencoded'
+        )
+        self.assertEqual(response.json(), {'phone_number': '7000000001'})
+
+    def test_malformed_body(self):
+        response = self.client.post('/login/', 'nope',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/login/').status_code, 405)
@@ -0,0 +1,18 @@
+from django.test import SimpleTestCase
+from django.test import override_settings
+from chat.workers import deflate_extensions
+
+
+class DeflateExtensionsTests(SimpleTestCase):
+    @override_settings(WEBSOCKET_DEFLATE={'ENABLED': True,
+                                          'MAX_WINDOW_BITS': 10,
+                                          'MEM_LEVEL': 4})
+    def test_window_and_memory_from_the_settings(self):
+        [extension] = deflate_extensions()
+        self.assertEqual(extension.server_max_window_bits, 10)
+        self.assertEqual(extension.client_max_window_bits, 10)
+        self.assertEqual(extension.compress_settings, {'memLevel': 4})
+
+    @override_settings(WEBSOCKET_DEFLATE={'ENABLED': False})
+    def test_disabled(self):
+        self.assertEqual(deflate_extensions(), [])
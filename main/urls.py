@@ -3,10 +3,22 @@ from .views import LoginView
 from .views import OTPVerificationView
 from .views import UserDetailsView
 from .views import ContactsVerificationView
+from .views import SyncView
+from .views import HistoryView
+from .views import SearchView
+from .views import ExportView
+from .views import BlobUploadView
+from .views import BlobDownloadView
 
 urlpatterns = [
     path('login/', LoginView.as_view()),
     path('verify-otp/', OTPVerificationView.as_view()),
     path('user-details/', UserDetailsView.as_view()),
     path('check-contacts/', ContactsVerificationView.as_view()),
+    path('sync/', SyncView.as_view()),
+    path('history/', HistoryView.as_view()),
+    path('search/', SearchView.as_view()),
+    path('export/', ExportView.as_view()),
+    path('blobs/', BlobUploadView.as_view()),
+    path('blobs/<str:digest>/', BlobDownloadView.as_view()),
 ]
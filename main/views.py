@@ -3,130 +3,126 @@ from __future__ import annotations
 from rest_framework.views import APIView
 from rest_framework import status
 from rest_framework.response import Response
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from rest_framework_simplejwt.tokens import RefreshToken
-import jwt
+import json
+import math
 import re
-import os
-from twilio.rest import Client
-from twilio.base.exceptions import TwilioRestException
+import zlib
+from typing import AsyncGenerator
 from .models import User
 from .models import OTP
+from .models import Message
+from .models import Contact
 from .serializers import UserSerializer
-from chat.settings import SECRET_KEY
+from .async_views import AsyncAPIView
+from .auth import AccessTokenAuthentication
+from .auth import load_token_user
+from .auth import token_user
+from .metrics import sync_to_async
+from .blobs import blob_store
+from .streaming import AsyncStreamingHttpResponse
+from .archive import archived_until
+from .blobs import BlobTooLarge
+from .sms import sms_queue
+from django.conf import settings
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# largest SQLite INTEGER, ids in cursors and parameters above it overflow
+MAX_ID = 2 ** 63 - 1
 
-class LoginView(APIView):
+
+class LoginView(AsyncAPIView):
     """
        API to register users
     """
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, data: dict, *args, **kwargs):
         response: dict = {'details': 'success'}
         status_code: int = status.HTTP_200_OK
-        if len(request.data) != 2:
+        if len(data) != 2:
             response['error'] = 'not allowed'
             response['details'] = 'only field `phone_number`'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         elif not re.search(r'^\+[0-9]{1,4}$',
-                           request.data.get('country_code', '')):
+                           str(data.get('country_code', ''))):
             response['error'] = 'wrong information'
             response['details'] = '`country_code` must not be empty'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         elif not re.search(r'^[0-9]{7,20}$',
-                           request.data.get('phone_number', '')):
+                           str(data.get('phone_number', ''))):
             response['error'] = 'wrong information'
             response['details'] = '`phone_number` must not be empty'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         else:
-            # TODO: SECURITY HOLE create a user after validation
-            serializer = UserSerializer(data=request.data)
-            if serializer.is_valid():
-                user = serializer.save()
-                otp, created = OTP.update_or_create_otp(user)
-                is_sent: bool = self.send_otp(
-                    request.data['country_code']
-                    + request.data['phone_number'],
-                    otp.otp_code
-                )
-                if created and not is_sent:
-                    response['error'] = 'invalid phone number'
-                    response['details'] = 'invalid phone number'
-                    status_code = status.HTTP_406_NOT_ACCEPTABLE
-            else:
-                user = User.exists(phone_number=request.data['phone_number'])
-                user.is_active = False
-                user.save()
-                otp, created = OTP.update_or_create_otp(user)
-                is_sent: bool = self.send_otp(
-                    request.data['country_code']
-                    + request.data['phone_number'],
-                    otp.otp_code
-                )
-                if not created and not is_sent:
-                    response['error'] = 'invalid phone number'
-                    response['details'] = 'invalid phone number'
-                    status_code = status.HTTP_406_NOT_ACCEPTABLE
+            user, otp = await self.login(data)
+            # the SMS is sent in the background, see main.sms
+            if not sms_queue.send_otp(user.country_code + user.phone_number,
+                                      otp.otp_code):
+                response['error'] = 'busy'
+                response['details'] = 'try again later'
+                status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return response, status_code
 
-                # response['error'] = 'error'
-                # response['details'] = 'Phone number might be in use'
-                # status_code = status.HTTP_406_NOT_ACCEPTABLE
-        return Response(data=response, status=status_code)
+    @staticmethod
+    @sync_to_async
+    def login(data: dict) -> tuple[User, OTP]:
+        # TODO: SECURITY HOLE create a user after validation
+        serializer = UserSerializer(data=data)
+        if serializer.is_valid():
+            user = serializer.save()
+        else:
+            user = User.exists(phone_number=data['phone_number'])
+            user.is_active = False
+            user.save()
 
-    def send_otp(self, phone_number: str, otp_code: int) -> bool:
-        account_sid = os.environ['TWILIO_ACCOUNT_SID']
-        auth_token = os.environ['TWILIO_AUTH_TOKEN']
-        twilio_phone_number = os.environ['TWILIO_PHONE_NUMBER']
-        client = Client(account_sid, auth_token)
-        try:
-            client.messages.create(
-                body='Welcome to SGB\'s Utopia'
-                     f'! this is your code: {otp_code}',
-                from_=twilio_phone_number,
-                to=phone_number
-            )
-            return True
-        except TwilioRestException:
-            return False
+            # response['error'] = 'error'
+            # response['details'] = 'Phone number might be in use'
+            # status_code = status.HTTP_406_NOT_ACCEPTABLE
+        otp, created = OTP.update_or_create_otp(
+            user, timedelta(seconds=settings.SMS['DEDUPE_WINDOW'])
+        )
+        return user, otp
 
 
-class OTPVerificationView(APIView):
+class OTPVerificationView(AsyncAPIView):
     """
     Validates the user's OTP
     """
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, data: dict, *args, **kwargs):
         response: dict = {'details': 'success'}
         status_code: int = status.HTTP_200_OK
-        if len(request.data) != 3:
+        if len(data) != 3:
             response['error'] = 'not allowed'
             response['details'] = 'only `phone_number` and `otp` are required'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         elif not re.search(r'^\+[0-9]{1,4}$',
-                           request.data.get('country_code', '')):
+                           str(data.get('country_code', ''))):
             response['error'] = 'wrong information'
             response['details'] = '`country_code` must not be empty'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         elif not re.search(r'^[0-9]{7,20}$',
-                           request.data.get('phone_number', '')):
+                           str(data.get('phone_number', ''))):
             response['error'] = 'wrong information'
             response['details'] = '`phone_number` must not be empty'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
-        elif not isinstance(request.data['otp'], int):
+        elif not isinstance(data['otp'], int):
             response['error'] = 'wrong information'
             response['details'] = 'Invalid OTP'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         else:
-            user: User = User.exists(phone_number=request.data['phone_number'])
+            user, access_token = await self.verify(data['phone_number'],
+                                                   data['otp'])
             if user:
-                if user.is_active:
-                    pass
-                elif OTP.is_valid(user, request.data['otp']):
-                    user.activate()
-                    access_token = str(
-                        RefreshToken.for_user(user).access_token)
-                    user.access_token = access_token
-                    user.save()
+                if access_token:
                     response['access_token'] = access_token
+                elif user.is_active:
+                    pass
                 else:
                     response['error'] = 'error'
                     response['details'] = 'Invalid OTP'
@@ -135,31 +131,43 @@ class OTPVerificationView(APIView):
                 response['error'] = 'error'
                 response['details'] = 'Phone number does not exist'
                 status_code = status.HTTP_404_NOT_FOUND
-        return Response(data=response, status=status_code)
+        return response, status_code
+
+    @staticmethod
+    @sync_to_async
+    def verify(phone_number: str,
+               otp_code: int) -> tuple[User | None, str | None]:
+        """
+        The user, and a new access token if `otp_code` activated them
+        """
+        user: User = User.exists(phone_number=phone_number)
+        if user and not user.is_active and OTP.is_valid(user, otp_code):
+            user.activate()
+            user.access_token = str(RefreshToken.for_user(user).access_token)
+            user.save()
+            return user, user.access_token
+        return user, None
 
 
-class UserDetailsView(APIView):
+class UserDetailsView(AsyncAPIView):
     """
     User details
     """
 
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, data: dict, *args, **kwargs):
         response: dict = {}
         status_code: int = status.HTTP_200_OK
-        if len(request.data) != 1:
+        if len(data) != 1:
             response['error'] = 'not allowed'
             response['details'] = 'fields `access_token` ' \
                                   'is required'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
-        elif not request.data.get('access_token', None):
+        elif not data.get('access_token', None):
             response['error'] = 'wrong information'
             response['details'] = 'field `access_token` must not be empty'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         else:
-            decoded: dict = jwt.decode(request.data['access_token'],
-                                       SECRET_KEY,
-                                       algorithms=['HS256'])
-            user: User = User.exists(pk=decoded['user_id'])
+            user: User | None = await load_token_user(data['access_token'])
             if user:
                 if user.is_active:
                     response['phone_number'] = user.phone_number
@@ -169,52 +177,214 @@ class UserDetailsView(APIView):
                         'details'] = 'Register again and verify your account'
                     status_code = status.HTTP_406_NOT_ACCEPTABLE
             else:
-                response['error'] = 'error'
-                response['details'] = 'Phone number does not exist'
-                status_code = status.HTTP_404_NOT_FOUND
+                response['error'] = 'wrong information'
+                response['details'] = 'invalid `access_token`'
+                status_code = status.HTTP_401_UNAUTHORIZED
 
-        return Response(data=response, status=status_code)
+        return response, status_code
+
+
+class ContactsVerificationView(AsyncAPIView):
+    """
+    Verify contacts, either as phone numbers or as their sha256 hashes
+    """
+
+    async def post(self, request, data: dict, *args, **kwargs):
+        response: dict = {}
+        status_code: int = status.HTTP_200_OK
+        if len(data) != 2:
+            response['error'] = 'not allowed'
+            response['details'] = 'fields `access_token` and ' \
+                                  '`phone_numbers` or `phone_hashes` ' \
+                                  'are required'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not data.get('access_token', None):
+            response['error'] = 'wrong information'
+            response['details'] = 'field `access_token` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not data.get('phone_numbers', None) \
+                and not data.get('phone_hashes', None):
+            response['error'] = 'wrong information'
+            response['details'] = 'field `phone_numbers` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not isinstance(data.get('phone_hashes' if 'phone_hashes' in data
+                                     else 'phone_numbers'), list):
+            # the malformed items of a list are skipped, see check_numbers
+            response['error'] = 'wrong information'
+            response['details'] = 'fields `phone_numbers` and ' \
+                                  '`phone_hashes` must be lists'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        else:
+            user: User | None = await load_token_user(data['access_token'])
+            if user:
+                if user.is_active:
+                    if 'phone_hashes' in data:
+                        response['phone_hashes'] = await self.check_hashes(
+                            user, data['phone_hashes']
+                        )
+                    else:
+                        response['phone_numbers'] = \
+                            await self.check_numbers(
+                                user, data['phone_numbers']
+                            )
+                else:
+                    response['error'] = 'error'
+                    response[
+                        'details'] = 'Register again and verify your account'
+                    status_code = status.HTTP_406_NOT_ACCEPTABLE
+            else:
+                response['error'] = 'wrong information'
+                response['details'] = 'invalid `access_token`'
+                status_code = status.HTTP_401_UNAUTHORIZED
+        return response, status_code
+
+    @staticmethod
+    @sync_to_async
+    def check_numbers(user: User,
+                      numbers: list[dict[str, str]]) -> list[dict[str, str]]:
+        numbers = [number for number in numbers
+                   if isinstance(number, dict)
+                   and isinstance(number.get('country_code'), str)
+                   and isinstance(number.get('phone_number'), str)]
+        registered: set[tuple[str, str]] = User.registered_phone_numbers(
+            [(number['country_code'], number['phone_number'])
+             for number in numbers],
+            settings.CONTACTS_CHUNK_SIZE
+        )
+        registered.discard((user.country_code, user.phone_number))
+        # presence is pushed to the users who have the contact, see
+        # main.presence
+        Contact.add(user, [User.hash_phone_number(*number)
+                           for number in registered])
+        return [number for number in numbers
+                if (number['country_code'], number['phone_number'])
+                in registered]
+
+    @staticmethod
+    @sync_to_async
+    def check_hashes(user: User, hashes: list[str]) -> list[str]:
+        hashes = [phone_hash for phone_hash in hashes
+                  if isinstance(phone_hash, str)]
+        registered: set[str] = User.registered_phone_hashes(
+            hashes, settings.CONTACTS_CHUNK_SIZE
+        )
+        registered.discard(user.phone_hash)
+        Contact.add(user, list(registered))
+        return [phone_hash for phone_hash in hashes
+                if phone_hash in registered]
 
 
-class ContactsVerificationView(APIView):
+class SyncView(APIView):
     """
-    Verify contacts
+    Undelivered messages after a cursor
     """
 
     def post(self, request, *args, **kwargs):
         response: dict = {}
         status_code: int = status.HTTP_200_OK
-        if len(request.data) != 2:
+        if not set(request.data) <= {'access_token', 'cursor', 'limit'}:
             response['error'] = 'not allowed'
-            response['details'] = 'fields `access_token` ' \
-                                  'is required'
+            response['details'] = 'only fields `access_token`, `cursor` ' \
+                                  'and `limit` are allowed'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         elif not request.data.get('access_token', None):
             response['error'] = 'wrong information'
             response['details'] = 'field `access_token` must not be empty'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
-        elif not request.data.get('phone_numbers', None):
+        elif not isinstance(request.data.get('cursor', 0), int) \
+                or not isinstance(request.data.get('limit', 0), int) \
+                or not 0 <= request.data.get('cursor', 0) <= MAX_ID:
             response['error'] = 'wrong information'
-            response['details'] = 'field `phone_numbers` must not be empty'
+            response['details'] = '`cursor` and `limit` must be integers'
             status_code = status.HTTP_406_NOT_ACCEPTABLE
         else:
-            decoded: dict = jwt.decode(request.data['access_token'],
-                                       SECRET_KEY,
-                                       algorithms=['HS256'])
-            user: User = User.exists(pk=decoded['user_id'])
+            user: User | None = token_user(request.data['access_token'])
             if user:
                 if user.is_active:
-                    phone_numbers: list[dict[str, str]] = []
-                    for number in request.data.get('phone_numbers'):
-                        county_code: str = number['country_code']
-                        phone_number: str = number['phone_number']
-                        if user.country_code != county_code \
-                                and user.phone_number != phone_number \
-                                and user.phone_number != User.exists(
-                            country_code=county_code,
-                            phone_number=phone_number):
-                            phone_numbers.append(number)
-                    response['phone_numbers'] = phone_numbers
+                    limit: int = min(
+                        max(request.data.get('limit', 0), 0)
+                        or settings.MESSAGE_SYNC_PAGE_SIZE,
+                        settings.MESSAGE_SYNC_PAGE_SIZE
+                    )
+                    messages: list[Message] = Message.pull_undelivered(
+                        user, request.data.get('cursor', 0), limit
+                    )
+                    response['messages'] = [message.to_event()
+                                            for message in messages]
+                    response['cursor'] = messages[-1].id if messages \
+                        else request.data.get('cursor', 0)
+                    response['has_more'] = len(messages) == limit
+                else:
+                    response['error'] = 'error'
+                    response[
+                        'details'] = 'Register again and verify your account'
+                    status_code = status.HTTP_406_NOT_ACCEPTABLE
+            else:
+                response['error'] = 'wrong information'
+                response['details'] = 'invalid `access_token`'
+                status_code = status.HTTP_401_UNAUTHORIZED
+        return Response(data=response, status=status_code)
+
+
+class HistoryView(APIView):
+    """
+    Conversation history, newest first, paged by an opaque `cursor`
+    """
+
+    def post(self, request, *args, **kwargs):
+        response: dict = {}
+        status_code: int = status.HTTP_200_OK
+        cursor = self.decode_cursor(request.data.get('cursor', ''))
+        if not set(request.data) <= {'access_token', 'country_code',
+                                     'phone_number', 'cursor', 'limit'}:
+            response['error'] = 'not allowed'
+            response['details'] = 'fields `access_token`, `country_code` ' \
+                                  'and `phone_number` are required'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not request.data.get('access_token', None):
+            response['error'] = 'wrong information'
+            response['details'] = 'field `access_token` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not re.search(r'^\+[0-9]{1,4}$',
+                           str(request.data.get('country_code', ''))):
+            response['error'] = 'wrong information'
+            response['details'] = '`country_code` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not re.search(r'^[0-9]{7,20}$',
+                           str(request.data.get('phone_number', ''))):
+            response['error'] = 'wrong information'
+            response['details'] = '`phone_number` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif cursor is False \
+                or not isinstance(request.data.get('limit', 0), int):
+            response['error'] = 'wrong information'
+            response['details'] = 'invalid `cursor` or `limit`'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        else:
+            user: User | None = token_user(request.data['access_token'])
+            other_user: User = User.exists(
+                country_code=request.data['country_code'],
+                phone_number=request.data['phone_number']
+            )
+            if user is None:
+                response['error'] = 'wrong information'
+                response['details'] = 'invalid `access_token`'
+                status_code = status.HTTP_401_UNAUTHORIZED
+            elif other_user:
+                if user.is_active:
+                    limit: int = min(
+                        max(request.data.get('limit', 0), 0)
+                        or settings.MESSAGE_HISTORY_PAGE_SIZE,
+                        settings.MESSAGE_HISTORY_PAGE_SIZE
+                    )
+                    messages: list[Message] = Message.history(
+                        user, other_user, cursor, limit
+                    )
+                    response['messages'] = [message.to_event()
+                                            for message in messages]
+                    response['cursor'] = self.encode_cursor(messages[-1]) \
+                        if messages else None
+                    response['has_more'] = len(messages) == limit
                 else:
                     response['error'] = 'error'
                     response[
@@ -226,49 +396,296 @@ class ContactsVerificationView(APIView):
                 status_code = status.HTTP_404_NOT_FOUND
         return Response(data=response, status=status_code)
 
-# class UploadImageView(APIView):
-#     """
-#     Upload images
-#     """
-#     def sign_request(self):
-#         pass
-#
-#     def post(self, request, *args, **kwargs):
-#         response: dict = {}
-#         status_code: int = status.HTTP_200_OK
-#         if len(request.data) != 2:
-#             response['error'] = 'not allowed'
-#             response['details'] = 'fields `access_token` ' \
-#                                   'is required'
-#             status_code = status.HTTP_406_NOT_ACCEPTABLE
-#         elif not request.data.get('access_token', None):
-#             response['error'] = 'wrong information'
-#             response['details'] = 'field `access_token` must not be empty'
-#             status_code = status.HTTP_406_NOT_ACCEPTABLE
-#         elif not request.data.get('phone_numbers', None):
-#             response['error'] = 'wrong information'
-#             response['details'] = 'field `phone_numbers` must not be empty'
-#             status_code = status.HTTP_406_NOT_ACCEPTABLE
-#         else:
-#             decoded: dict = jwt.decode(request.data['access_token'],
-#                                        'django-insecure-#60=6k*hajinp%m=e5$mn=+gr(&g6b)+91smxi*wv+3827x5nv',
-#                                        algorithms=['HS256'])
-#             user: User = User.exists(pk=decoded['user_id'])
-#             if user:
-#                 if user.is_active:
-#                     phone_numbers: list[str] = []
-#                     for phone_number in request.data.get('phone_numbers'):
-#                         if User.exists(phone_number=phone_number):
-#                             phone_numbers.append(phone_number)
-#                     response['phone_numbers'] = phone_numbers
-#                 else:
-#                     response['error'] = 'error'
-#                     response[
-#                         'details'] = 'Register again and verify your account'
-#                     status_code = status.HTTP_406_NOT_ACCEPTABLE
-#             else:
-#                 response['error'] = 'error'
-#                 response['details'] = 'Phone number does not exist'
-#                 status_code = status.HTTP_404_NOT_FOUND
-#
-#         return Response(data=response, status=status_code)
+    @staticmethod
+    def encode_cursor(message: Message) -> str:
+        # microseconds since the epoch and id of the last message sent
+        delta = message.creation_date - EPOCH
+        return f'{delta // timedelta(microseconds=1)}.{message.id}'
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple[datetime, int] | None | bool:
+        """
+        (creation_date, id) of a cursor, None for the first page and
+        False if it is invalid
+        """
+        if not cursor:
+            return None
+        match = re.search(r'^(-?[0-9]{1,20})\.([0-9]{1,20})$', str(cursor))
+        if not match or int(match.group(2)) > MAX_ID:
+            return False
+        try:
+            creation_date = EPOCH + timedelta(microseconds=int(match.group(1)))
+        except OverflowError:
+            # outside the range of datetime
+            return False
+        return creation_date, int(match.group(2))
+
+
+class SearchView(AsyncAPIView):
+    """
+    Full-text search of the caller's messages, best match first, paged by
+    an opaque `cursor`
+    """
+
+    async def post(self, request, data: dict, *args, **kwargs):
+        response: dict = {}
+        status_code: int = status.HTTP_200_OK
+        cursor = self.decode_cursor(data.get('cursor', ''))
+        if not set(data) <= {'access_token', 'query', 'cursor', 'limit'}:
+            response['error'] = 'not allowed'
+            response['details'] = 'fields `access_token` and `query` ' \
+                                  'are required'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not data.get('access_token', None):
+            response['error'] = 'wrong information'
+            response['details'] = 'field `access_token` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif not isinstance(data.get('query'), str) \
+                or not data['query'].strip() \
+                or len(data['query']) > 256:
+            response['error'] = 'wrong information'
+            response['details'] = '`query` must not be empty'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif cursor is False or not isinstance(data.get('limit', 0), int):
+            response['error'] = 'wrong information'
+            response['details'] = 'invalid `cursor` or `limit`'
+            status_code = status.HTTP_406_NOT_ACCEPTABLE
+        else:
+            user: User | None = await load_token_user(data['access_token'])
+            if user:
+                if user.is_active:
+                    limit: int = min(
+                        max(data.get('limit', 0), 0)
+                        or settings.MESSAGE_SEARCH_PAGE_SIZE,
+                        settings.MESSAGE_SEARCH_PAGE_SIZE
+                    )
+                    results, archived = await self.search(
+                        user, data['query'], cursor, limit
+                    )
+                    response['messages'] = [message.to_event()
+                                            for message, _ in results]
+                    # archived messages are not searched, see main.archive
+                    response['archived_until'] = archived
+                    response['cursor'] = self.encode_cursor(*results[-1]) \
+                        if results else None
+                    response['has_more'] = len(results) == limit
+                else:
+                    response['error'] = 'error'
+                    response[
+                        'details'] = 'Register again and verify your account'
+                    status_code = status.HTTP_406_NOT_ACCEPTABLE
+            else:
+                response['error'] = 'wrong information'
+                response['details'] = 'invalid `access_token`'
+                status_code = status.HTTP_401_UNAUTHORIZED
+        return response, status_code
+
+    @staticmethod
+    @sync_to_async
+    def search(user: User, text: str, cursor: tuple[float, int] | None,
+               limit: int) -> tuple[list[tuple[Message, float]], str | None]:
+        return Message.search(user, text, cursor, limit), archived_until()
+
+    @staticmethod
+    def encode_cursor(message: Message, rank: float) -> str:
+        # rank and id of the last message sent, repr() round-trips floats
+        return f'{rank!r}:{message.id}'
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple[float, int] | None | bool:
+        """
+        (rank, id) of a cursor, None for the first page and False if it is
+        invalid
+        """
+        if not cursor:
+            return None
+        match = re.search(r'^(-?[0-9.e+-]{1,32}):([0-9]{1,20})$', str(cursor))
+        if not match:
+            return False
+        try:
+            rank = float(match.group(1))
+        except ValueError:
+            return False
+        # 1e999 parses as inf
+        if not math.isfinite(rank) or int(match.group(2)) > MAX_ID:
+            return False
+        return rank, int(match.group(2))
+
+
+class ExportView(APIView):
+    """
+    Every message of the caller as newline-delimited JSON, oldest first,
+    gzip compressed if the client accepts it. An interrupted export is
+    resumed with `?cursor=` set to the `id` of the last line received.
+    Staff can export another user's messages with `?user=`. Messages moved
+    to main.archive are read back from it in the same order.
+    """
+
+    authentication_classes = [AccessTokenAuthentication]
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response(data={'error': 'not allowed',
+                                  'details': 'header `Authorization` '
+                                             'is required'},
+                            status=status.HTTP_401_UNAUTHORIZED)
+        cursor: str = request.query_params.get('cursor', '0')
+        user_id: str = request.query_params.get('user', '')
+        # checked before the response starts, an overflow while streaming
+        # would cut the export short
+        if not re.search(r'^[0-9]{1,20}$', cursor) \
+                or not re.search(r'^([0-9]{1,20})?$', user_id) \
+                or int(cursor) > MAX_ID or int(user_id or 0) > MAX_ID:
+            return Response(data={'error': 'wrong information',
+                                  'details': '`cursor` and `user` must be '
+                                             'integers'},
+                            status=status.HTTP_406_NOT_ACCEPTABLE)
+        user: User = request.user
+        if user_id and int(user_id) != user.pk:
+            if not user.is_staff:
+                return Response(data={'error': 'not allowed',
+                                      'details': 'only staff can export '
+                                                 'other users'},
+                                status=status.HTTP_403_FORBIDDEN)
+            user = User.exists(pk=int(user_id))
+            if not user:
+                return Response(data={'error': 'error',
+                                      'details': 'user does not exist'},
+                                status=status.HTTP_404_NOT_FOUND)
+        compress: bool = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING',
+                                                    '')
+        http_response = AsyncStreamingHttpResponse(
+            self.lines(user, int(cursor), compress),
+            content_type='application/x-ndjson'
+        )
+        if compress:
+            http_response['Content-Encoding'] = 'gzip'
+        http_response['Vary'] = 'Accept-Encoding'
+        http_response['Content-Disposition'] = \
+            f'attachment; filename="messages-{user.pk}.ndjson"'
+        return http_response
+
+    @staticmethod
+    async def lines(user: User, cursor: int,
+                    compress: bool) -> AsyncGenerator[bytes, None]:
+        # gzip members flushed after every page, so whatever the client
+        # got before an interruption can be decompressed
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        while True:
+            data, cursor = await ExportView.page(user, cursor)
+            if not data:
+                break
+            if compressor is None:
+                yield data
+            else:
+                yield compressor.compress(data) \
+                    + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressor is not None:
+            yield compressor.flush()
+
+    @staticmethod
+    @sync_to_async
+    def page(user: User, cursor: int) -> tuple[bytes, int]:
+        # one page in memory at a time, encoded off the event loop
+        messages: list[Message] = Message.export(
+            user, cursor, settings.MESSAGE_EXPORT_CHUNK_SIZE
+        )
+        if not messages:
+            return b'', cursor
+        return ''.join(json.dumps(message.to_export()) + '\n'
+                       for message in messages).encode(), messages[-1].id
+
+
+class BlobUploadView(APIView):
+    """
+    Upload an image as the raw request body,
+    authenticated with an `Authorization: Bearer` access token.
+    The body is copied to the store chunk by chunk, under ASGI Django has
+    already spooled it to a temporary file before the view runs.
+    """
+
+    authentication_classes = [AccessTokenAuthentication]
+
+    def post(self, request, *args, **kwargs):
+        response: dict = {'details': 'success'}
+        status_code: int = status.HTTP_201_CREATED
+        if not request.user.is_authenticated:
+            response['error'] = 'not allowed'
+            response['details'] = 'header `Authorization` is required'
+            status_code = status.HTTP_401_UNAUTHORIZED
+        elif not re.search(r'^[0-9]{0,20}$',
+                           request.META.get('CONTENT_LENGTH') or ''):
+            response['error'] = 'wrong information'
+            response['details'] = 'invalid header `Content-Length`'
+            status_code = status.HTTP_400_BAD_REQUEST
+        elif int(request.META.get('CONTENT_LENGTH') or 0) \
+                > settings.BLOB_MAX_SIZE:
+            response['error'] = 'wrong information'
+            response['details'] = 'image is too large'
+            status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        else:
+            try:
+                # read the raw body through the wrapped HttpRequest,
+                # without buffering it in request.data
+                digest, created = blob_store.write(request._request,
+                                                   settings.BLOB_MAX_SIZE)
+                response['blob'] = digest
+                if not created:
+                    status_code = status.HTTP_200_OK
+            except BlobTooLarge:
+                response['error'] = 'wrong information'
+                response['details'] = 'image is too large'
+                status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        return Response(data=response, status=status_code)
+
+
+class BlobDownloadView(APIView):
+    """
+    Download an image, supports single `Range` requests
+    """
+
+    authentication_classes = [AccessTokenAuthentication]
+
+    def get(self, request, digest: str, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response(data={'error': 'not allowed',
+                                  'details': 'header `Authorization` '
+                                             'is required'},
+                            status=status.HTTP_401_UNAUTHORIZED)
+        if not blob_store.exists(digest):
+            return Response(data={'error': 'error',
+                                  'details': 'image does not exist'},
+                            status=status.HTTP_404_NOT_FOUND)
+        size: int = blob_store.size(digest)
+        start, end = 0, size - 1
+        range_match = re.search(r'^bytes=(\d*)-(\d*)$',
+                                request.META.get('HTTP_RANGE', ''))
+        if range_match and any(range_match.groups()):
+            if not range_match.group(1):
+                # suffix range, the last N bytes
+                start = max(size - int(range_match.group(2)), 0)
+            else:
+                start = int(range_match.group(1))
+                if range_match.group(2):
+                    end = min(int(range_match.group(2)), size - 1)
+            if start > end:
+                http_response = HttpResponse(
+                    status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+                )
+                http_response['Content-Range'] = f'bytes */{size}'
+                return http_response
+        http_response = StreamingHttpResponse(
+            blob_store.read(digest, start, end),
+            content_type='application/octet-stream',
+            status=status.HTTP_206_PARTIAL_CONTENT
+            if end - start + 1 < size else status.HTTP_200_OK
+        )
+        if http_response.status_code == status.HTTP_206_PARTIAL_CONTENT:
+            http_response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        http_response['Content-Length'] = str(end - start + 1)
+        http_response['Accept-Ranges'] = 'bytes'
+        http_response['ETag'] = f'"{digest}"'
+        # a digest always names the same content
+        http_response['Cache-Control'] = 'private, max-age=31536000, ' \
+                                         'immutable'
+        return http_response